@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import gzip
+import json
+import random
+import re
+import socketserver
+import sys
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import unquote
+
+# Local stand-in for the endpoints of the BV-BRC data API that compare_systems queries:
+# genome, genome_feature, subsystem, pathway and protein_family_ref. Every genome, feature
+# and record is generated from the genome id, so a genome always has the same data and
+# benchmarks of different sizes share their genomes. Only meant for benchmarks.
+
+# Genera the synthetic genomes belong to, genome ids are <genus taxon>.<number>
+GENERA = [1279, 561, 590, 1386, 286]
+DEFAULT_CDS = 4000
+# Families shared by most genomes of a genus and size of the family pool per genus
+CORE_FAMILIES = 2500
+FAMILIES = 60000
+
+GENOME_COLUMNS = {
+    'genome_id': 'Genome ID',
+    'genome_name': 'Genome Name',
+    'taxon_id': 'Taxon ID',
+    'genome_status': 'Genome Status',
+    'isolation_country': 'Isolation Country',
+    'collection_year': 'Collection Year',
+    'geographic_group': 'Geographic Group',
+    'host_group': 'Host Group',
+    'cds': 'CDS',
+    'genome_length': 'Size',
+    'contigs': 'Contigs'
+}
+FEATURE_COLUMNS = {
+    'genome_name': 'Genome',
+    'genome_id': 'Genome ID',
+    'accession': 'Accession',
+    'patric_id': 'BRC ID',
+    'refseq_locus_tag': 'RefSeq Locus Tag',
+    'alt_locus_tag': 'Alt Locus Tag',
+    'feature_id': 'Feature ID',
+    'annotation': 'Annotation',
+    'feature_type': 'Feature Type',
+    'start': 'Start',
+    'end': 'End',
+    'length': 'Length',
+    'strand': 'Strand',
+    'figfam_id': 'FIGfam ID',
+    'plfam_id': 'PATRIC genus-specific families (PLfams)',
+    'pgfam_id': 'PATRIC cross-genus families (PGfams)',
+    'protein_id': 'Protein ID',
+    'aa_length': 'AA Length',
+    'gene': 'Gene Symbol',
+    'product': 'Product',
+    'go': 'GO'
+}
+# Bookkeeping fields the service does not read, returned unless the query selects fields
+BOOKKEEPING = {'date_inserted': '2023-01-01T00:00:00Z', 'date_modified': '2023-01-01T00:00:00Z', 'owner': 'PATRIC', 'public': True, '_version_': 1}
+
+COUNTRIES = ['USA', 'China', 'Germany', 'Brazil', 'India', 'Kenya', '']
+HOST_GROUPS = ['Human', 'Bird', 'Pig', 'Environment', '']
+
+# Returns the ids of the first n synthetic genomes
+def get_genome_ids(n):
+    return [f'{GENERA[i % len(GENERA)]}.{10000 + i}' for i in range(n)]
+
+def get_genus(genome_id):
+    return int(genome_id.split('.')[0])
+
+def get_plfam_id(genus, family_index):
+    return f'PLF_{genus}_{family_index:08d}'
+
+def get_pgfam_id(family_index):
+    return f'PGF_{family_index // 2:08d}'
+
+# Products of the families, a few families have none
+def get_family_product(family_id):
+    family_index = int(family_id.rsplit('_', 1)[1])
+    if family_index % 97 == 0:
+        return None
+    if family_index % 5 == 0:
+        return 'hypothetical protein'
+    return f'Protein of family {family_id}'
+
+class SyntheticData:
+    '''
+    Generates the rows of the synthetic genomes. A genome has about cds CDS features, a
+    share of them with subsystem roles and pathway enzymes.
+    '''
+
+    def __init__(self, cds=DEFAULT_CDS, seed=0):
+        self.cds = cds
+        self.seed = seed
+        self.family_ids = None
+
+    def genome(self, genome_id):
+        rng = random.Random(f'{self.seed}:genome:{genome_id}')
+        cds = max(200, int(rng.gauss(self.cds, self.cds / 4)))
+        return {
+            'genome_id': genome_id,
+            'genome_name': f'Synthetic genus{get_genus(genome_id)} strain {genome_id.split(".")[1]}',
+            'taxon_id': get_genus(genome_id),
+            'genome_status': rng.choice(['WGS', 'WGS', 'Complete']),
+            'isolation_country': rng.choice(COUNTRIES),
+            'collection_year': rng.choice([rng.randint(1990, 2023), '']),
+            'geographic_group': rng.choice(['North America', 'Asia', 'Europe', 'Africa', '']),
+            'host_group': rng.choice(HOST_GROUPS),
+            'cds': cds,
+            'genome_length': cds * 1000,
+            'contigs': rng.randint(1, 200)
+        }
+
+    def features(self, genome_id):
+        genome = self.genome(genome_id)
+        genus = genome['taxon_id']
+        rng = random.Random(f'{self.seed}:features:{genome_id}')
+        features = []
+        for k in range(genome['cds']):
+            if rng.random() < 0.6:
+                family_index = k % CORE_FAMILIES
+            else:
+                family_index = rng.randrange(CORE_FAMILIES, FAMILIES)
+            start = k * 1000 + 1
+            aa_length = rng.randint(50, 1200)
+            strand = '+' if rng.random() < 0.5 else '-'
+            features.append({
+                'genome_name': genome['genome_name'],
+                'genome_id': genome_id,
+                'accession': f'CONTIG{genome_id}',
+                'patric_id': f'fig|{genome_id}.peg.{k + 1}',
+                'refseq_locus_tag': f'RS{k + 1:05d}' if k % 4 else '',
+                'alt_locus_tag': f'VBI{k + 1:07d}',
+                'feature_id': f'PATRIC.{genome_id}.CONTIG.CDS.{start:09d}.{start + aa_length * 3 + 2:09d}.{"fwd" if strand == "+" else "rev"}',
+                'annotation': 'PATRIC',
+                'feature_type': 'CDS',
+                'start': start,
+                'end': start + aa_length * 3 + 2,
+                'length': aa_length * 3 + 3,
+                'strand': strand,
+                'figfam_id': '',
+                'plfam_id': get_plfam_id(genus, family_index) if rng.random() < 0.95 else '',
+                'pgfam_id': get_pgfam_id(family_index) if rng.random() < 0.97 else '',
+                'protein_id': f'WP_{rng.randrange(10**9):09d}.1',
+                'aa_length': aa_length,
+                'gene': f'gene{family_index % 3000}' if rng.random() < 0.2 else '',
+                'product': get_family_product(get_pgfam_id(family_index)) or 'hypothetical protein',
+                'go': ''
+            })
+        return features
+
+    # Subsystem records of a genome, about a third of its features have a role
+    def subsystem_records(self, genome_id):
+        records = []
+        for feature in self.features(genome_id):
+            family_index = int(feature['pgfam_id'].rsplit('_', 1)[1]) if feature['pgfam_id'] else zlib.crc32(feature['feature_id'].encode()) % FAMILIES
+            if family_index % 3 != 0:
+                continue
+            subsystem = family_index % 900
+            record = {
+                'active': 'active' if subsystem % 7 else 'likely',
+                'class': f'Class {subsystem % 40}',
+                'feature_id': feature['feature_id'],
+                'gene': feature['gene'],
+                'genome_id': genome_id,
+                'genome_name': feature['genome_name'],
+                'id': f'{feature["feature_id"]}.{subsystem}',
+                'patric_id': feature['patric_id'],
+                'product': feature['product'],
+                'refseq_locus_tag': feature['refseq_locus_tag'],
+                'role_id': f'Role{family_index % 5000}',
+                'role_name': f'Role {family_index % 5000}',
+                'subclass': f'Subclass {subsystem % 120}',
+                'subsystem_id': f'Subsystem_{subsystem}',
+                'subsystem_name': f'Subsystem {subsystem}',
+                'superclass': ['METABOLISM', 'ENERGY', 'PROTEIN PROCESSING', 'STRESS RESPONSE', 'DNA PROCESSING'][subsystem % 5],
+                'taxon_id': get_genus(genome_id)
+            }
+            if not record['gene']:
+                del record['gene']
+            record.update(BOOKKEEPING)
+            records.append(record)
+        return records
+
+    # Pathway records of a genome, about a fifth of its features have an enzyme
+    def pathway_records(self, genome_id):
+        records = []
+        for feature in self.features(genome_id):
+            family_index = int(feature['pgfam_id'].rsplit('_', 1)[1]) if feature['pgfam_id'] else zlib.crc32(feature['feature_id'].encode()) % FAMILIES
+            if family_index % 5 != 1:
+                continue
+            pathway = family_index % 180
+            ec_number = f'{family_index % 6 + 1}.{family_index % 11}.{family_index % 4 + 1}.{family_index % 150}'
+            record = {
+                'accession': feature['accession'],
+                'alt_locus_tag': feature['alt_locus_tag'],
+                'annotation': 'PATRIC',
+                'ec_description': f'Enzyme {ec_number}',
+                'ec_number': ec_number,
+                'feature_id': feature['feature_id'],
+                'genome_ec': f'{genome_id}_{ec_number}',
+                'genome_id': genome_id,
+                'genome_name': feature['genome_name'],
+                'id': f'{feature["feature_id"]}.{pathway}',
+                'pathway_class': f'Pathway class {pathway % 12}',
+                'pathway_ec': f'{pathway:05d}_{ec_number}',
+                'pathway_id': f'{pathway:05d}',
+                'pathway_name': f'Pathway {pathway}',
+                'patric_id': feature['patric_id'],
+                'product': feature['product'],
+                'refseq_locus_tag': feature['refseq_locus_tag'],
+                'sequence_id': feature['accession'],
+                'taxon_id': get_genus(genome_id)
+            }
+            record.update(BOOKKEEPING)
+            records.append(record)
+        return records
+
+    # Every family id, in id order, for the paged protein_family_ref queries
+    def get_family_ids(self):
+        if self.family_ids is None:
+            family_ids = [get_plfam_id(genus, family_index) for genus in GENERA for family_index in range(FAMILIES)]
+            family_ids += [get_pgfam_id(family_index) for family_index in range(0, FAMILIES, 2)]
+            self.family_ids = sorted(family_ids)
+        return self.family_ids
+
+def family_records(family_ids):
+    records = []
+    for family_id in family_ids:
+        record = {'family_id': family_id, 'family_type': family_id[:5].lower().replace('_', ''), 'family_product': get_family_product(family_id)}
+        if record['family_product'] is None:
+            continue
+        record.update(BOOKKEEPING)
+        records.append(record)
+    return records
+
+# Parses the rql operators of a query the service sends into a dict of operator arguments
+def parse_query(query):
+    parsed = {}
+    for operator, args in re.findall(r'(\w+)\(([^()]*(?:\([^()]*\))?)\)', query):
+        if operator == 'in':
+            field, values = args.split(',', 1)
+            parsed.setdefault('in', {})[field] = values.strip('()').split(',') if values.strip('()') else []
+        elif operator in ('eq', 'gt'):
+            field, value = args.split(',', 1)
+            parsed.setdefault(operator, {})[field] = value
+        elif operator == 'select':
+            parsed['select'] = args.split(',')
+        elif operator == 'sort':
+            parsed['sort'] = args.strip(' +')
+        elif operator == 'limit':
+            parsed['limit'] = int(args.split(',')[0])
+    return parsed
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        self.respond(path, unquote(query.replace('http_download=true', '')))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        path = self.path.partition('?')[0]
+        self.respond(path, unquote(self.rfile.read(length).decode()))
+
+    def respond(self, path, query):
+        endpoint = path.strip('/').split('/')[-1]
+        parsed = parse_query(query)
+        try:
+            rows, columns = self.server.get_rows(endpoint, parsed)
+        except KeyError:
+            self.send_error(404, f'Unknown endpoint {endpoint}')
+            return
+        if 'text/tsv' in self.headers.get('Accept', ''):
+            body = render_tsv(rows, columns, parsed.get('select'))
+            content_type = 'text/tsv'
+        else:
+            body = json.dumps(rows if parsed.get('select') is None else [{field: row[field] for field in parsed['select'] if field in row} for row in rows])
+            content_type = 'application/json'
+        data = body.encode()
+        encoding = None
+        accept_encoding = self.headers.get('Accept-Encoding', '')
+        if 'gzip' in accept_encoding:
+            data = gzip.compress(data, compresslevel=1)
+            encoding = 'gzip'
+        elif 'deflate' in accept_encoding:
+            data = zlib.compress(data, 1)
+            encoding = 'deflate'
+        # latency and bandwidth of the remote api
+        time.sleep(self.server.latency + (len(data) / self.server.bandwidth if self.server.bandwidth else 0))
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+# Renders rows as the tsv download: quoted cells, columns named by display name unless fields were selected
+def render_tsv(rows, columns, select=None):
+    fields = select if select is not None else list(columns)
+    header = fields if select is not None else [columns[field] for field in fields]
+    lines = ['\t'.join(f'"{name}"' for name in header)]
+    for row in rows:
+        lines.append('\t'.join(f'"{row.get(field, "")}"' for field in fields))
+    return '\n'.join(lines) + '\n'
+
+class MockApiServer(socketserver.ForkingMixIn, HTTPServer):
+    '''
+    Serves every request from a forked process, so generating the rows of concurrent
+    queries does not serialize on one interpreter.
+    '''
+
+    def __init__(self, address, data, latency=0.0, bandwidth=0.0):
+        super().__init__(address, MockApiHandler)
+        self.data = data
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    # Returns the rows of the query on the endpoint with the columns of its tsv download
+    def get_rows(self, endpoint, parsed):
+        genome_ids = parsed.get('in', {}).get('genome_id', [])
+        if endpoint == 'genome':
+            rows, columns = [self.data.genome(genome_id) for genome_id in genome_ids], GENOME_COLUMNS
+        elif endpoint == 'genome_feature':
+            rows, columns = [feature for genome_id in genome_ids for feature in self.data.features(genome_id)], FEATURE_COLUMNS
+            annotation = parsed.get('eq', {}).get('annotation')
+            if annotation is not None:
+                rows = [row for row in rows if row['annotation'] == annotation]
+        elif endpoint == 'subsystem':
+            rows, columns = [record for genome_id in genome_ids for record in self.data.subsystem_records(genome_id)], None
+        elif endpoint == 'pathway':
+            rows, columns = [record for genome_id in genome_ids for record in self.data.pathway_records(genome_id)], None
+        elif endpoint == 'protein_family_ref':
+            family_ids = parsed.get('in', {}).get('family_id')
+            if family_ids is None:
+                # paged over every family: eq(family_id,*) then gt(family_id,<last>)
+                all_ids = self.data.get_family_ids()
+                after = parsed.get('gt', {}).get('family_id')
+                first = 0 if after is None else bisect.bisect_right(all_ids, after)
+                family_ids = all_ids[first:first + parsed.get('limit', 25000)]
+            rows, columns = family_records(family_ids), None
+        else:
+            raise KeyError(endpoint)
+        if parsed.get('sort'):
+            rows.sort(key=lambda row: str(row.get(parsed['sort'], '')))
+        if columns is None:
+            columns = {field: field for field in (rows[0] if rows else [])}
+        return (rows[:parsed.get('limit', len(rows))], columns)
+
+# Starts the server on host:port, port 0 picks a free port. Returns the server and its api url
+def start_server(host='127.0.0.1', port=0, cds=DEFAULT_CDS, seed=0, latency=0.0, bandwidth=0.0):
+    server = MockApiServer((host, port), SyntheticData(cds, seed), latency, bandwidth)
+    return (server, f'http://{host}:{server.server_address[1]}/api')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serves synthetic BV-BRC data API endpoints for benchmarks')
+    parser.add_argument('--host', help='address to listen on', required=False, default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='port to listen on, 0 picks a free port', required=False, default=0)
+    parser.add_argument('--cds', type=int, help=f'mean CDS count of a genome (default {DEFAULT_CDS})', required=False, default=DEFAULT_CDS)
+    parser.add_argument('--seed', type=int, help='seed of the synthetic data', required=False, default=0)
+    parser.add_argument('--latency', type=float, help='seconds added to every response', required=False, default=0.0)
+    parser.add_argument('--bandwidth', type=float, help='bytes per second responses are throttled to, unlimited when 0', required=False, default=0.0)
+    map_args = parser.parse_args()
+
+    server, url = start_server(map_args.host, map_args.port, map_args.cds, map_args.seed, map_args.latency, map_args.bandwidth)
+    print(f'listening on {url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    sys.exit(0)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from mock_api import DEFAULT_CDS, get_genome_ids
+
+# Runs compare_systems against the local mock api on jobs of increasing size and records
+# the wall time and peak memory of the job and of each of its stages, read from the
+# telemetry.json the job writes. Results can be compared with those of an earlier run.
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+DEFAULT_SIZES = '10,100,1000,5000'
+RESULTS_FILE = 'benchmark_results.json'
+# Environment variables of caches shared between jobs, unset so every job runs cold
+CACHE_ENVS = ['COMPARATIVE_SYSTEMS_CACHE_DIR', 'COMPARATIVE_SYSTEMS_RESULT_CACHE_DIR', 'COMPARATIVE_SYSTEMS_FAMILY_STORE']
+
+# Starts the mock api in its own process, so serving does not count in the measurements of the job
+def start_mock_api(cds, latency, bandwidth):
+    mock = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, 'mock_api.py'), '--port', '0', '--cds', str(cds),
+        '--latency', str(latency), '--bandwidth', str(bandwidth)], stdout=subprocess.PIPE, text=True)
+    line = mock.stdout.readline()
+    if not line.startswith('listening on '):
+        mock.kill()
+        raise RuntimeError(f'Mock api did not start: {line}')
+    return (mock, line.split()[-1])
+
+def get_job_env(api_url):
+    env = dict(os.environ)
+    for cache_env in CACHE_ENVS:
+        env.pop(cache_env, None)
+    env['COMPARATIVE_SYSTEMS_API_URL'] = api_url
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(REPO_DIR, 'lib')] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    # the mock api accepts any token
+    env.setdefault('KB_AUTH_TOKEN', 'un=benchmark|tokenid=benchmark|expiry=0|sig=benchmark')
+    return env
+
+# Runs compare_systems on the first n_genomes synthetic genomes and returns its measurements
+def run_job(n_genomes, job_dir, env, parallel=None):
+    shutil.rmtree(job_dir, ignore_errors=True)
+    os.makedirs(job_dir)
+    job_file = os.path.join(job_dir, 'job.json')
+    with open(job_file, 'w') as o:
+        json.dump({'output_file': 'benchmark', 'genome_ids': get_genome_ids(n_genomes), 'genome_groups': []}, o)
+    output_dir = os.path.join(job_dir, 'output')
+    command = [sys.executable, os.path.join(REPO_DIR, 'scripts', 'compare_systems.py'), '--jfile', job_file, '-o', output_dir]
+    if parallel is not None:
+        command += ['--parallel', str(parallel)]
+    start_time = time.time()
+    with open(os.path.join(job_dir, 'job.log'), 'w') as log:
+        returncode = subprocess.call(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wall_seconds = time.time() - start_time
+    telemetry_file = os.path.join(output_dir, 'telemetry.json')
+    if returncode != 0 or not os.path.exists(telemetry_file):
+        raise RuntimeError(f'Job of {n_genomes} genomes failed, see {os.path.join(job_dir, "job.log")}')
+    with open(telemetry_file) as i:
+        telemetry = json.load(i)
+    # kept with the job for scripts/calibrate_estimate.py
+    shutil.copy(telemetry_file, job_dir)
+    stages = telemetry['stages']
+    failed = [name for name, stage in stages.items() if stage.get('status') != 'success']
+    if len(failed) > 0:
+        raise RuntimeError(f'Job of {n_genomes} genomes had failed stages: {",".join(failed)}')
+    return {
+        'genomes': n_genomes,
+        'wall_seconds': wall_seconds,
+        # the pool workers run the cpu stages in processes of their own
+        'peak_rss_mb': max([telemetry['peak_rss_mb']] + [stage['peak_rss_mb'] for stage in stages.values()]),
+        'requests': sum(stage['requests'] for stage in stages.values()),
+        'wire_bytes': sum(stage['wire_bytes'] for stage in stages.values()),
+        'stages': {name: {key: stage[key] for key in ['kind', 'wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'rows']} for name, stage in stages.items()}
+    }
+
+def print_result(result):
+    print(f"{result['genomes']} genomes: {result['wall_seconds']:.1f}s, peak memory {result['peak_rss_mb']:.0f} MB, "
+        f"{result['requests']} requests, {result['wire_bytes']/1024**2:.1f} MB downloaded")
+    for name, stage in sorted(result['stages'].items(), key=lambda item: item[1]['wall_seconds'], reverse=True):
+        print(f"    {name:<24}{stage['kind']:<5}{stage['wall_seconds']:>9.2f}s{stage['cpu_seconds']:>9.2f}s cpu{stage['peak_rss_mb']:>8.0f} MB{stage['rows']:>12} rows")
+
+# Returns the measurements of results that are worse than those of the baseline by more than
+# tolerance (a fraction) and min_seconds or min_mb, as readable lines
+def find_regressions(results, baseline, tolerance, min_seconds=1.0, min_mb=50):
+    regressions = []
+    for size, result in results.items():
+        if size not in baseline:
+            continue
+        base = baseline[size]
+        measures = [('job', 'wall_seconds', result['wall_seconds'], base['wall_seconds'], min_seconds),
+            ('job', 'peak_rss_mb', result['peak_rss_mb'], base['peak_rss_mb'], min_mb)]
+        for name, stage in result['stages'].items():
+            if name in base['stages']:
+                measures.append((name, 'wall_seconds', stage['wall_seconds'], base['stages'][name]['wall_seconds'], min_seconds))
+                measures.append((name, 'peak_rss_mb', stage['peak_rss_mb'], base['stages'][name]['peak_rss_mb'], min_mb))
+        for name, measure, value, base_value, min_change in measures:
+            if value > base_value * (1 + tolerance) and value - base_value > min_change:
+                regressions.append(f'{size} genomes {name} {measure}: {base_value:.1f} -> {value:.1f}')
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks compare_systems against a local mock of the BV-BRC data API')
+    parser.add_argument('--sizes', help=f'comma separated genome counts of the jobs (default {DEFAULT_SIZES})', required=False, default=DEFAULT_SIZES)
+    parser.add_argument('--cds', type=int, help=f'mean CDS count of a synthetic genome (default {DEFAULT_CDS})', required=False, default=DEFAULT_CDS)
+    parser.add_argument('-o', help='directory of the jobs and results. Defaults to bench_output.', required=False, default='bench_output')
+    parser.add_argument('--parallel', type=int, help='number of worker processes of the jobs', required=False, default=None)
+    parser.add_argument('--latency', type=float, help='seconds the mock api adds to every response', required=False, default=0.0)
+    parser.add_argument('--bandwidth', type=float, help='bytes per second the mock api is throttled to, unlimited when 0', required=False, default=0.0)
+    parser.add_argument('--baseline', help=f'{RESULTS_FILE} of an earlier run to compare with, exits with 1 on regressions', required=False, default=None)
+    parser.add_argument('--tolerance', type=float, help='fraction a measurement may exceed the baseline by (default 0.25)', required=False, default=0.25)
+    parser.add_argument('--keep', action='store_true', help='keep the job outputs', required=False, default=False)
+    map_args = parser.parse_args()
+
+    sizes = [int(size) for size in map_args.sizes.split(',')]
+    os.makedirs(map_args.o, exist_ok=True)
+    mock, api_url = start_mock_api(map_args.cds, map_args.latency, map_args.bandwidth)
+    print(f'mock api at {api_url}, {map_args.cds} CDS per genome')
+    results = {}
+    try:
+        env = get_job_env(api_url)
+        for n_genomes in sizes:
+            job_dir = os.path.join(map_args.o, f'genomes_{n_genomes}')
+            results[str(n_genomes)] = run_job(n_genomes, job_dir, env, map_args.parallel)
+            print_result(results[str(n_genomes)])
+            if not map_args.keep:
+                shutil.rmtree(os.path.join(job_dir, 'output'), ignore_errors=True)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    results_file = os.path.join(map_args.o, RESULTS_FILE)
+    with open(results_file, 'w') as o:
+        json.dump({'cds': map_args.cds, 'latency': map_args.latency, 'bandwidth': map_args.bandwidth, 'results': results}, o, indent=1)
+    print(f'results written to {results_file}')
+
+    if map_args.baseline is not None:
+        with open(map_args.baseline) as i:
+            baseline = json.load(i)
+        if baseline['cds'] != map_args.cds:
+            sys.stderr.write(f"Baseline was run with {baseline['cds']} CDS per genome, not comparable\n")
+            sys.exit(2)
+        regressions = find_regressions(results, baseline['results'], map_args.tolerance)
+        for regression in regressions:
+            sys.stderr.write(f'Regression: {regression}\n')
+        if len(regressions) > 0:
+            sys.exit(1)
+        print(f'No regressions against {map_args.baseline}')
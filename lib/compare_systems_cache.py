@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# Environment variables used to configure the per-genome API cache
+CACHE_DIR_ENV = 'COMPARATIVE_SYSTEMS_CACHE_DIR'
+CACHE_SIZE_ENV = 'COMPARATIVE_SYSTEMS_CACHE_SIZE'
+CACHE_MAX_AGE_ENV = 'COMPARATIVE_SYSTEMS_CACHE_MAX_AGE'
+DATA_VERSION_ENV = 'COMPARATIVE_SYSTEMS_DATA_VERSION'
+# Environment variables used to configure the whole job result cache
+RESULT_CACHE_DIR_ENV = 'COMPARATIVE_SYSTEMS_RESULT_CACHE_DIR'
+RESULT_CACHE_SIZE_ENV = 'COMPARATIVE_SYSTEMS_RESULT_CACHE_SIZE'
+
+# SQLite file of protein family products shared between jobs
+FAMILY_STORE_ENV = 'COMPARATIVE_SYSTEMS_FAMILY_STORE'
+# Directory of resolved genome groups shared between the preflight and the job
+GROUP_CACHE_DIR_ENV = 'COMPARATIVE_SYSTEMS_GROUP_CACHE_DIR'
+GROUP_CACHE_MAX_AGE_ENV = 'COMPARATIVE_SYSTEMS_GROUP_CACHE_MAX_AGE'
+
+DEFAULT_CACHE_SIZE = 50 * 1024**3
+DEFAULT_CACHE_MAX_AGE = 30 * 24 * 3600
+DEFAULT_RESULT_CACHE_SIZE = 20 * 1024**3
+DEFAULT_GROUP_CACHE_MAX_AGE = 3600
+
+# Parses sizes such as '500M' or '50G' into a number of bytes
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+class GenomeDataCache:
+    '''
+    On-disk cache of BV-BRC API rows, one entry per (namespace, genome_id) and user.
+    Private genomes are only visible to their owner, so entries are kept apart by the
+    authorization of the session that fetched them.
+    Entries are gzipped json files written atomically, so several jobs and worker
+    processes can share one cache directory. Reading an entry refreshes its
+    modification time, which is used as the LRU clock by evict().
+    An entry is stale when it is older than max_age seconds or was written under a
+    different data version.
+    '''
+
+    def __init__(self, cache_dir, max_size=DEFAULT_CACHE_SIZE, max_age=DEFAULT_CACHE_MAX_AGE, version=''):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+        if not cache_dir:
+            return None
+        max_size = parse_size(os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE))
+        max_age = int(os.environ.get(CACHE_MAX_AGE_ENV, DEFAULT_CACHE_MAX_AGE))
+        version = os.environ.get(DATA_VERSION_ENV, '')
+        return cls(cache_dir, max_size=max_size, max_age=max_age, version=version)
+
+    def _entry_path(self, namespace, genome_id, authorization):
+        user_key = hashlib.sha1(authorization.encode()).hexdigest()
+        return os.path.join(self.cache_dir, user_key, namespace, genome_id + '.json.gz')
+
+    def get(self, namespace, genome_id, authorization):
+        entry_file = self._entry_path(namespace, genome_id, authorization)
+        try:
+            with gzip.open(entry_file, 'rt') as i:
+                entry = json.load(i)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if entry.get('version') != self.version or time.time() - entry.get('created', 0) > self.max_age:
+            self.misses += 1
+            return None
+        try:
+            os.utime(entry_file)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry['rows']
+
+    def put(self, namespace, genome_id, authorization, rows):
+        entry_file = self._entry_path(namespace, genome_id, authorization)
+        os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+        tmp_file = f'{entry_file}.{os.getpid()}.tmp'
+        entry = {'version': self.version, 'created': time.time(), 'rows': rows}
+        try:
+            with gzip.open(tmp_file, 'wt') as o:
+                json.dump(entry, o)
+            os.replace(tmp_file, entry_file)
+        except OSError as e:
+            sys.stderr.write(f'Error writing cache entry {entry_file}:\n{e}\n')
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def evict(self):
+        # remove least recently used entries until the cache fits in max_size
+        entries = []
+        total_size = 0
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                entry_file = os.path.join(root, f)
+                try:
+                    st = os.stat(entry_file)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry_file))
+                total_size += st.st_size
+        entries.sort()
+        removed = 0
+        for mtime, size, entry_file in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(entry_file)
+            except OSError:
+                continue
+            total_size -= size
+            removed += 1
+        if removed > 0:
+            print(f'Evicted {removed} entries from cache {self.cache_dir}')
+        return removed
+
+# Returns the rows for a chunk of genome ids, reading cached genomes from cache and
+# fetching only the missing ones with fetch_fn(genome_ids).
+# authorization: Authorization header of the session fetch_fn queries with
+# genome_key(row) returns the genome id of a fetched row
+# sort_key(row) returns the key the query sorts its rows by: when rows were read from the
+# cache, all rows are sorted by it so the chunk has the order of a single response
+def get_cached_chunk(cache, namespace, authorization, gids, fetch_fn, genome_key, sort_key):
+    if cache is None:
+        return fetch_fn(gids)
+    rows = []
+    missing_gids = []
+    for gid in gids:
+        cached_rows = cache.get(namespace, gid, authorization)
+        if cached_rows is None:
+            missing_gids.append(gid)
+        else:
+            rows.extend(cached_rows)
+    if len(missing_gids) > 0:
+        fetched_rows = fetch_fn(missing_gids)
+        genome_rows = {gid: [] for gid in missing_gids}
+        for row in fetched_rows:
+            genome_rows.setdefault(genome_key(row), []).append(row)
+        for gid in missing_gids:
+            cache.put(namespace, gid, authorization, genome_rows[gid])
+        if len(missing_gids) == len(gids):
+            return fetched_rows
+        rows.extend(fetched_rows)
+    rows.sort(key=sort_key)
+    return rows
+
+class GenomeGroupCache:
+    '''
+    Short-lived on-disk cache of the genome ids of genome groups, so the preflight and the
+    job it sizes resolve a group once and see the same genomes. Groups are private to their
+    owner, an entry is keyed by the group path and the authorization of the session that
+    resolved it. Entries are json files written atomically and expire after max_age seconds.
+    '''
+
+    def __init__(self, cache_dir, max_age=DEFAULT_GROUP_CACHE_MAX_AGE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        cache_dir = os.environ.get(GROUP_CACHE_DIR_ENV)
+        if not cache_dir:
+            return None
+        max_age = int(os.environ.get(GROUP_CACHE_MAX_AGE_ENV, DEFAULT_GROUP_CACHE_MAX_AGE))
+        return cls(cache_dir, max_age=max_age)
+
+    def _entry_path(self, genome_group, authorization):
+        key = hashlib.sha1(f'{authorization}\n{genome_group}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, genome_group, authorization):
+        try:
+            with open(self._entry_path(genome_group, authorization)) as i:
+                entry = json.load(i)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if time.time() - entry.get('created', 0) > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['genome_ids']
+
+    def put(self, genome_group, authorization, genome_ids):
+        entry_file = self._entry_path(genome_group, authorization)
+        tmp_file = f'{entry_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_file, 'w') as o:
+                json.dump({'created': time.time(), 'genome_ids': genome_ids}, o)
+            os.replace(tmp_file, entry_file)
+        except OSError as e:
+            sys.stderr.write(f'Error writing genome group cache entry {entry_file}:\n{e}\n')
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    # Removes the expired entries
+    def evict(self):
+        removed = 0
+        for f in os.listdir(self.cache_dir):
+            entry_file = os.path.join(self.cache_dir, f)
+            try:
+                if time.time() - os.stat(entry_file).st_mtime > self.max_age:
+                    os.remove(entry_file)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+class JobResultCache:
+    '''
+    On-disk cache of the output files of whole jobs, one directory per job key.
+    An entry is written to a temporary directory and renamed into place, so concurrent
+    jobs never see a partial entry. Reading an entry refreshes the modification time of
+    its entry.json, which is used as the LRU clock by evict(). Entries older than max_age
+    seconds or written under a different data version are ignored.
+    Output files are named after the output_file of the job that produced them, a hit
+    for another output_file renames them and the job_name of the json tables.
+    '''
+
+    def __init__(self, cache_dir, max_size=DEFAULT_RESULT_CACHE_SIZE, max_age=DEFAULT_CACHE_MAX_AGE, version=''):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.version = version
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        cache_dir = os.environ.get(RESULT_CACHE_DIR_ENV)
+        if not cache_dir:
+            return None
+        max_size = parse_size(os.environ.get(RESULT_CACHE_SIZE_ENV, DEFAULT_RESULT_CACHE_SIZE))
+        max_age = int(os.environ.get(CACHE_MAX_AGE_ENV, DEFAULT_CACHE_MAX_AGE))
+        version = os.environ.get(DATA_VERSION_ENV, '')
+        return cls(cache_dir, max_size=max_size, max_age=max_age, version=version)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    # Places the cached outputs of key in output_dir, named after output_file.
+    # Returns the list of files placed, None on a miss
+    def get(self, key, output_dir, output_file):
+        entry_dir = self._entry_dir(key)
+        entry_file = os.path.join(entry_dir, 'entry.json')
+        try:
+            with open(entry_file) as i:
+                entry = json.load(i)
+        except (OSError, ValueError):
+            return None
+        if entry.get('version') != self.version or time.time() - entry.get('created', 0) > self.max_age:
+            return None
+        try:
+            os.utime(entry_file)
+        except OSError:
+            pass
+        cached_prefix = entry['output_file'] + '_'
+        placed_files = []
+        for f in entry['files']:
+            out_name = output_file + '_' + f[len(cached_prefix):] if f.startswith(cached_prefix) else f
+            cached_path = os.path.join(entry_dir, f)
+            out_path = os.path.join(output_dir, out_name)
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            if entry['output_file'] != output_file and f.endswith('.json'):
+                # job_name is the only place output_file appears in the tables
+                with open(cached_path) as i:
+                    text = i.read()
+                old_name = '"job_name": ' + json.dumps(entry['output_file'])
+                new_name = '"job_name": ' + json.dumps(output_file)
+                with open(out_path, 'w') as o:
+                    o.write(text.replace(old_name, new_name, 1))
+            else:
+                # copied rather than linked, a later job writing to output_dir must not change the entry
+                shutil.copyfile(cached_path, out_path)
+            placed_files.append(out_name)
+        return placed_files
+
+    def put(self, key, output_dir, output_file, files):
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            for f in files:
+                shutil.copyfile(os.path.join(output_dir, f), os.path.join(tmp_dir, f))
+            with open(os.path.join(tmp_dir, 'entry.json'), 'w') as o:
+                json.dump({'version': self.version, 'created': time.time(), 'output_file': output_file, 'files': files}, o)
+            entry_dir = self._entry_dir(key)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except OSError as e:
+            sys.stderr.write(f'Error writing result cache entry {key}:\n{e}\n')
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def evict(self):
+        # remove least recently used entries until the cache fits in max_size
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if key.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            size = 0
+            for f in os.listdir(entry_dir):
+                try:
+                    size += os.stat(os.path.join(entry_dir, f)).st_size
+                except OSError:
+                    pass
+            try:
+                mtime = os.stat(os.path.join(entry_dir, 'entry.json')).st_mtime
+            except OSError:
+                mtime = 0
+            entries.append((mtime, size, entry_dir))
+            total_size += size
+        entries.sort()
+        removed = 0
+        for mtime, size, entry_dir in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+            removed += 1
+        if removed > 0:
+            print(f'Evicted {removed} jobs from result cache {self.cache_dir}')
+        return removed
+
+class FamilyProductStore:
+    '''
+    SQLite index of protein_family_ref family_id -> family_product, consulted before the
+    API so that only families missing from the store are queried.
+    Families the API does not know are stored with a null product so they are not queried
+    again. Rows older than max_age seconds or written under a different data version are
+    treated as missing and rewritten by the job that queries them again, or all at once
+    by a bulk refresh. The connection belongs to the thread that opened the store.
+    '''
+
+    # maximum number of ? parameters per statement on older sqlite builds
+    BATCH_SIZE = 900
+
+    def __init__(self, db_file, max_age=DEFAULT_CACHE_MAX_AGE, version=''):
+        self.db_file = os.path.abspath(db_file)
+        self.max_age = max_age
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        self.connection = sqlite3.connect(self.db_file, timeout=300)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS family_product (family_id TEXT PRIMARY KEY, family_product TEXT, version TEXT, created REAL) WITHOUT ROWID')
+
+    @classmethod
+    def from_env(cls, db_file=None):
+        db_file = db_file or os.environ.get(FAMILY_STORE_ENV)
+        if not db_file:
+            return None
+        max_age = int(os.environ.get(CACHE_MAX_AGE_ENV, DEFAULT_CACHE_MAX_AGE))
+        version = os.environ.get(DATA_VERSION_ENV, '')
+        return cls(db_file, max_age=max_age, version=version)
+
+    # Returns (products, missing): the stored product of each known family, None for
+    # families the API does not know, and the family ids that have to be queried
+    def get(self, family_ids):
+        products = {}
+        oldest = time.time() - self.max_age
+        for pos in range(0, len(family_ids), self.BATCH_SIZE):
+            batch = family_ids[pos:pos + self.BATCH_SIZE]
+            rows = self.connection.execute(
+                f'SELECT family_id, family_product FROM family_product WHERE family_id IN ({",".join("?" * len(batch))}) AND version = ? AND created >= ?',
+                batch + [self.version, oldest])
+            products.update(rows)
+        missing = [family_id for family_id in family_ids if family_id not in products]
+        self.hits += len(products)
+        self.misses += len(missing)
+        return (products, missing)
+
+    # Stores the products of the queried family ids, ids without a product are stored as unknown
+    def put(self, family_ids, products):
+        created = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO family_product (family_id, family_product, version, created) VALUES (?, ?, ?, ?)',
+                ((family_id, products.get(family_id), self.version, created) for family_id in family_ids))
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM family_product').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
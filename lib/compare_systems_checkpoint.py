@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+
+CHECKPOINT_DIR_NAME = '.checkpoint'
+
+class JobCheckpoint:
+    '''
+    Completed chunks of a job saved under its output directory, so that a failed job rerun
+    in resume mode only redoes the chunks it had not finished.
+    Entries are pickled per (namespace, chunk key) and written atomically. Each job key has
+    a directory of its own, so the shards of a job and the merge can share an output
+    directory: starting a job without resume discards the previous entries of its key only.
+    '''
+
+    def __init__(self, output_dir, job_key, resume=False):
+        self.checkpoint_dir = os.path.join(os.path.abspath(output_dir), CHECKPOINT_DIR_NAME, hashlib.sha1(job_key.encode()).hexdigest())
+        self.job_key = job_key
+        self.loaded = 0
+        self.saved = 0
+        manifest_file = os.path.join(self.checkpoint_dir, 'manifest.json')
+        previous_key = None
+        try:
+            with open(manifest_file) as i:
+                previous_key = json.load(i).get('job_key')
+        except (OSError, ValueError):
+            pass
+        if resume and previous_key == job_key:
+            print(f'Resuming from checkpoint {self.checkpoint_dir}')
+        else:
+            if resume:
+                print(f'No checkpoint of this job in {self.checkpoint_dir}, starting from scratch')
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            with open(manifest_file, 'w') as o:
+                json.dump({'job_key': job_key}, o)
+
+    def _entry_path(self, namespace, chunk_key):
+        return os.path.join(self.checkpoint_dir, namespace, hashlib.sha1(chunk_key.encode()).hexdigest() + '.pkl')
+
+    def load(self, namespace, chunk_key):
+        try:
+            with open(self._entry_path(namespace, chunk_key), 'rb') as i:
+                value = pickle.load(i)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        self.loaded += 1
+        return value
+
+    def save(self, namespace, chunk_key, value):
+        entry_file = self._entry_path(namespace, chunk_key)
+        os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+        tmp_file = f'{entry_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'wb') as o:
+                pickle.dump(value, o, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, entry_file)
+            self.saved += 1
+        except OSError as e:
+            sys.stderr.write(f'Error writing checkpoint {entry_file}:\n{e}\n')
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def remove(self):
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        # the checkpoints of other jobs in the output directory are kept
+        try:
+            os.rmdir(os.path.dirname(self.checkpoint_dir))
+        except OSError:
+            pass
+
+# Returns the result of fetch_fn(ids) for a chunk of ids, loading it from the checkpoint
+# when a previous run completed the chunk and saving it otherwise
+def get_checkpointed_chunk(checkpoint, namespace, ids, fetch_fn):
+    if checkpoint is None:
+        return fetch_fn(ids)
+    chunk_key = ','.join(ids)
+    value = checkpoint.load(namespace, chunk_key)
+    if value is None:
+        value = fetch_fn(ids)
+        checkpoint.save(namespace, chunk_key, value)
+    return value
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import time
+
+from compare_systems_fetch import DEFAULT_FETCH_WORKERS, fetch_chunks, get_thread_transfer_bytes
+
+# Genome queries are planned over units: consecutive blocks of a fixed number of genomes of
+# the job. A query chunk is several whole units or, when one unit is too large, a piece of a
+# unit. Rows are checkpointed and ordered per unit, so the outputs and the checkpoint do
+# not depend on how the units were grouped into queries.
+
+# Uncompressed size and duration a query response is planned toward
+CHUNK_BYTES_ENV = 'COMPARATIVE_SYSTEMS_CHUNK_BYTES'
+CHUNK_SECONDS_ENV = 'COMPARATIVE_SYSTEMS_CHUNK_SECONDS'
+DEFAULT_CHUNK_BYTES = 32 * 1024**2
+DEFAULT_CHUNK_SECONDS = 60
+# Keeps the genome id list of a query short
+MAX_CHUNK_GENOMES = 500
+# Size estimate of a genome without a CDS count
+DEFAULT_GENOME_CDS = 4000
+
+# Returns the CDS count of each genome of the genome data, used as its size estimate
+def get_genome_weights(genome_data):
+    if genome_data is None or 'CDS' not in genome_data.columns:
+        return {}
+    weights = {}
+    for genome_id, cds in zip(genome_data['Genome ID'].tolist(), genome_data['CDS'].tolist()):
+        try:
+            cds = float(cds)
+        except (TypeError, ValueError):
+            continue
+        if cds == cds and cds > 0:
+            weights[str(genome_id)] = cds
+    return weights
+
+class ChunkPlanner:
+    '''
+    Groups genome units into query chunks whose estimated response is close to target_bytes.
+    The response size of a genome is its CDS count times the bytes per CDS of the endpoint,
+    which starts from bytes_per_weight and is replaced by the ratio measured on the chunks
+    already fetched. The target shrinks when the measured throughput would make a response
+    take longer than target_seconds. Chunks are planned lazily, so each chunk uses the
+    measurements of the chunks that finished before it was planned.
+    '''
+
+    def __init__(self, weights, bytes_per_weight, target_bytes=DEFAULT_CHUNK_BYTES, target_seconds=DEFAULT_CHUNK_SECONDS, max_genomes=MAX_CHUNK_GENOMES):
+        self.weights = weights
+        self.default_weight = DEFAULT_GENOME_CDS
+        if len(weights) > 0:
+            self.default_weight = sorted(weights.values())[len(weights) // 2]
+        self.bytes_per_weight = bytes_per_weight
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.max_genomes = max_genomes
+        self.lock = threading.Lock()
+        self.observed_weight = 0
+        self.observed_bytes = 0
+        self.observed_seconds = 0
+        self.chunks = 0
+
+    @classmethod
+    def from_env(cls, weights, bytes_per_weight):
+        target_bytes = int(os.environ.get(CHUNK_BYTES_ENV, DEFAULT_CHUNK_BYTES))
+        target_seconds = float(os.environ.get(CHUNK_SECONDS_ENV, DEFAULT_CHUNK_SECONDS))
+        return cls(weights, bytes_per_weight, target_bytes=target_bytes, target_seconds=target_seconds)
+
+    def weight(self, genome_id):
+        return self.weights.get(genome_id, self.default_weight)
+
+    def observe(self, weight, nbytes, seconds):
+        # chunks served without a request, from a cache, say nothing about the endpoint
+        if nbytes == 0:
+            return
+        with self.lock:
+            self.observed_weight += weight
+            self.observed_bytes += nbytes
+            self.observed_seconds += seconds
+
+    def estimate_bytes(self, weight):
+        with self.lock:
+            if self.observed_weight > 0:
+                return weight * self.observed_bytes / self.observed_weight
+        return weight * self.bytes_per_weight
+
+    def get_target_bytes(self):
+        with self.lock:
+            if self.observed_seconds > 0:
+                rate = self.observed_bytes / self.observed_seconds
+                return max(self.target_bytes / 16, min(self.target_bytes, rate * self.target_seconds))
+        return self.target_bytes
+
+    # Yields chunks of the units, lists of (unit index, genome ids) pairs
+    def plan(self, units):
+        chunk = []
+        chunk_weight = 0
+        chunk_genomes = 0
+        for unit_index, unit_ids in units:
+            unit_weight = sum(self.weight(gid) for gid in unit_ids)
+            target_bytes = self.get_target_bytes()
+            if len(unit_ids) > 1 and self.estimate_bytes(unit_weight) > target_bytes:
+                # a unit of large genomes is split into pieces
+                if len(chunk) > 0:
+                    yield chunk
+                    chunk, chunk_weight, chunk_genomes = [], 0, 0
+                piece = []
+                piece_weight = 0
+                for gid in unit_ids:
+                    if len(piece) > 0 and self.estimate_bytes(piece_weight + self.weight(gid)) > target_bytes:
+                        yield [(unit_index, piece)]
+                        piece, piece_weight = [], 0
+                    piece.append(gid)
+                    piece_weight += self.weight(gid)
+                yield [(unit_index, piece)]
+                continue
+            if len(chunk) > 0 and (self.estimate_bytes(chunk_weight + unit_weight) > target_bytes or chunk_genomes + len(unit_ids) > self.max_genomes):
+                yield chunk
+                chunk, chunk_weight, chunk_genomes = [], 0, 0
+            chunk.append((unit_index, unit_ids))
+            chunk_weight += unit_weight
+            chunk_genomes += len(unit_ids)
+        if len(chunk) > 0:
+            yield chunk
+
+    # Calls fetch_fn on the genome ids of a chunk and measures the response
+    def fetch(self, fetch_fn, chunk):
+        gids = [gid for unit_index, unit_ids in chunk for gid in unit_ids]
+        start_bytes = get_thread_transfer_bytes()
+        start_time = time.time()
+        rows = fetch_fn(gids)
+        self.observe(sum(self.weight(gid) for gid in gids), get_thread_transfer_bytes() - start_bytes, time.time() - start_time)
+        with self.lock:
+            self.chunks += 1
+        return rows
+
+# Fetches the rows of genome_ids unit by unit and yields (unit genome ids, rows) in unit order
+# fetch_fn(gids): rows of a list of genomes
+# split_fn(rows, unit_of_genome): the rows of a chunk as a dict of rows per unit index
+# order_fn(pieces): the rows of a unit from the rows of the chunks it was fetched in
+# Units found in the checkpoint under namespace are not fetched, fetched units are saved
+def fetch_genome_units(genome_ids, unit_size, planner, fetch_fn, split_fn, order_fn, checkpoint=None, namespace=None, max_workers=DEFAULT_FETCH_WORKERS):
+    units = [genome_ids[pos:pos + unit_size] for pos in range(0, len(genome_ids), unit_size)]
+    unit_rows = {}
+    if checkpoint is not None:
+        for unit_index, unit_ids in enumerate(units):
+            rows = checkpoint.load(namespace, ','.join(unit_ids))
+            if rows is not None:
+                unit_rows[unit_index] = rows
+    missing_units = [(unit_index, unit_ids) for unit_index, unit_ids in enumerate(units) if unit_index not in unit_rows]
+    remaining_genomes = {unit_index: len(unit_ids) for unit_index, unit_ids in missing_units}
+    unit_of_genome = {gid: unit_index for unit_index, unit_ids in missing_units for gid in unit_ids}
+    unit_pieces = {}
+    next_unit = 0
+    fetch_chunk = lambda chunk: (chunk, planner.fetch(fetch_fn, chunk))
+    for chunk, rows in fetch_chunks(fetch_chunk, planner.plan(missing_units), max_workers):
+        for unit_index, rows_of_unit in split_fn(rows, unit_of_genome).items():
+            unit_pieces.setdefault(unit_index, []).append(rows_of_unit)
+        for unit_index, unit_ids in chunk:
+            remaining_genomes[unit_index] -= len(unit_ids)
+            if remaining_genomes[unit_index] == 0:
+                rows_of_unit = order_fn(unit_pieces.pop(unit_index, []))
+                if checkpoint is not None:
+                    checkpoint.save(namespace, ','.join(units[unit_index]), rows_of_unit)
+                unit_rows[unit_index] = rows_of_unit
+        while next_unit in unit_rows:
+            yield (units[next_unit], unit_rows.pop(next_unit))
+            next_unit += 1
+    while next_unit in unit_rows:
+        yield (units[next_unit], unit_rows.pop(next_unit))
+        next_unit += 1
+
+# Splits rows held in a list by unit, genome_key(row) is the genome id of a row
+def split_rows(rows, unit_of_genome, genome_key):
+    unit_rows = {}
+    for row in rows:
+        unit_rows.setdefault(unit_of_genome[genome_key(row)], []).append(row)
+    return unit_rows
+
+# Joins the pieces of a unit held in lists. A unit fetched in one query keeps the order of
+# the response, the pieces of a split unit are sorted by sort_key like a single response
+def merge_rows(pieces, sort_key=None):
+    rows = [row for piece in pieces for row in piece]
+    if len(pieces) > 1 and sort_key is not None:
+        rows.sort(key=sort_key)
+    return rows
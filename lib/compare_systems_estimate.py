@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+import json
+import math
+import os
+
+from compare_systems_chunks import DEFAULT_GENOME_CDS, MAX_CHUNK_GENOMES
+from compare_systems_fetch import create_api_session, fetch_chunks, get_fetch_workers, query_api_records
+
+# Resources of a job are predicted from the size of its genomes: the CDS count of every
+# genome and the subsystem and pathway records of a sample of them. Each system, and the
+# features query every system reads, has a linear model of its runtime and peak memory in
+# the count it grows with. The models are fitted on the telemetry.json of earlier jobs; until
+# a model is configured, the runtime comes from the genome count ladder the app used before
+# and the memory from the CDS count.
+
+ESTIMATE_FILE = 'estimate.json'
+# Model file written by calibrate_estimate, the genome count ladder is used when unset
+ESTIMATE_MODEL_ENV = 'COMPARATIVE_SYSTEMS_ESTIMATE_MODEL'
+# Genomes whose subsystem and pathway records are counted
+SAMPLE_GENOMES = 10
+# Records per CDS assumed when the sample has no CDS counts
+DEFAULT_RECORDS_PER_CDS = {'subsystem': 0.3, 'pathway': 0.15}
+# The estimate is raised by these factors to cover the variance of the api
+RUNTIME_MARGIN = 1.5
+MEMORY_MARGIN = 1.25
+MIN_RUNTIME = 1800
+MIN_MEMORY_GB = 2
+# Runtime by genome count without a model: the first (genome count, seconds) step the job is
+# below, the last runtime above them
+RUNTIME_LADDER = [(10, 1800), (100, 3 * 3600), (300, 6 * 3600), (None, 43200)]
+# Memory without a model grows with the CDS count up to the 32GB the ladder gave every job,
+# reached by the 500 genomes of average size the service compares at most
+LADDER_MAX_MEMORY_GB = 32
+LADDER_MAX_MEMORY_CDS = 500 * DEFAULT_GENOME_CDS
+LADDER_MIN_MEMORY_GB = 4
+
+# The count the runtime and memory of each system grow with
+SYSTEM_WEIGHTS = {'FEATURES': 'cds', 'PATHWAYS': 'pathway_records', 'SUBSYSTEMS': 'subsystem_records', 'FAMILIES': 'cds'}
+# Stages of each system, by the first part of the stage name
+STAGE_SYSTEMS = {
+    'genome_data': 'FEATURES', 'features': 'FEATURES',
+    'pathways': 'PATHWAYS', 'PATHWAYS': 'PATHWAYS',
+    'subsystems': 'SUBSYSTEMS', 'SUBSYSTEMS': 'SUBSYSTEMS',
+    'families': 'FAMILIES', 'FAMILIES': 'FAMILIES'
+}
+# Stage and counter measuring each weight in the telemetry of a job
+WEIGHT_STAGES = {'cds': ('genome_data', 'cds'), 'pathway_records': ('pathways.fetch', 'rows'), 'subsystem_records': ('subsystems.fetch', 'rows')}
+
+# Returns the model of the environment, None when none is configured. A model has the
+# intercept and slope per unit of weight of the runtime in seconds and of the peak memory
+# in MB of each system it was fitted for
+def load_estimate_model(model_file=None):
+    model_file = model_file or os.environ.get(ESTIMATE_MODEL_ENV)
+    if not model_file:
+        return None
+    with open(model_file) as i:
+        return json.load(i)
+
+# Returns True when the model predicts every system of the recipe
+def covers_recipe(model, recipe):
+    return model is not None and all(system in model for system in ['FEATURES'] + recipe)
+
+# Returns the CDS count of each genome from the genome endpoint
+def fetch_genome_cds(genome_ids, api_session, fetch_workers):
+    def fetch_cds_chunk(gids):
+        query = f"in(genome_id,({','.join(gids)}))&select(genome_id,cds)&limit(2500000)"
+        return list(query_api_records(api_session,'genome',query,print_query=False))
+    chunks = [genome_ids[pos:pos + MAX_CHUNK_GENOMES] for pos in range(0, len(genome_ids), MAX_CHUNK_GENOMES)]
+    genome_cds = {}
+    for records in fetch_chunks(fetch_cds_chunk, chunks, fetch_workers):
+        for record in records:
+            if record.get('cds'):
+                genome_cds[record['genome_id']] = int(record['cds'])
+    return genome_cds
+
+# Counts the records of an endpoint for a few genomes, only their genome ids are downloaded
+def count_genome_records(endpoint, genome_ids, api_session):
+    query = f"in(genome_id,({','.join(genome_ids)}))&select(genome_id)&limit(2500000)"
+    return sum(1 for record in query_api_records(api_session,endpoint,query,print_query=False))
+
+# Returns the weights of a job: its genome and CDS counts and, with sample_records, the subsystem
+# and pathway records estimated from a sample of evenly spaced genomes
+def get_job_stats(genome_ids, session, sample_records=True):
+    fetch_workers = get_fetch_workers()
+    api_session = create_api_session(session, fetch_workers)
+    genome_cds = fetch_genome_cds(genome_ids, api_session, fetch_workers)
+    cds = sum(genome_cds.get(gid, DEFAULT_GENOME_CDS) for gid in genome_ids)
+    step = max(1, len(genome_ids) // SAMPLE_GENOMES)
+    sample_ids = [gid for gid in genome_ids[::step][:SAMPLE_GENOMES] if gid in genome_cds]
+    sample_cds = sum(genome_cds[gid] for gid in sample_ids)
+    stats = {'genomes': len(genome_ids), 'genomes_without_cds': len([gid for gid in genome_ids if gid not in genome_cds]), 'cds': cds}
+    if not sample_records:
+        return stats
+    stats['sampled_genomes'] = len(sample_ids)
+    for endpoint in ['subsystem','pathway']:
+        if sample_cds > 0:
+            records_per_cds = count_genome_records(endpoint, sample_ids, api_session) / sample_cds
+        else:
+            records_per_cds = DEFAULT_RECORDS_PER_CDS[endpoint]
+        stats[f'{endpoint}_records'] = int(cds * records_per_cds)
+    return stats
+
+def predict(line, weight):
+    return line[0] + line[1] * weight
+
+def get_ladder_runtime(n_genomes):
+    for max_genomes, runtime in RUNTIME_LADDER:
+        if max_genomes is None or n_genomes < max_genomes:
+            return runtime
+
+def get_ladder_memory(cds):
+    memory_gb = int(math.ceil(LADDER_MAX_MEMORY_GB * cds / LADDER_MAX_MEMORY_CDS))
+    return f'{min(LADDER_MAX_MEMORY_GB, max(LADDER_MIN_MEMORY_GB, memory_gb))}GB'
+
+# Predicts the runtime and peak memory of each system of the recipe and of the job.
+# Stages of different systems overlap, the job runtime is their sum so it errs long. The pool
+# workers run beside the main process, so the job memory is the sum of their peaks.
+# Without a model of every system, the job gets the runtime of the genome count ladder and
+# memory in proportion to its CDS count.
+# The job asks for a cpu per system aggregation, run in the pool, and one for the main process
+def estimate_resources(stats, recipe, model=None):
+    estimate = {'stats': stats, 'cpu': len(recipe) + 1}
+    if not covers_recipe(model, recipe):
+        estimate.update({'model': 'ladder', 'systems': {}, 'runtime': get_ladder_runtime(stats['genomes']), 'memory': get_ladder_memory(stats['cds'])})
+        return estimate
+    systems = {}
+    for system in ['FEATURES'] + recipe:
+        weight = stats[SYSTEM_WEIGHTS[system]]
+        systems[system] = {
+            'seconds': round(predict(model[system]['seconds'], weight)),
+            'memory_mb': round(predict(model[system]['memory_mb'], weight))
+        }
+    runtime = sum(system_estimate['seconds'] for system_estimate in systems.values()) * RUNTIME_MARGIN
+    memory_mb = sum(system_estimate['memory_mb'] for system_estimate in systems.values()) * MEMORY_MARGIN
+    estimate.update({
+        'model': 'calibrated',
+        'systems': systems,
+        'runtime': max(MIN_RUNTIME, int(math.ceil(runtime / 60) * 60)),
+        'memory': f'{max(MIN_MEMORY_GB, int(math.ceil(memory_mb / 1024)))}GB'
+    })
+    return estimate
+
+# Returns the intercept and slope of the least squares line through the points, neither
+# negative. A single weight gives a line through the origin
+def fit_line(points):
+    n = len(points)
+    mean_x = sum(x for x, y in points) / n
+    mean_y = sum(y for x, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, y in points)
+    if var_x == 0:
+        return [0.0, mean_y / mean_x if mean_x > 0 else 0.0]
+    slope = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x)
+    intercept = mean_y - slope * mean_x
+    if intercept < 0:
+        # through the origin
+        intercept = 0.0
+        slope = sum(x * y for x, y in points) / sum(x * x for x, y in points)
+    return [intercept, slope]
+
+# Fits the model on the telemetry of earlier jobs. Jobs without the features query, resumed
+# from a checkpoint or served from the result cache among them, say nothing about the runtime
+# and are skipped, as are jobs whose telemetry has no CDS count and systems a job did not run.
+# FEATURES memory is the peak of the main process, the memory of a system is the peak of the
+# stage aggregating it in a pool process
+def calibrate_estimate_model(telemetry_jsons):
+    points = {system: {'seconds': [], 'memory_mb': []} for system in SYSTEM_WEIGHTS}
+    for telemetry_json in telemetry_jsons:
+        stages = telemetry_json['stages']
+        if 'features.fetch' not in stages or stages['features.fetch'].get('requests', 0) == 0:
+            continue
+        weights = {weight: stages[stage][counter] for weight, (stage, counter) in WEIGHT_STAGES.items() if counter in stages.get(stage, {})}
+        if 'cds' not in weights:
+            continue
+        system_stages = {}
+        for name, stage in stages.items():
+            system = STAGE_SYSTEMS.get(name.split('.')[0])
+            if system is not None:
+                system_stages.setdefault(system, []).append(stage)
+        for system, stage_list in system_stages.items():
+            weight = weights.get(SYSTEM_WEIGHTS[system])
+            if weight is None:
+                continue
+            points[system]['seconds'].append((weight, sum(stage['wall_seconds'] for stage in stage_list)))
+            if system == 'FEATURES':
+                points[system]['memory_mb'].append((weight, telemetry_json['peak_rss_mb']))
+            else:
+                # peaks of whole processes include the stages run before
+                worker_peaks = [stage['peak_rss_mb'] for stage in stage_list if stage['kind'] == 'cpu' and stage.get('peak_rss_scope') == 'stage']
+                if len(worker_peaks) > 0:
+                    points[system]['memory_mb'].append((weight, max(worker_peaks)))
+    model = {}
+    for system, system_points in points.items():
+        if len(system_points['seconds']) == 0 or len(system_points['memory_mb']) == 0:
+            continue
+        model[system] = {measure: fit_line(measure_points) for measure, measure_points in system_points.items()}
+    return model
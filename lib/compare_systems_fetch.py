@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import codecs
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+from compare_systems_telemetry import record_request, submit_in_stage
+
+# Base url of the BV-BRC data API, a local server can stand in for it
+API_URL_ENV = 'COMPARATIVE_SYSTEMS_API_URL'
+API_BASE_URL = os.environ.get(API_URL_ENV, "https://www.bv-brc.org/api").rstrip('/')
+
+# Maximum number of chunk queries in flight per runner
+FETCH_WORKERS_ENV = 'COMPARATIVE_SYSTEMS_FETCH_WORKERS'
+DEFAULT_FETCH_WORKERS = 4
+
+def get_fetch_workers():
+    return max(1, int(os.environ.get(FETCH_WORKERS_ENV, DEFAULT_FETCH_WORKERS)))
+
+# Requests, bytes received on the wire and bytes after decompression per endpoint,
+# summed over every query of the process
+_transfer_stats = {}
+_transfer_lock = threading.Lock()
+# Decompressed bytes received by the current thread
+_thread_transfer = threading.local()
+
+def record_transfer(endpoint, wire_bytes, content_bytes):
+    with _transfer_lock:
+        stats = _transfer_stats.setdefault(endpoint, {'requests': 0, 'wire_bytes': 0, 'bytes': 0})
+        stats['requests'] += 1
+        stats['wire_bytes'] += wire_bytes
+        stats['bytes'] += content_bytes
+    record_request(wire_bytes, content_bytes)
+    _thread_transfer.bytes = get_thread_transfer_bytes() + content_bytes
+
+def get_thread_transfer_bytes():
+    return getattr(_thread_transfer, 'bytes', 0)
+
+def get_transfer_stats():
+    with _transfer_lock:
+        return {endpoint: dict(stats) for endpoint, stats in _transfer_stats.items()}
+
+def print_transfer_stats():
+    for endpoint, stats in sorted(get_transfer_stats().items()):
+        ratio = stats['bytes'] / stats['wire_bytes'] if stats['wire_bytes'] > 0 else 0
+        print(f"{endpoint}: {stats['requests']} requests, {stats['wire_bytes']/1024**2:.1f} MB transferred, {stats['bytes']/1024**2:.1f} MB uncompressed ({ratio:.1f}x)")
+
+# Creates a session whose connection pool is shared by all fetch threads of a runner
+# session: authenticated session, only its Authorization header is reused
+def create_api_session(session, pool_size=DEFAULT_FETCH_WORKERS):
+    api_session = requests.Session()
+    retries = Retry(total=3, backoff_factor=2, status_forcelist=[502, 503, 504], allowed_methods=None)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+    api_session.mount('https://', adapter)
+    api_session.mount('http://', adapter)
+    # responses are compressed on the wire and decompressed by urllib3 as they are read
+    api_session.headers.update({"content-type": "application/rqlquery+x-www-form-urlencoded", "accept-encoding": ACCEPT_ENCODING})
+    if 'Authorization' in session.headers:
+        api_session.headers['Authorization'] = session.headers['Authorization']
+    return api_session
+
+def get_endpoint_url(endpoint):
+    return f"{API_BASE_URL}/{endpoint}/?http_download=true"
+
+# Yields the decompressed body of a streamed response as text, piece by piece, and records
+# the compressed and uncompressed size of what was read when the caller is done
+def iter_response_text(r, endpoint, chunk_size=1024*1024):
+    decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')(errors='replace')
+    content_bytes = 0
+    try:
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            content_bytes += len(chunk)
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+    finally:
+        # bytes urllib3 read from the socket, before content decoding
+        record_transfer(endpoint, r.raw.tell(), content_bytes)
+
+# Splits text pieces into lines without their line endings
+def iter_text_lines(text_chunks):
+    pending = ''
+    for text in text_chunks:
+        lines = (pending + text).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    if pending:
+        yield pending.rstrip('\r')
+
+# Posts an rql query to an api endpoint and yields the response lines
+def query_api_lines(api_session, endpoint, query, accept="text/tsv", print_query=True):
+    base = get_endpoint_url(endpoint)
+    if print_query:
+        print('Query = {0}&{1}'.format(base,query))
+    with api_session.post(base, data=query, headers={"accept": accept}, stream=True) as r:
+        r.raise_for_status()
+        yield from iter_text_lines(iter_response_text(r, endpoint))
+
+# Incrementally decodes a json array of objects from an iterable of text pieces and
+# yields each object as soon as it is complete, so the full response text is never
+# held in memory
+def iter_json_array(text_chunks):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    started = False
+    finished = False
+    for text in text_chunks:
+        if finished:
+            break
+        buffer = buffer[pos:] + text
+        pos = 0
+        while pos < len(buffer):
+            # skip whitespace and the separators between objects
+            if buffer[pos] in ' \t\r\n,':
+                pos += 1
+                continue
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f'Expected a json array, found: {buffer[pos:pos+100]}')
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                finished = True
+                break
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # object is incomplete, wait for more text
+                break
+            pos = end
+            yield record
+    if not finished:
+        raise ValueError(f'Truncated json array: {buffer[pos:pos+100]}')
+
+# Posts an rql query to an api endpoint and yields the records of the json response
+# as they are read from the socket
+def query_api_records(api_session, endpoint, query, print_query=True):
+    base = get_endpoint_url(endpoint)
+    if print_query:
+        print('Query = {0}&{1}'.format(base,query))
+    with api_session.post(base, data=query, headers={"accept": "application/json"}, stream=True) as r:
+        r.raise_for_status()
+        yield from iter_json_array(iter_response_text(r, endpoint))
+
+# Runs fetch_fn over chunks with at most max_workers calls in flight and yields the
+# results in chunk order. Only a window of max_workers results is held at a time so
+# fetching runs ahead of the consumer without buffering every chunk.
+def fetch_chunks(fetch_fn, chunks, max_workers=DEFAULT_FETCH_WORKERS):
+    chunks = iter(chunks)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(submit_in_stage(executor, fetch_fn, chunk))
+            if len(pending) >= max_workers:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for chunk in chunks:
+                pending.append(submit_in_stage(executor, fetch_fn, chunk))
+                break
+            yield result
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
 import copy
+import glob
 import gzip
+import hashlib
 import json
+import math
 import multiprocessing
 import os
 import re
@@ -10,6 +13,7 @@ import shutil
 import subprocess
 import sys
 import tarfile
+import tempfile
 import urllib.request as request
 from contextlib import closing
 from multiprocessing import Process
@@ -17,8 +21,18 @@ from multiprocessing import Process
 import requests
 import pandas as pd
 import numpy as np
+from pandas.api.types import union_categoricals
 
-from bvbrc_api import authenticateByEnv,getGenomeIdsByGenomeGroup,getFeatureDataFrame,getSubsystemsDataFrame,getPathwayDataFrame,getDataForGenomes,getQueryData,getQueryDataText
+from bvbrc_api import authenticateByEnv,getGenomeIdsByGenomeGroup,getFeatureDataFrame,getSubsystemsDataFrame,getPathwayDataFrame,getQueryData,getQueryDataText
+from compare_systems_cache import DATA_VERSION_ENV, FamilyProductStore, GenomeDataCache, GenomeGroupCache, JobResultCache, get_cached_chunk
+from compare_systems_checkpoint import JobCheckpoint, get_checkpointed_chunk
+from compare_systems_estimate import ESTIMATE_FILE, covers_recipe, estimate_resources, get_job_stats, load_estimate_model
+from compare_systems_chunks import DEFAULT_GENOME_CDS, MAX_CHUNK_GENOMES, ChunkPlanner, fetch_genome_units, get_genome_weights, merge_rows, split_rows
+from compare_systems_table import read_columnar_table, remove_columnar_table, write_columnar_table
+from compare_systems_scheduler import StageScheduler, get_workers
+from compare_systems_shard import SUMMARIES_SUFFIX, concat_columnar_tables, get_shard_genome_ids, parse_shard, read_shard_manifests, read_summaries_manifest, sort_unit_rows, write_shard_manifest
+from compare_systems_fetch import create_api_session, fetch_chunks, get_fetch_workers, print_transfer_stats, query_api_lines, query_api_records
+from compare_systems_telemetry import measure_stage, record_cds, record_rows, summarize_telemetry, write_telemetry
 
 import time
 import io
@@ -75,173 +89,219 @@ def return_columns_to_remove(system,columns):
         sys.stderr.write("Error, system is not a valid type\n")
         return [] 
 
-def run_families(genome_ids, query_dict, output_file, output_dir, genome_data, genome_group_dict, session):
-    print('starting protein families')
-    data_dict = {} 
-    data_dict['plfam'] = {}
-    data_dict['pgfam'] = {}
-    plfam_genomes = {}
-    pgfam_genomes = {}
-    present_genome_ids = set()
-    genomes_missing_data = {}
-    for gids in chunker(genome_ids, 20):
-        base = "https://www.bv-brc.org/api/genome_feature/?http_download=true"
-        query = f"in(genome_id,({','.join(gids)}))&limit(2500000)&sort(+feature_id)&eq(annotation,PATRIC)"
-        headers = {"accept":"text/tsv", "content-type":"application/rqlquery+x-www-form-urlencoded", 'Authorization': session.headers['Authorization']}
-        result_header = True
-        for line in getQueryData(base,query,headers):
-            if result_header:
-                result_header = False
-                print(line)
-                continue
-            line = line.strip().split('\t')
-            # 20 entries in query result with pgfam and plfam data
-            if len(line) < 20: 
-                continue
-            try:
-                genome_id = line[1].replace('\"','')
-                plfam_id = line[14].replace('\"','')
-                pgfam_id = line[15].replace('\"','')
-                aa_length = line[17].replace('\"','')
-                product = line[19].replace('\"','')
-            except Exception as e:
-                sys.stderr.write(f'Error with the following line:\n{e}\n{line}\n')
-                continue
-            if aa_length == '':
-                continue
-            present_genome_ids.add(genome_id)
-            ### add to missing genomes data dict
-            if genome_id not in genomes_missing_data:
-                genomes_missing_data[genome_id] = True
-            ### plfam counts
-            if plfam_id != '':
-                if plfam_id not in data_dict['plfam']:
-                    data_dict['plfam'][plfam_id] = {} 
-                    data_dict['plfam'][plfam_id]['aa_length_list'] = [] 
-                    data_dict['plfam'][plfam_id]['feature_count'] = 0 
-                    data_dict['plfam'][plfam_id]['genome_count'] = 0 
-                    data_dict['plfam'][plfam_id]['product'] = product 
-                if plfam_id not in plfam_genomes:
-                    plfam_genomes[plfam_id] = {} 
-                if genome_id not in plfam_genomes[plfam_id]:
-                    plfam_genomes[plfam_id][genome_id] = 0
-                data_dict['plfam'][plfam_id]['aa_length_list'].append(int(aa_length))
-                data_dict['plfam'][plfam_id]['feature_count']+=1
-                data_dict['plfam'][plfam_id]['genome_count'] = len(plfam_genomes[plfam_id])
-                plfam_genomes[plfam_id][genome_id]+=1
-            ### pgfam counts
-            if pgfam_id != '':
-                if pgfam_id not in data_dict['pgfam']:
-                    data_dict['pgfam'][pgfam_id] = {} 
-                    data_dict['pgfam'][pgfam_id]['aa_length_list'] = [] 
-                    data_dict['pgfam'][pgfam_id]['feature_count'] = 0 
-                    data_dict['pgfam'][pgfam_id]['genome_count'] = 0 
-                    data_dict['pgfam'][pgfam_id]['product'] = product 
-                if pgfam_id not in pgfam_genomes:
-                    pgfam_genomes[pgfam_id] = {} 
-                if genome_id not in pgfam_genomes[pgfam_id]:
-                    pgfam_genomes[pgfam_id][genome_id] = 0
-                data_dict['pgfam'][pgfam_id]['aa_length_list'].append(int(aa_length))
-                data_dict['pgfam'][pgfam_id]['feature_count']+=1
-                data_dict['pgfam'][pgfam_id]['genome_count'] = len(pgfam_genomes[pgfam_id])
-                pgfam_genomes[pgfam_id][genome_id]+=1
+# Feature table columns used by the protein families
+FAMILY_FEATURE_COLUMNS = ['genome_id','annotation','plfam_id','pgfam_id','aa_length']
 
-    # - get protein family description data
-    product_dict = {}
-    for plids_list in chunker(list(data_dict['plfam'].keys()),5000):
-        print(f"plids_list has {len(plids_list)} elements")
-        base = "https://www.bv-brc.org/api/protein_family_ref/?http_download=true"
-        query = f"in(family_id,({','.join(plids_list)}))&limit(2500000)&sort(+family_id)"
-        headers = {"accept":"application/json", "content-type":"application/rqlquery+x-www-form-urlencoded", 'Authorization': session.headers['Authorization']}
-        #headers = {"accept":"text/tsv", "content-type":"application/rqlquery+x-www-form-urlencoded", 'Authorization': session.headers['Authorization']}
-        res_data = getQueryDataText(base,query,headers,print_query=False)
-        text_data = json.loads(res_data)
-        print(f"text_data has {len(text_data)} elements")
-        for entry in text_data:
-            product_dict[entry['family_id']] = entry['family_product']
-        if len(text_data) == 0:
-            print(query)
-    for pgids_list in chunker(list(data_dict['pgfam'].keys()),5000):
-        print(f"pgids_list has {len(pgids_list)} elements")
-        base = "https://www.bv-brc.org/api/protein_family_ref/?http_download=true"
-        query = f"in(family_id,({','.join(pgids_list)}))&limit(2500000)&sort(+family_id)"
-        headers = {"accept":"application/json", "content-type":"application/rqlquery+x-www-form-urlencoded", 'Authorization': session.headers['Authorization']}
-        res_data = getQueryDataText(base,query,headers,print_query=False)
-        text_data = json.loads(res_data)
-        print(f"text_data has {len(text_data)} elements")
-        for entry in text_data:
-            product_dict[entry['family_id']] = entry['family_product']
-        if len(text_data) == 0:
-            print(query)
+# Returns the rows of feature_df that the families count: PATRIC features with a protein length
+def get_family_feature_frame(feature_df):
+    if 'annotation' in feature_df.columns:
+        feature_df = feature_df[feature_df['annotation'] == 'PATRIC']
+    aa_length = pd.to_numeric(feature_df['aa_length'], errors='coerce')
+    keep = aa_length.notna().to_numpy()
+    family_df = pd.DataFrame({
+        'genome_id': feature_df['genome_id'].astype(str).to_numpy()[keep],
+        'plfam_id': feature_df['plfam_id'].astype(object).fillna('').to_numpy()[keep],
+        'pgfam_id': feature_df['pgfam_id'].astype(object).fillna('').to_numpy()[keep],
+        'aa_length': aa_length.to_numpy()[keep].astype(np.int64)})
+    return family_df
+
+# Aggregates one chunk of family feature rows into partial sums per family and genome:
+# feature count, sum and sum of squares of the protein lengths, min and max length.
+# Lengths are integers, so the sums are exact and partials can be merged by addition
+# Returns a dict with a partial table per family type and the set of genome ids with data
+# chunk_df: genome_id, plfam_id, pgfam_id and aa_length of each feature, missing family ids are empty strings
+def aggregate_family_chunk(chunk_df):
+    chunk_df = chunk_df[['genome_id','plfam_id','pgfam_id','aa_length']].copy()
+    chunk_df['aa_length'] = chunk_df['aa_length'].astype(np.int64)
+    chunk_df['aa_length_sq'] = chunk_df['aa_length'] * chunk_df['aa_length']
+    chunk_partials = {'genome_ids': set(chunk_df['genome_id'].unique())}
+    for fam in ['plfam','pgfam']:
+        fam_df = chunk_df[chunk_df[fam+'_id'] != '']
+        partial = fam_df.groupby([fam+'_id','genome_id'], sort=False).agg(
+            feature_count=('aa_length','size'),
+            aa_length_sum=('aa_length','sum'),
+            aa_length_sumsq=('aa_length_sq','sum'),
+            aa_length_min=('aa_length','min'),
+            aa_length_max=('aa_length','max'))
+        chunk_partials[fam] = partial.reset_index().rename(columns={fam+'_id':'family_id'})
+    return chunk_partials
 
-    # go back and get the mean, max, min, std dev for each family_id
-    plfam_line_list = []        
-    pgfam_line_list = []
-    plfam_genome_list = {}
-    pgfam_genome_list = {}
-    genome_str_dict = {}
-    genome_str_dict['plfam'] = {}
-    genome_str_dict['pgfam'] = {}
-    for plfam_id in data_dict['plfam']:
-        if plfam_id == '':
+# Merges partial family tables into per family and genome counts and a table with one row per family:
+# feature_count, genome_count and the protein length min, max, mean and population standard deviation
+# Families keep the order in which they were first seen
+def merge_family_partials(partials):
+    genome_counts = pd.concat(partials, ignore_index=True).groupby(['family_id','genome_id'], sort=False).agg(
+        feature_count=('feature_count','sum'),
+        aa_length_sum=('aa_length_sum','sum'),
+        aa_length_sumsq=('aa_length_sumsq','sum'),
+        aa_length_min=('aa_length_min','min'),
+        aa_length_max=('aa_length_max','max')).reset_index()
+    family_table = genome_counts.groupby('family_id', sort=False).agg(
+        feature_count=('feature_count','sum'),
+        genome_count=('genome_id','size'),
+        aa_length_sum=('aa_length_sum','sum'),
+        aa_length_sumsq=('aa_length_sumsq','sum'),
+        aa_length_min=('aa_length_min','min'),
+        aa_length_max=('aa_length_max','max')).reset_index()
+    family_table['aa_length_mean'] = family_table['aa_length_sum'] / family_table['feature_count']
+    # exact variance from the integer sums, python ints avoid int64 overflow of n*sumsq
+    family_table['aa_length_std'] = [math.sqrt((n * q - t * t) / (n * n)) for n, q, t in zip(family_table['feature_count'].tolist(), family_table['aa_length_sumsq'].tolist(), family_table['aa_length_sum'].tolist())]
+    return (family_table, genome_counts)
+
+# Two ascii hex digits for every count from 0 to 255
+HEX_PAIRS = np.array([list(format(x,'02x').encode()) for x in range(256)], dtype=np.uint8)
+
+# Returns the genome x family count matrix in coordinate form (family codes, genome codes, counts),
+# with family codes following the rows of family_table and genome codes following genome_order
+def get_family_genome_matrix(family_table, genome_counts, genome_order):
+    family_codes = pd.Index(family_table['family_id']).get_indexer(genome_counts['family_id'])
+    genome_codes = pd.Index(genome_order).get_indexer(genome_counts['genome_id'])
+    keep = genome_codes >= 0
+    counts = genome_counts['feature_count'].to_numpy(dtype=np.uint32)
+    return (family_codes[keep].astype(np.int64), genome_codes[keep].astype(np.int64), counts[keep])
+
+# Encodes each family row of the count matrix as two hex digits per genome.
+# Counts above 255 do not fit two digits and are capped at ff.
+# Rows are expanded to a dense uint8 block of block_size families at a time
+def get_genome_strings(family_matrix, n_families, n_genomes, block_size=10000):
+    family_codes, genome_codes, counts = family_matrix
+    if n_genomes == 0:
+        return [''] * n_families
+    order = np.argsort(family_codes, kind='stable')
+    family_codes = family_codes[order]
+    genome_codes = genome_codes[order]
+    counts = np.minimum(counts[order], 255).astype(np.uint8)
+    genome_strs = []
+    for start in range(0, n_families, block_size):
+        end = min(start + block_size, n_families)
+        lo, hi = np.searchsorted(family_codes, [start, end])
+        block = np.zeros((end - start, n_genomes), dtype=np.uint8)
+        block[family_codes[lo:hi] - start, genome_codes[lo:hi]] = counts[lo:hi]
+        encoded = np.ascontiguousarray(HEX_PAIRS[block].reshape(end - start, 2 * n_genomes))
+        genome_strs.extend(x.decode() for x in encoded.view(f'S{2 * n_genomes}').ravel())
+    return genome_strs
+
+# Returns a dict of family_id to the genome ids that have the family, in genome_ids order
+def get_family_genome_lists(family_table, genome_counts, genome_ids):
+    family_ids = family_table['family_id'].tolist()
+    family_codes = pd.Index(family_ids).get_indexer(genome_counts['family_id'])
+    genome_pos = pd.Index(genome_ids).get_indexer(genome_counts['genome_id'])
+    order = np.lexsort((genome_pos, family_codes))
+    sorted_genome_ids = genome_counts['genome_id'].to_numpy()[order]
+    bounds = np.searchsorted(family_codes[order], np.arange(len(family_ids) + 1))
+    return {family_id: sorted_genome_ids[bounds[x]:bounds[x+1]].tolist() for x, family_id in enumerate(family_ids)}
+
+# Writes the plfam and pgfam count matrices in coordinate form to a numpy .npz file
+def write_family_matrices(matrix_file, family_tables, family_matrices, genome_ids):
+    arrays = {'genome_ids': np.array(genome_ids, dtype=str)}
+    for fam in family_matrices:
+        family_codes, genome_codes, counts = family_matrices[fam]
+        arrays[f'{fam}_ids'] = family_tables[fam]['family_id'].to_numpy(dtype=str)
+        arrays[f'{fam}_row'] = family_codes
+        arrays[f'{fam}_col'] = genome_codes
+        arrays[f'{fam}_count'] = counts
+    np.savez_compressed(matrix_file, **arrays)
+
+# Genomes per unit of the subsystem, pathway and family feature queries: units are
+# checkpointed and keep the record order of a query of their genomes
+GENOME_UNIT_SIZE = 20
+# Uncompressed response bytes per CDS the queries are planned with until measured
+FAMILY_FEATURE_BYTES_PER_CDS = 320
+SYSTEM_BYTES_PER_CDS = {
+    'subsystem': 200,
+    'pathway': 100
+}
+
+# Fetches the protein family fields of PATRIC features for a list of genome ids
+# Returns a list of [genome_id, plfam_id, pgfam_id, aa_length, product]
+def fetch_family_features(gids, api_session):
+    feature_rows = []
+    query = f"in(genome_id,({','.join(gids)}))&limit(2500000)&sort(+feature_id)&eq(annotation,PATRIC)"
+    result_header = True
+    for line in query_api_lines(api_session,'genome_feature',query,accept="text/tsv"):
+        if result_header:
+            result_header = False
+            print(line)
             continue
-        aa_length_list = data_dict['plfam'][plfam_id]['aa_length_list']
-        aa_length_max = max(aa_length_list)
-        aa_length_min = min(aa_length_list)
-        aa_length_mean = np.mean(aa_length_list)
-        aa_length_std = np.std(aa_length_list)
-        feature_count = data_dict['plfam'][plfam_id]['feature_count']
-        genome_count = data_dict['plfam'][plfam_id]['genome_count']
-        #genomes = format(feature_count,'#04x').replace('0x','')
-        genomes_dir = {} 
-        plfam_genome_list[plfam_id] = []
-        for gid in genome_ids:
-            if gid in plfam_genomes[plfam_id]:
-                genomes_dir[gid] = format(plfam_genomes[plfam_id][gid],'#04x').replace('0x','')
-                plfam_genome_list[plfam_id].append(gid)
-            else:
-                genomes_dir[gid] = '00'
-        #genomes = ''.join(genomes_list)
-        genome_str_dict['plfam'][plfam_id] = genomes_dir 
-        #product = data_dict['plfam'][plfam_id]['product']
-        if plfam_id in product_dict:
-            product = product_dict[plfam_id]
-        else:
-            product = 'NOTHING'
-        plfam_str = f'{plfam_id}\t{feature_count}\t{genome_count}\t{product}\t{aa_length_min}\t{aa_length_max}\t{aa_length_mean}\t{aa_length_std}'
-        plfam_line_list.append(plfam_str)
-    for pgfam_id in data_dict['pgfam']:
-        if pgfam_id == '':
+        line = line.strip().split('\t')
+        # 20 entries in query result with pgfam and plfam data
+        if len(line) < 20: 
             continue
-        aa_length_list = data_dict['pgfam'][pgfam_id]['aa_length_list']
-        aa_length_max = max(aa_length_list)
-        aa_length_min = min(aa_length_list)
-        aa_length_mean = np.mean(aa_length_list)
-        aa_length_std = np.std(aa_length_list)
-        feature_count = data_dict['pgfam'][pgfam_id]['feature_count']
-        genome_count = data_dict['pgfam'][pgfam_id]['genome_count']
-        #genomes = format(feature_count,'#04x').replace('0x','')
-        genomes_dir = {}
-        pgfam_genome_list[pgfam_id] = []
-        for gid in genome_ids:
-            if gid in pgfam_genomes[pgfam_id]:
-                #genomes+=format(pgfam_genomes[pgfam_id][gid],'#04x').replace('0x','')
-                genomes_dir[gid] = format(pgfam_genomes[pgfam_id][gid],'#04x').replace('0x','')
-                pgfam_genome_list[pgfam_id].append(gid)
-            else:
-                genomes_dir[gid] = '00'
-        #genomes = ''.join(genomes_list)
-        genome_str_dict['pgfam'][pgfam_id] = genomes_dir 
-        #product = data_dict['pgfam'][pgfam_id]['product']
-        if pgfam_id in product_dict:
-            product = product_dict[pgfam_id]
-        else:
-            product = 'NOTHING'
-        pgfam_str = f'{pgfam_id}\t{feature_count}\t{genome_count}\t{product}\t{aa_length_min}\t{aa_length_max}\t{aa_length_mean}\t{aa_length_std}'
-        pgfam_line_list.append(pgfam_str)
+        try:
+            genome_id = line[1].replace('\"','')
+            plfam_id = line[14].replace('\"','')
+            pgfam_id = line[15].replace('\"','')
+            aa_length = line[17].replace('\"','')
+            product = line[19].replace('\"','')
+        except Exception as e:
+            sys.stderr.write(f'Error with the following line:\n{e}\n{line}\n')
+            continue
+        if aa_length == '':
+            continue
+        feature_rows.append([genome_id, plfam_id, pgfam_id, aa_length, product])
+    return feature_rows
 
-    #output_json['genome_ids'] = genome_ids
-    #output_json['genome_ids'] = list(set(genome_ids).intersection(present_genome_ids)) 
+# Family stages: fetch the family fields of every feature, parse them into per family and
+# genome partials, aggregate the partials into the family tables and genome strings, look up
+# the family products and write the output. run_families runs them one after the other
+
+# Returns the family feature frames of the genomes: the features query rows when available,
+# the genomes missing from that table are queried again
+# query_dict: optional features query table
+# genome_data: optional genome data, the CDS counts size the queries
+def fetch_family_frames(genome_ids, session, cache=None, checkpoint=None, query_dict=None, genome_data=None):
+    family_frames = []
+    feature_genome_ids = set()
+    feature_df = get_feature_df(query_dict, FAMILY_FEATURE_COLUMNS) if query_dict else None
+    if feature_df is not None and feature_df.shape[0] > 0:
+        family_frames.append(get_family_feature_frame(feature_df))
+        feature_genome_ids = set(family_frames[0]['genome_id'].unique())
+    missing_genome_ids = [gid for gid in genome_ids if gid not in feature_genome_ids]
+    if len(missing_genome_ids) > 0:
+        print(f'querying features of {len(missing_genome_ids)} genomes missing from the features table')
+    fetch_workers = get_fetch_workers()
+    api_session = create_api_session(session, fetch_workers)
+    planner = ChunkPlanner.from_env(get_genome_weights(genome_data), FAMILY_FEATURE_BYTES_PER_CDS)
+    authorization = session.headers.get('Authorization', '')
+    # the query sorts by feature_id, which starts with the genome id
+    fetch_chunk = lambda gids: get_cached_chunk(cache, 'genome_feature.families', authorization, gids, lambda missing_gids: fetch_family_features(missing_gids, api_session),
+        lambda row: row[0], lambda row: row[0] + '.')
+    for unit_ids, feature_rows in fetch_genome_units(missing_genome_ids, GENOME_UNIT_SIZE, planner, fetch_chunk,
+            lambda rows, unit_of_genome: split_rows(rows, unit_of_genome, lambda row: row[0]), lambda pieces: merge_rows(pieces, lambda row: row[0] + '.'), checkpoint, 'genome_feature.families', fetch_workers):
+        family_frames.append(pd.DataFrame(feature_rows, columns=['genome_id','plfam_id','pgfam_id','aa_length','product']))
+    record_rows(sum(frame.shape[0] for frame in family_frames))
+    return family_frames
+
+# Aggregates the family frames into partials and stores them as columnar tables under table_dir
+# Returns the partial table directory of each family type and the genome ids with data
+def parse_family_frames(table_dir, family_frames):
+    family_partials = {'plfam': [], 'pgfam': []}
+    present_genome_ids = set()
+    for chunk_df in family_frames:
+        record_rows(chunk_df.shape[0])
+        chunk_partials = aggregate_family_chunk(chunk_df)
+        present_genome_ids.update(chunk_partials['genome_ids'])
+        for fam in family_partials:
+            family_partials[fam].append(chunk_partials[fam])
+    partial_tables = {'genome_ids': present_genome_ids}
+    for fam in family_partials:
+        partial_df = pd.concat(family_partials[fam], ignore_index=True)
+        partial_tables[fam] = write_columnar_table(partial_df, table_dir, prefix=f'.{fam}_partials_')
+    return partial_tables
+
+# Merges the family partials into the family tables with a genomes string column, the genome
+# lists of each family and the genome order of the output. Writes the family matrices when matrix_file is set
+def aggregate_family_tables(genome_ids, matrix_file, partial_tables, genome_data):
+    present_genome_ids = partial_tables['genome_ids']
+    family_tables = {}
+    family_genome_counts = {}
+    for fam in ['plfam','pgfam']:
+        partial_df = read_columnar_table(partial_tables[fam])
+        partial_df['family_id'] = partial_df['family_id'].astype(object)
+        partial_df['genome_id'] = partial_df['genome_id'].astype(object)
+        record_rows(partial_df.shape[0])
+        family_tables[fam], family_genome_counts[fam] = merge_family_partials([partial_df])
+        del partial_df
 
     unsorted_genome_ids = [gid for gid in genome_ids if gid in present_genome_ids] 
     tmp_data = genome_data.loc[genome_data['Genome ID'].isin(unsorted_genome_ids)]
@@ -250,36 +310,114 @@ def run_families(genome_ids, query_dict, output_file, output_dir, genome_data, g
     unsorted_genome_names = tmp_data['Genome Name'].tolist()
     sorted_genome_names, sorted_genome_ids = zip(*sorted(zip(unsorted_genome_names,unsorted_genome_ids)))
 
-    # add genomes string to each line
-    for x in range(0,len(plfam_line_list)): 
-        line_parts = plfam_line_list[x].split('\t')
-        genomes_dir = genome_str_dict['plfam'][line_parts[0]]
-        genome_str = ''
-        for gid in sorted_genome_ids:
-            genome_str+=genomes_dir[gid]
-        line_parts.append(genome_str)
-        plfam_line_list[x] = '\t'.join(line_parts)
-    for x in range(0,len(pgfam_line_list)): 
-        line_parts = pgfam_line_list[x].split('\t')
-        genomes_dir = genome_str_dict['pgfam'][line_parts[0]]
-        genome_str = ''
-        for gid in sorted_genome_ids:
-            genome_str+=genomes_dir[gid]
-        line_parts.append(genome_str)
-        pgfam_line_list[x] = '\t'.join(line_parts)
-    
+    genome_lists = {}
+    family_matrices = {}
+    for fam in family_tables:
+        family_table = family_tables[fam]
+        family_matrices[fam] = get_family_genome_matrix(family_table, family_genome_counts[fam], sorted_genome_ids)
+        family_table['genomes'] = get_genome_strings(family_matrices[fam], family_table.shape[0], len(sorted_genome_ids))
+        genome_lists[fam] = get_family_genome_lists(family_table, family_genome_counts[fam], genome_ids)
+        family_table.drop(columns=['aa_length_sum','aa_length_sumsq'], inplace=True)
+
+    if matrix_file is not None:
+        write_family_matrices(matrix_file, family_tables, family_matrices, sorted_genome_ids)
+
+    return {
+        'family_tables': family_tables,
+        'genome_lists': genome_lists,
+        'genome_ids': sorted_genome_ids,
+        'genome_names': sorted_genome_names,
+        'present_genome_ids': present_genome_ids
+    }
+
+# Returns the family_product of every family of the aggregated family tables.
+# Families found in the family product store are not queried, the products of the
+# others are added to the store
+def fetch_family_products(session, checkpoint, family_data):
+    fetch_workers = get_fetch_workers()
+    api_session = create_api_session(session, fetch_workers)
+    # - get protein family description data
+    def fetch_product_chunk(family_ids):
+        print(f"family_ids has {len(family_ids)} elements")
+        query = f"in(family_id,({','.join(family_ids)}))&limit(2500000)&sort(+family_id)"
+        text_data = list(query_api_records(api_session,'protein_family_ref',query,print_query=False))
+        print(f"text_data has {len(text_data)} elements")
+        if len(text_data) == 0:
+            print(query)
+        return text_data
+    product_dict = {}
+    family_tables = family_data['family_tables']
+    store = FamilyProductStore.from_env()
+    family_id_chunks = []
+    for family_type in ['plfam','pgfam']:
+        family_ids = family_tables[family_type]['family_id'].tolist()
+        if store is not None:
+            stored_products, family_ids = store.get(family_ids)
+            product_dict.update((family_id, product) for family_id, product in stored_products.items() if product is not None)
+        family_id_chunks += list(chunker(family_ids,5000))
+    record_rows(sum(len(family_ids) for family_ids in family_id_chunks))
+    fetch_chunk = lambda family_ids: get_checkpointed_chunk(checkpoint, 'protein_family_ref', family_ids, fetch_product_chunk)
+    for family_ids, text_data in zip(family_id_chunks, fetch_chunks(fetch_chunk, family_id_chunks, fetch_workers)):
+        chunk_products = {}
+        for entry in text_data:
+            chunk_products[entry['family_id']] = entry['family_product']
+        product_dict.update(chunk_products)
+        if store is not None:
+            store.put(family_ids, chunk_products)
+    if store is not None:
+        print(f"family product store: {store.hits} families found, {store.misses} queried")
+        store.close()
+    return product_dict
+
+# Writes every family of protein_family_ref to the family product store, read in pages
+# of page_size families ordered by family_id
+def refresh_family_products(store, session, page_size=25000):
+    api_session = create_api_session(session, 1)
+    last_family_id = None
+    total = 0
+    while True:
+        condition = 'eq(family_id,*)' if last_family_id is None else f'gt(family_id,{last_family_id})'
+        query = f"{condition}&select(family_id,family_product)&sort(+family_id)&limit({page_size})"
+        page_products = {}
+        for entry in query_api_records(api_session,'protein_family_ref',query,print_query=False):
+            page_products[entry['family_id']] = entry.get('family_product')
+        if len(page_products) == 0:
+            break
+        store.put(list(page_products), page_products)
+        total += len(page_products)
+        last_family_id = max(page_products)
+        print(f"refreshed {total} families, last family_id {last_family_id}")
+    return total
+
+# Writes the protein families tables json
+def write_families(output_file, output_dir, genome_group_dict, genome_data, family_data, product_dict):
+    family_tables = family_data['family_tables']
+    sorted_genome_ids = family_data['genome_ids']
+
+    # add counts, length stats, product and genomes string for each family_id
     header = 'family_id\tfeature_count\tgenome_count\tproduct\taa_length_min\taa_length_max\taa_length_mean\taa_length_std\tgenomes'
-    plfam_line_list.insert(0,header)
-    pgfam_line_list.insert(0,header)
+    line_lists = {'plfam': [header], 'pgfam': [header]}
+    for fam in line_lists:
+        family_table = family_tables[fam]
+        for family_id, feature_count, genome_count, aa_length_min, aa_length_max, aa_length_mean, aa_length_std, genome_str in zip(family_table['family_id'].tolist(),
+                family_table['feature_count'].tolist(), family_table['genome_count'].tolist(), family_table['aa_length_min'].tolist(),
+                family_table['aa_length_max'].tolist(), family_table['aa_length_mean'].tolist(), family_table['aa_length_std'].tolist(), family_table['genomes'].tolist()):
+            if family_id in product_dict:
+                product = product_dict[family_id]
+            else:
+                product = 'NOTHING'
+            family_str = f'{family_id}\t{feature_count}\t{genome_count}\t{product}\t{aa_length_min}\t{aa_length_max}\t{aa_length_mean}\t{aa_length_std}\t{genome_str}'
+            line_lists[fam].append(family_str)
+        record_rows(family_table.shape[0])
 
     output_json = {}
-    output_json['plfam'] = '\n'.join(plfam_line_list) 
-    output_json['pgfam'] = '\n'.join(pgfam_line_list) 
+    output_json['plfam'] = '\n'.join(line_lists['plfam']) 
+    output_json['pgfam'] = '\n'.join(line_lists['pgfam']) 
     output_json['genome_ids'] = sorted_genome_ids 
-    output_json['genome_names'] = sorted_genome_names
+    output_json['genome_names'] = family_data['genome_names']
     output_json['job_name'] = output_file
-    output_json['plfam_genomes'] = plfam_genome_list 
-    output_json['pgfam_genomes'] = pgfam_genome_list 
+    output_json['plfam_genomes'] = family_data['genome_lists']['plfam'] 
+    output_json['pgfam_genomes'] = family_data['genome_lists']['pgfam'] 
 
     # add genome groups and other metadata for genome ids to output json
     output_json['genome_data'] = {}
@@ -306,259 +444,249 @@ def run_families(genome_ids, query_dict, output_file, output_dir, genome_data, g
         o.write(json.dumps(output_json))
 
     print("ProteinFamilies Complete")
-    return ({ 'success': True, 'genomes': present_genome_ids })
+    return ({ 'success': True, 'genomes': family_data['present_genome_ids'] })
 
-def run_subsystems(genome_ids, query_dict, output_file, output_dir, genome_data, session):
-    print('starting subsystems')
-    subsystems_file = os.path.join(output_dir,output_file+'_subsystems.tsv')
-    subsystem_line_list = []
-    subsystem_header = 'superclass\tclass\tsubclass\tsubsystem_name\tgene_count\trole_count'
-    subsystem_line_list.append(subsystem_header)
-    subsystem_dict = {}
-    overview_counts_dict = {}
-    unique_subsystem_features = {}
-
-    subsystem_query_data = []
-    required_fields = ['superclass','class','subclass','subsystem_name','subsystem_id','feature_id','gene','product','role_id','role_name']
-    subsystem_data_found = False
-    subsystem_genomes_found = set()
-    subsystem_table_header = None
-    print_one = True
-    genome_dict = {}
-    variant_counts_dict = {}
-    genome_data_dict = {}
-    for gids in chunker(genome_ids, 20):
-        base = "https://www.bv-brc.org/api/subsystem/?http_download=true"
+# Returns the family matrix file of the job, None when the matrix is not requested
+def get_family_matrix_file(output_file, output_dir, write_matrix):
+    if not write_matrix:
+        return None
+    return os.path.join(output_dir,output_file+'_proteinfams_matrix.npz')
+
+def run_families(genome_ids, query_dict, output_file, output_dir, genome_data, genome_group_dict, session, cache=None, write_matrix=False):
+    print('starting protein families')
+    family_frames = fetch_family_frames(genome_ids, session, cache, None, query_dict, genome_data)
+    partial_tables = parse_family_frames(output_dir, family_frames)
+    del family_frames
+    try:
+        family_data = aggregate_family_tables(genome_ids, get_family_matrix_file(output_file, output_dir, write_matrix), partial_tables, genome_data)
+    finally:
+        for fam in ['plfam','pgfam']:
+            remove_columnar_table(partial_tables[fam])
+    product_dict = fetch_family_products(session, None, family_data)
+    return write_families(output_file, output_dir, genome_group_dict, genome_data, family_data, product_dict)
+
+# Fetches the subsystem or pathway json records for a list of genome ids. Every field is
+# downloaded: the records tsv and the pathway genes table list all of them
+def fetch_json_records(endpoint, gids, api_session):
+    if endpoint == 'pathway':
+        query = f"in(genome_id,({','.join(gids)}))&limit(2500000)&sort(+id)&eq(annotation,PATRIC)"
+    else:
         query = f"in(genome_id,({','.join(gids)}))&limit(2500000)&sort(+id)"
-        headers = {"accept":"application/json", "content-type":"application/rqlquery+x-www-form-urlencoded","Authorization": session.headers['Authorization']}
+    #subsystem: dict_keys(['active', 'class', 'date_inserted', 'date_modified', 'feature_id', 'gene', 'genome_id', 'genome_name', 'id', 'owner', 'patric_id', 'product', 'public', 'refseq_locus_tag', 'role_id', 'role_name', 'subclass', 'subsystem_id', 'subsystem_name', 'superclass', 'taxon_id', '_version_'])
+    #pathway: accession       alt_locus_tag   annotation      date_inserted   date_modified   ec_description  ec_number       feature_id      genome_ec       genome_id       genome_name     id      owner   pathway_class   pathway_ec      pathway_id   pathway_name     patric_id       product public  refseq_locus_tag        sequence_id     taxon_id        _version_
+    return list(query_api_records(api_session,endpoint,query))
+
+# Returns the cache and checkpoint namespace of the rows of an endpoint projected on fields,
+# rows fetched with other fields are kept apart
+def get_fields_namespace(endpoint, fields):
+    return f"{endpoint}.{hashlib.sha1(','.join(fields).encode()).hexdigest()[:8]}"
+
+# Repeated, high cardinality fields stored as categoricals in the records frames
+SUBSYSTEM_CATEGORY_FIELDS = ['genome_id','genome_name','superclass','class','subclass','subsystem_id','subsystem_name','role_id','role_name','active']
+PATHWAY_CATEGORY_FIELDS = ['genome_id','genome_name','annotation','pathway_id','pathway_name','pathway_class','ec_number','ec_description']
+
+# Builds a DataFrame straight from api records with the columns of the widest record header.
+# Required fields are empty strings where missing or null and category_fields are stored as categoricals
+def build_records_frame(records, header, required_fields, category_fields):
+    columns = header + [field for field in required_fields if field not in header]
+    records_df = pd.DataFrame.from_records(records, columns=columns)
+    for field in required_fields:
+        records_df[field] = records_df[field].fillna('')
+    for field in category_fields:
+        if field in records_df.columns:
+            records_df[field] = records_df[field].astype('category')
+    return records_df
+
+# Concatenates the records frames of the units of a job into one frame with the columns of the
+# widest record header. Category fields are joined as categoricals, not expanded into objects
+def concat_records_frames(records_frames, header, required_fields, category_fields):
+    columns = header + [field for field in required_fields if field not in header]
+    data = {}
+    for column in columns:
+        pieces = [frame[column] if column in frame.columns else pd.Series(np.nan, index=frame.index, dtype=object) for frame in records_frames]
+        if column in category_fields:
+            data[column] = union_categoricals([pd.Categorical(piece) for piece in pieces], sort_categories=True)
+        else:
+            data[column] = pd.concat(pieces, ignore_index=True)
+    return pd.DataFrame(data)
+
+# Fields every subsystem and pathway record frame has, empty where the api left them out
+SYSTEM_REQUIRED_FIELDS = {
+    'subsystem': ['superclass','class','subclass','subsystem_name','subsystem_id','feature_id','gene','product','role_id','role_name'],
+    'pathway': ['annotation','ec_description','ec_number','feature_id','genome_id','pathway_class','pathway_id','pathway_name','patric_id','product']
+}
+SYSTEM_CATEGORY_FIELDS = {
+    'subsystem': SUBSYSTEM_CATEGORY_FIELDS,
+    'pathway': PATHWAY_CATEGORY_FIELDS
+}
 
-        #dict_keys(['active', 'class', 'date_inserted', 'date_modified', 'feature_id', 'gene', 'genome_id', 'genome_name', 'id', 'owner', 'patric_id', 'product', 'public', 'refseq_locus_tag', 'role_id', 'role_name', 'subclass', 'subsystem_id', 'subsystem_name', 'superclass', 'taxon_id', '_version_'])
+# Subsystem and pathway stages: fetch the records of the endpoint, parse them into a columnar
+# records table, compute the outputs from the table and write them
 
-        print('Query = {0}\nHeaders = {1}'.format(base+'&'+query,headers))
-        result_header = True        
-        current_header = None
-        all_data = json.loads(getQueryDataText(base,query,headers))
+# Fetches the records of the subsystem or pathway endpoint for the genomes. The records of each
+# unit are turned into a frame as they arrive, so only one unit is held as records at a time
+# Returns the records frames of the units and the widest record header, records are not
+# guaranteed to carry every key
+# genome_data: optional genome data, the CDS counts size the queries
+def fetch_system_records(endpoint, genome_ids, session, cache=None, checkpoint=None, genome_data=None):
+    records_frames = []
+    n_records = 0
+    table_header = None
+    print_one = endpoint == 'subsystem'
+    fetch_workers = get_fetch_workers()
+    api_session = create_api_session(session, fetch_workers)
+    namespace = endpoint
+    planner = ChunkPlanner.from_env(get_genome_weights(genome_data), SYSTEM_BYTES_PER_CDS[endpoint])
+    authorization = session.headers.get('Authorization', '')
+    fetch_chunk = lambda gids: get_cached_chunk(cache, namespace, authorization, gids, lambda missing_gids: fetch_json_records(endpoint, missing_gids, api_session),
+        lambda record: record['genome_id'], lambda record: record['id'])
+    split_records = lambda records, unit_of_genome: split_rows(records, unit_of_genome, lambda record: record['genome_id'])
+    merge_records = lambda pieces: merge_rows(pieces, lambda record: record['id'])
+    for unit_ids, all_data in fetch_genome_units(genome_ids, GENOME_UNIT_SIZE, planner, fetch_chunk, split_records, merge_records, checkpoint, namespace, fetch_workers):
+        if len(all_data) == 0:
+            continue
+        unit_header = None
         for line in all_data:
-            subsystem_data_found = True
-            if result_header:
-                result_header = False
-                print(line)
-                current_header = line.keys()
-                if subsystem_table_header is None or len(current_header) > len(subsystem_table_header):
-                    #subsystem_table_header = current_header
-                    subsystem_table_header = [x for x in current_header]
-                continue
+            if unit_header is None or len(line) > len(unit_header):
+                unit_header = [x for x in line.keys()]
             if print_one:
                 print_one = False
                 print(line)
-            subsystem_fields = line
-            for field in required_fields:
-                if field not in subsystem_fields:
-                    subsystem_fields[field] = ''
-            subsystem_query_data.append(subsystem_fields)
-            try:
-                active = subsystem_fields['active'] 
-                clss = subsystem_fields['class'] 
-                feature_id = subsystem_fields['feature_id'] 
-                gene = subsystem_fields['gene'] 
-                genome_id = subsystem_fields['genome_id']
-                genome_name = subsystem_fields['genome_name']
-                product = subsystem_fields['product'] 
-                role_id = subsystem_fields['role_id'] 
-                role_name = subsystem_fields['role_name'] 
-                subclass = subsystem_fields['subclass'] 
-                subsystem_id = subsystem_fields['subsystem_id'] 
-                subsystem_name = subsystem_fields['subsystem_name'] 
-                superclass = subsystem_fields['superclass']
-                # TODO: underlying issue of metadata, capitalizition of superclasses is not consistent
-                superclass = superclass.upper()
-            except Exception as e:
-                sys.stderr.write(f'Error with the following line:\n{e}\n{line}\n')
-                continue
-            subsystem_genomes_found.add(genome_id)
-            if genome_id not in genome_dict:
-                genome_dict[genome_name] = genome_id
-                genome_data_dict[genome_id] = {}
-                genome_data_dict[genome_id]["genes"] = [] 
-            if superclass not in subsystem_dict:
-                subsystem_dict[superclass] = {} 
-                overview_counts_dict[superclass] = {}
-            if clss not in subsystem_dict[superclass]:
-                subsystem_dict[superclass][clss] = {}
-                overview_counts_dict[superclass][clss] = {}
-            if subclass not in subsystem_dict[superclass][clss]:
-                subsystem_dict[superclass][clss][subclass] = {}
-                overview_counts_dict[superclass][clss][subclass] = {}
-                overview_counts_dict[superclass][clss][subclass]['subsystem_names'] = set()
-                overview_counts_dict[superclass][clss][subclass]['gene_set'] = set() 
-            if subsystem_name not in subsystem_dict[superclass][clss][subclass]:
-                subsystem_dict[superclass][clss][subclass][subsystem_name] = {}
-                subsystem_dict[superclass][clss][subclass][subsystem_name]['gene_set'] = set()
-                subsystem_dict[superclass][clss][subclass][subsystem_name]['role_set'] = set() 
-                subsystem_dict[superclass][clss][subclass][subsystem_name]['active_genome_dict'] = {}
-                subsystem_dict[superclass][clss][subclass][subsystem_name]['subsystem_id'] = subsystem_id
-                subsystem_dict[superclass][clss][subclass][subsystem_name]['subsystem_counts'] = 0 
-            overview_counts_dict[superclass][clss][subclass]['subsystem_names'].add(subsystem_name)
-            subsystem_dict[superclass][clss][subclass][subsystem_name]['active_genome_dict'][genome_id] = active 
-            #sub_key = superclass + clss + subclass + subsystem_name
-            if subsystem_id not in variant_counts_dict:
-                variant_counts_dict[subsystem_id] = {}
-                variant_counts_dict[subsystem_id]['active'] = 0
-                variant_counts_dict[subsystem_id]['likely'] = 0
-                variant_counts_dict[subsystem_id]['inactive'] = 0
-            if active == 'active' or active == 'likely':
-                variant_counts_dict[subsystem_id][active] += 1
-            else: # never reached, the genome just doesn't have an entry
-                variant_counts_dict[subsystem_id]['inactive'] += 1
-            # TODO: repeated features; do I count these towards the gene counts?
-            #if feature_id in subsystem_dict[superclass][clss][subclass][subsystem_name]['gene_set']:
-            #    with open('repeated_feature_ids.txt','a') as o:
-            #       o.write(f'{feature_id}\n') 
-            #if feature_id not in genome_data_dict[genome_id]["genes"]:
-                #subsystem_dict[superclass][clss][subclass][subsystem_name]['gene_set'].add(feature_id)
-            subsystem_dict[superclass][clss][subclass][subsystem_name]['gene_set'].add(feature_id)
-            #genome_data_dict[genome_id]["genes"].append(feature_id)
-            overview_counts_dict[superclass][clss][subclass]['gene_set'].add(feature_id)
-            #if role_id is not None and role_id != '': 
-            subsystem_dict[superclass][clss][subclass][subsystem_name]['role_set'].add(role_id)
-            subsystem_dict[superclass][clss][subclass][subsystem_name]['subsystem_counts']+=1
-
-    if not subsystem_data_found:
-        return ({ 'success': False }) 
-
-    parsed_query_data = []
-    for line in subsystem_query_data:
-        new_line = ''
-        for field in subsystem_table_header:
-            if new_line != '':
-                new_line += '\t'
-            if field not in line:    
-                new_line += ' '
-            else:
-                value = line[field]
-                if not isinstance(value,str):
-                    value = str(value)
-                new_line += value 
-        parsed_query_data.append(new_line.split('\t'))
-    
-    subsystem_df = pd.DataFrame(parsed_query_data,columns=subsystem_table_header)
-    subsystem_df.to_csv(subsystems_file,index=False,sep='\t')
+        if table_header is None or len(unit_header) > len(table_header):
+            table_header = unit_header
+        records_frames.append(build_records_frame(all_data, unit_header, SYSTEM_REQUIRED_FIELDS[endpoint], SYSTEM_CATEGORY_FIELDS[endpoint]))
+        n_records += len(all_data)
+    print(f'{endpoint}: {len(genome_ids)} genomes queried in {planner.chunks} chunks')
+    record_rows(n_records)
+    return (records_frames, table_header)
 
-    gene_df = query_dict['feature']
-    gene_df = pd.merge(gene_df,subsystem_df.drop(return_columns_to_remove('subsystems_genes',subsystem_df.columns.tolist()),axis=1),on=['genome_id','feature_id'],how='inner')
+# Joins the records frames of the units and stores them as a columnar table under table_dir
+# Returns the table directory with the record header, None when no records were found
+def parse_system_records(endpoint, table_dir, fetched):
+    records_frames, table_header = fetched
+    if len(records_frames) == 0:
+        return None
+    records_df = concat_records_frames(records_frames, table_header, SYSTEM_REQUIRED_FIELDS[endpoint], SYSTEM_CATEGORY_FIELDS[endpoint])
+    record_rows(records_df.shape[0])
+    return { 'table': write_columnar_table(records_df, table_dir, prefix=f'.{endpoint}_records_'), 'header': table_header }
+
+# Reads a records table written by parse_system_records. Only the category fields stay
+# categorical, other string columns are turned back into objects
+def read_records_table(records_table, category_fields):
+    records_df = read_columnar_table(records_table)
+    for column in records_df.columns:
+        if column not in category_fields and isinstance(records_df[column].dtype, pd.CategoricalDtype):
+            records_df[column] = records_df[column].astype(object)
+    return records_df
 
-    # get data for conservation scores 
-    unique_subsystem_features = {}
-    unique_subsystem_roles = {}
-    for idx in range(0,gene_df.shape[0]):
-        curr_sub_id = gene_df.iloc[idx].subsystem_id
-        if curr_sub_id not in unique_subsystem_features:
-            unique_subsystem_features[curr_sub_id] = {}
-        if curr_sub_id not in unique_subsystem_roles:
-            unique_subsystem_roles[curr_sub_id] = {}
-        gene = gene_df.iloc[idx]['gene']
-        role = gene_df.iloc[idx]['role_id']
-        genome_id = gene_df.iloc[idx].genome_id
-        if not gene is None and not gene is np.nan:
-            if gene not in unique_subsystem_features[curr_sub_id]:
-                unique_subsystem_features[curr_sub_id][gene] = set()
-            unique_subsystem_features[curr_sub_id][gene].add(genome_id)
-        if not role is None and not role is np.nan:
-            if role not in unique_subsystem_roles[curr_sub_id]:    
-                unique_subsystem_roles[curr_sub_id][role] = set()
-            unique_subsystem_roles[curr_sub_id][role].add(genome_id)
-
-    # conservation scores
-    # gets counts for overview dict, any other adjustments
-    # create subsystems table
-    subsystems_table_list = []
-    overview_dict = {} 
-    for superclass in overview_counts_dict:
-        overview_dict[superclass] = {}
-        overview_dict[superclass]['subsystem_name_counts'] = 0
-        overview_dict[superclass]['gene_counts'] = 0
-        for clss in overview_counts_dict[superclass]:
-            overview_dict[superclass][clss] = {}
-            overview_dict[superclass][clss]['subsystem_name_counts'] = 0
-            overview_dict[superclass][clss]['gene_counts'] = 0
-            for subclass in overview_counts_dict[superclass][clss]:
-                overview_dict[superclass][clss][subclass] = {}
-                overview_dict[superclass][clss][subclass]['subsystem_name_counts'] = len(overview_counts_dict[superclass][clss][subclass]['subsystem_names'])
-                overview_dict[superclass][clss][subclass]['gene_counts'] = len(overview_counts_dict[superclass][clss][subclass]['gene_set'])
-                overview_dict[superclass][clss]['subsystem_name_counts'] += len(overview_counts_dict[superclass][clss][subclass]['subsystem_names'])
-                overview_dict[superclass][clss]['gene_counts'] += len(overview_counts_dict[superclass][clss][subclass]['gene_set'])
-                overview_dict[superclass]['gene_counts'] += len(overview_counts_dict[superclass][clss][subclass]['gene_set'])
-                overview_dict[superclass]['subsystem_name_counts'] += len(overview_counts_dict[superclass][clss][subclass]['subsystem_names'])
-                for subsystem_name in subsystem_dict[superclass][clss][subclass]:
-                    #sub_key = superclass + clss + subclass + subsystem_name
-                    subsystem_id = subsystem_dict[superclass][clss][subclass][subsystem_name]['subsystem_id']
-                    # gene conservation
-                    #if subsystem_id in unique_subsystem_features:
-                    #for gene in unique_subsystem_features[subsystem_id]:
-                    #    gene_numerator += len(unique_subsystem_features[subsystem_id][gene])
-                    gene_numerator = len(subsystem_dict[superclass][clss][subclass][subsystem_name]['gene_set'])
-                    gene_denominator = len(subsystem_dict[superclass][clss][subclass][subsystem_name]['role_set'])*len(subsystem_genomes_found)
-                    gene_conservation = 0
-                    if gene_denominator > 0:
-                        gene_conservation = float(gene_numerator) / float(gene_denominator)
-                    # role conservation
-                    role_numerator = 0
-                    role_denominator = 0
-                    if subsystem_id in unique_subsystem_roles:
-                        for role in unique_subsystem_roles[subsystem_id]:
-                            role_numerator += len(unique_subsystem_roles[subsystem_id][role])
-                        role_denominator = len(subsystem_dict[superclass][clss][subclass][subsystem_name]['role_set'])*len(subsystem_genomes_found) 
-                    role_conservation = 0
-                    if role_denominator > 0:
-                        role_conservation = float(role_numerator) / float(role_denominator) * 100
-                    active_num = len(subsystem_df[subsystem_df.subsystem_id == subsystem_id].genome_id.unique()) 
-                    new_entry = {
-                        'superclass': superclass,
-                        'class': clss,
-                        'subclass': subclass,
-                        'subsystem_name': subsystem_name,
-                        'subsystem_id': subsystem_id,
-                        'role_counts': len(subsystem_dict[superclass][clss][subclass][subsystem_name]['role_set']),
-                        'gene_counts': len(subsystem_dict[superclass][clss][subclass][subsystem_name]['gene_set']),
-                        'genome_count': len(subsystem_dict[superclass][clss][subclass][subsystem_name]['active_genome_dict']),
-                        'gene_conservation': gene_conservation,
-                        'role_conservation': role_conservation,
-                        'prop_active': float(active_num)/float(len(subsystem_genomes_found))
-                    }
-                    subsystems_table_list.append(new_entry)
-    subsystems_table = pd.DataFrame(subsystems_table_list)
-
-    # Variant matrix
-    variant_mtx_header = '\t\t\t\t\t\t'
-    gid_str = ''
-    genome_name_list = list(genome_dict.keys())
-    genome_name_list.sort()
-    for genome_name in genome_name_list:
-        variant_mtx_header += f'\t{genome_name}'
-        gid_str += f'\t{genome_dict[genome_name]}'
+# Writes the output files computed by a system and returns its runner result
+def write_system_output(system, output):
+    for output_file, text in output.get('files', {}).items():
+        with open(output_file,'w') as o:
+            o.write(text)
+    if output['result']['success']:
+        print(f'{system} complete')
+    return output['result']
+
+SUBSYSTEM_LEVELS = ['superclass','class','subclass','subsystem_name']
+
+# Computes the subsystem metrics from the subsystem records and the feature genes merged with them
+# in a few grouped passes.
+# Returns the subsystems table, the overview counts, the variant matrix text and the genome ids found
+def aggregate_subsystems(subsystem_df, gene_df):
+    records = subsystem_df[SUBSYSTEM_LEVELS + ['subsystem_id','feature_id','role_id','genome_id','genome_name','active']].copy()
+    # TODO: underlying issue of metadata, capitalizition of superclasses is not consistent
+    records['superclass'] = records['superclass'].str.upper()
+    subsystem_genomes_found = records['genome_id'].unique().tolist()
+    n_genomes = len(subsystem_genomes_found)
+    # subsystems are listed level by level in order of first appearance:
+    # sorting on the first row of each key prefix gives that order
+    records['row'] = np.arange(records.shape[0])
+    order_columns = []
+    for level in range(1, len(SUBSYSTEM_LEVELS) + 1):
+        records[f'first_{level}'] = records.groupby(SUBSYSTEM_LEVELS[:level], sort=False, observed=True)['row'].transform('min')
+        order_columns.append(f'first_{level}')
+    records['key_code'] = records.groupby(order_columns).ngroup()
+
+    subsystems_table = records.groupby('key_code').agg(**{
+        'superclass': ('superclass','first'),
+        'class': ('class','first'),
+        'subclass': ('subclass','first'),
+        'subsystem_name': ('subsystem_name','first'),
+        'subsystem_id': ('subsystem_id','first'),
+        'role_counts': ('role_id','nunique'),
+        'gene_counts': ('feature_id','nunique'),
+        'genome_count': ('genome_id','nunique')}).reset_index(drop=True)
+    subsystems_table['subsystem_id'] = subsystems_table['subsystem_id'].astype(object)
+    role_denominator = subsystems_table['role_counts'] * n_genomes
+    # gene conservation
+    subsystems_table['gene_conservation'] = subsystems_table['gene_counts'] / role_denominator
+    # role conservation: genomes having each role among the genes, 0 for subsystems without genes
+    gene_roles = gene_df[['subsystem_id','role_id','genome_id']].dropna(subset=['role_id']).drop_duplicates()
+    role_numerator = subsystems_table['subsystem_id'].map(gene_roles.groupby('subsystem_id', observed=True).size()).fillna(0)
+    subsystems_table['role_conservation'] = np.where(subsystems_table['subsystem_id'].isin(gene_df['subsystem_id']), role_numerator / role_denominator * 100, 0.0)
+    active_num = subsystems_table['subsystem_id'].map(subsystem_df.groupby('subsystem_id', observed=True)['genome_id'].nunique())
+    subsystems_table['prop_active'] = active_num / n_genomes
+
+    # overview counts per superclass, class and subclass
+    overview_dict = {}
+    subclass_counts = records.groupby(order_columns[:3]).agg(
+        superclass=('superclass','first'),
+        clss=('class','first'),
+        subclass=('subclass','first'),
+        subsystem_name_counts=('subsystem_name','nunique'),
+        gene_counts=('feature_id','nunique'))
+    for superclass, clss, subclass, subsystem_name_counts, gene_counts in zip(subclass_counts['superclass'].tolist(), subclass_counts['clss'].tolist(),
+            subclass_counts['subclass'].tolist(), subclass_counts['subsystem_name_counts'].tolist(), subclass_counts['gene_counts'].tolist()):
+        if superclass not in overview_dict:
+            overview_dict[superclass] = {'subsystem_name_counts': 0, 'gene_counts': 0}
+        if clss not in overview_dict[superclass]:
+            overview_dict[superclass][clss] = {'subsystem_name_counts': 0, 'gene_counts': 0}
+        overview_dict[superclass][clss][subclass] = {'subsystem_name_counts': subsystem_name_counts, 'gene_counts': gene_counts}
+        overview_dict[superclass][clss]['subsystem_name_counts'] += subsystem_name_counts
+        overview_dict[superclass][clss]['gene_counts'] += gene_counts
+        overview_dict[superclass]['gene_counts'] += gene_counts
+        overview_dict[superclass]['subsystem_name_counts'] += subsystem_name_counts
+
+    # Variant matrix: active value of the last record of each subsystem and genome, genomes sorted by name
+    genome_dict = dict(zip(records['genome_name'].tolist(), records['genome_id'].tolist()))
+    genome_name_list = sorted(genome_dict.keys())
+    variant_mtx_header = '\t\t\t\t\t\t' + ''.join(f'\t{genome_name}' for genome_name in genome_name_list)
     variant_mtx_header += '\nSuperclass\tClass\tSubclass\tSS\tactive\tlikely\tinactive'
-    variant_mtx_header += gid_str
-    variant_mtx_lines = []
-    variant_mtx_lines.append(variant_mtx_header)
-    for superclass in subsystem_dict:
-        for clss in subsystem_dict[superclass]:
-            for subclass in subsystem_dict[superclass][clss]: 
-                for subsystem_name in subsystem_dict[superclass][clss][subclass]:
-                    #sub_key = superclass + clss + subclass + subsystem_name 
-                    subsystem_id = subsystem_dict[superclass][clss][subclass][subsystem_name]['subsystem_id']
-                    inactive_value = 0 
-                    new_var_line_p1 = f'{superclass}\t{clss}\t{subclass}\t{subsystem_name}'
-                    new_var_line_p1 += f"\t{variant_counts_dict[subsystem_id]['active']}\t{variant_counts_dict[subsystem_id]['likely']}\t{inactive_value}"
-                    new_var_line_p2 = ''
-                    for genome_name in genome_name_list:
-                        if genome_dict[genome_name] in subsystem_dict[superclass][clss][subclass][subsystem_name]['active_genome_dict']:
-                            new_var_line_p2 += f"\t{subsystem_dict[superclass][clss][subclass][subsystem_name]['active_genome_dict'][genome_dict[genome_name]]}" 
-                        else:
-                            new_var_line_p2 += f"\tinactive"
-                            inactive_value += 1
-                    new_var_line = new_var_line_p1 + f'\t{inactive_value}' + new_var_line_p2 
-                    variant_mtx_lines.append(new_var_line) 
+    variant_mtx_header += ''.join(f'\t{genome_dict[genome_name]}' for genome_name in genome_name_list)
+    variant_counts = {}
+    for active in ['active','likely']:
+        variant_counts[active] = subsystems_table['subsystem_id'].map(records[records['active'] == active].groupby('subsystem_id', observed=True).size()).fillna(0).astype(int).tolist()
+    active_genomes = records.drop_duplicates(['key_code','genome_id'], keep='last').astype({'genome_id': object, 'active': object})
+    active_matrix = active_genomes.pivot(index='key_code', columns='genome_id', values='active')
+    active_matrix = active_matrix.reindex(index=range(subsystems_table.shape[0]), columns=[genome_dict[genome_name] for genome_name in genome_name_list])
+    inactive_counts = active_matrix.isna().sum(axis=1).tolist()
+    active_rows = active_matrix.fillna('inactive').astype(str).to_numpy().tolist()
+    variant_mtx_lines = [variant_mtx_header]
+    for superclass, clss, subclass, subsystem_name, active_count, likely_count, inactive_value, active_row in zip(subsystems_table['superclass'].tolist(),
+            subsystems_table['class'].tolist(), subsystems_table['subclass'].tolist(), subsystems_table['subsystem_name'].tolist(),
+            variant_counts['active'], variant_counts['likely'], inactive_counts, active_rows):
+        new_var_line = f'{superclass}\t{clss}\t{subclass}\t{subsystem_name}\t{active_count}\t{likely_count}\t0\t{inactive_value}'
+        new_var_line += ''.join(f'\t{active}' for active in active_row)
+        variant_mtx_lines.append(new_var_line)
     variant_mtx_text = '\n'.join(variant_mtx_lines)
+
+    return (subsystems_table, overview_dict, variant_mtx_text, subsystem_genomes_found)
+
+# Returns the subsystems output of the parsed subsystem records: writes the records tsv and
+# variant matrix and returns the tables json text with the runner result
+def compute_subsystems(output_file, output_dir, records, query_dict, genome_data):
+    if records is None:
+        return { 'result': { 'success': False } }
+    subsystems_file = os.path.join(output_dir,output_file+'_subsystems.tsv')
+    subsystem_df = read_records_table(records['table'], SUBSYSTEM_CATEGORY_FIELDS)
+    record_rows(subsystem_df.shape[0])
+    subsystem_df.to_csv(subsystems_file,index=False,sep='\t')
+
+    gene_df = get_feature_df(query_dict)
+    gene_df = pd.merge(gene_df,subsystem_df.drop(return_columns_to_remove('subsystems_genes',subsystem_df.columns.tolist()),axis=1),on=['genome_id','feature_id'],how='inner')
+
+    subsystems_table, overview_dict, variant_mtx_text, subsystem_genomes_found = aggregate_subsystems(subsystem_df, gene_df)
     variant_mtx_file = subsystems_file.replace('.tsv','_variant_mtx.tsv') 
     with open(variant_mtx_file,'w') as o:
         o.write(variant_mtx_text)
@@ -572,155 +700,83 @@ def run_subsystems(genome_ids, query_dict, output_file, output_dir, genome_data,
     output_json['job_name'] = output_file
     output_json['subsystems'] = subsystems_table.to_csv(index=False,sep='\t')
     output_json['genes'] = gene_df.to_csv(index=False,sep='\t')
-    with open(output_json_file,'w') as o:
-        o.write(json.dumps(output_json))
 
-    print('Subsystems complete')
-    return ({ 'success': True, 'genomes': list(subsystem_genomes_found) })
+    return {
+        'files': { output_json_file: json.dumps(output_json) },
+        'result': { 'success': True, 'genomes': list(subsystem_genomes_found) }
+    }
 
-def run_pathways(genome_ids, query_dict, output_file, output_dir, genome_data, session):
-    print('starting pathways') 
-    pathways_file = os.path.join(output_dir,output_file+'_pathways.tsv')
-    #pathway_df = query_dict['pathway']
-    #pathway_df.to_csv(pathways_file,sep='\t',index=False)
-    pathway_line_list = []
-    ec_line_list = []
+def run_subsystems(genome_ids, query_dict, output_file, output_dir, genome_data, session, cache=None):
+    print('starting subsystems')
+    records = parse_system_records('subsystem', output_dir, fetch_system_records('subsystem', genome_ids, session, cache, None, genome_data))
+    try:
+        output = compute_subsystems(output_file, output_dir, records, query_dict, genome_data)
+    finally:
+        if records is not None:
+            remove_columnar_table(records['table'])
+    return write_system_output('Subsystems', output)
+
+# Computes the pathway and ec number tables from the pathway records with grouped distinct counts.
+# Pathways are listed in order of first appearance, ec numbers in order of first appearance within their pathway
+# Returns the pathway and ecnumber tsv text and the genome ids found
+def aggregate_pathways(pathway_df):
     pathway_header = 'annotation\tpathway_id\tpathway_name\tpathway_class\tgenome_count\tec_count\tgene_count\tgenome_ec\tec_conservation\tgene_conservation'
     ec_header = 'annotation\tpathway_id\tpathway_name\tpathway_class\tec_description\tec_number\tgenome_count\tec_count\tgene_count\tgenome_ec'
-    pathway_line_list.append(pathway_header)
-    ec_line_list.append(ec_header)
-    pathway_dict = {}
-    ec_dict = {}
-    unique_pathways = set()
-    unique_ecs = set()
-    unique_features = set()
-    unique_pathway_features = {} 
-    unique_pathway_ecs = {}
-    
-    pathway_query_data = []
-    required_fields = ['annotation','ec_description','ec_number','feature_id','genome_id','pathway_class','pathway_id','pathway_name','patric_id','product']
-    pathway_data_found = False
-    pathway_genomes_found = set()
-    pathway_table_header = None
-    for gids in chunker(genome_ids, 20):
-        base = "https://www.bv-brc.org/api/pathway/?http_download=true"
-        query = f"in(genome_id,({','.join(gids)}))&limit(2500000)&sort(+id)&eq(annotation,PATRIC)"
-        headers = {"accept":"application/json", "content-type":"application/rqlquery+x-www-form-urlencoded", "Authorization": session.headers['Authorization']}
-        
-        print('Query = {0}\nHeaders = {1}'.format(base+'&'+query,headers))
-        #accession       alt_locus_tag   annotation      date_inserted   date_modified   ec_description  ec_number       feature_id      genome_ec       genome_id       genome_name     id      owner   pathway_class   pathway_ec      pathway_id   pathway_name     patric_id       product public  refseq_locus_tag        sequence_id     taxon_id        _version_
-
-        result_header = True
-        current_header = None
-        all_data = json.loads(getQueryDataText(base,query,headers))
-        for line in all_data:
-            pathway_data_found = True
-            if result_header:
-                result_header = False
-                print(line)
-                current_header = line.keys()
-                if pathway_table_header is None or len(current_header) > len(pathway_table_header):
-                    pathway_table_header = current_header 
-                #pathway_query_data.append(line)
-                continue
-            #line = line.strip().replace('\"','').split('\t')
-            pathway_fields = line
-            #for idx,f in enumerate(line):
-            #    pathway_fields[pathway_table_header[idx]] = f
-            for field in required_fields:
-                if field not in pathway_fields:
-                    pathway_fields[field] = ''
-            pathway_query_data.append(pathway_fields)
-            try:
-                annotation = pathway_fields['annotation'] 
-                ec_description = pathway_fields['ec_description'] 
-                ec_number = pathway_fields['ec_number'] 
-                feature_id = pathway_fields['feature_id'] 
-                genome_id = pathway_fields['genome_id'] 
-                #genome_name = line[10].replace('\"','')
-                pathway_class =  pathway_fields['pathway_class'] 
-                pathway_id = pathway_fields['pathway_id'] 
-                pathway_name = pathway_fields['pathway_name'] 
-                patric_id = pathway_fields['patric_id'] 
-                product = pathway_fields['product'] 
-            except Exception as e:
-                sys.stderr.write(f'Error with the following line:\n{e}\n{line}\n')
-                continue
-            pathway_genomes_found.add(genome_id)
-            unique_pathways.add(pathway_id)
-            unique_ecs.add(ec_number)
-            #unique_features.add(patric_id)
-            '''
-            if pathway_id not in unique_pathway_features:
-                unique_pathway_features[pathway_id] = {} 
-            if 'gene' in pathway_fields:
-                pathway_gene = pathway_fields['gene']
-                if pathway_gene not in unique_pathway_features[pathway_id]: 
-                    unique_pathway_features[pathway_id][pathway_gene] = set()
-                unique_pathway_features[pathway_id][pathway_gene].add(genome_id)
-            '''
-            if pathway_id not in unique_pathway_ecs:
-                unique_pathway_ecs[pathway_id] = {}
-            if ec_number not in unique_pathway_ecs[pathway_id]:
-                unique_pathway_ecs[pathway_id][ec_number] = set()
-            unique_pathway_ecs[pathway_id][ec_number].add(genome_id)
-
-            # pathway data
-            if pathway_id not in pathway_dict:
-                pathway_dict[pathway_id] = {} 
-                pathway_dict[pathway_id]['annotation'] = annotation 
-                pathway_dict[pathway_id]['pathway_id'] = pathway_id
-                pathway_dict[pathway_id]['pathway_name'] = pathway_name
-                pathway_dict[pathway_id]['pathway_class'] = pathway_class
-                pathway_dict[pathway_id]['genome_count'] = set()
-                pathway_dict[pathway_id]['ec_count'] = set()
-                pathway_dict[pathway_id]['gene_count'] = set()
-                pathway_dict[pathway_id]['genome_ec'] = set() 
-            pathway_dict[pathway_id]['genome_count'].add(genome_id)
-            pathway_dict[pathway_id]['ec_count'].add(ec_number)
-            pathway_dict[pathway_id]['gene_count'].add(feature_id)
-            pathway_dict[pathway_id]['genome_ec'].add(genome_id+'_'+ec_number)
-            # ec data
-            #ec_header = 'annotation\tpathway_id\tpathway_name\tpathway_class\tproduct\tec_number\tgenome_count\tec_count\tgene_count\tgenome_ec'
-            if pathway_id not in ec_dict:
-                ec_dict[pathway_id] = {}
-            if ec_number not in ec_dict[pathway_id]:
-                ec_dict[pathway_id][ec_number] = {}
-                ec_dict[pathway_id][ec_number]['annotation'] = annotation
-                ec_dict[pathway_id][ec_number]['pathway_id'] = pathway_id
-                ec_dict[pathway_id][ec_number]['pathway_name'] = pathway_name
-                ec_dict[pathway_id][ec_number]['pathway_class'] = pathway_class
-                ec_dict[pathway_id][ec_number]['ec_description'] = ec_description 
-                ec_dict[pathway_id][ec_number]['ec_number'] = ec_number
-                ec_dict[pathway_id][ec_number]['genome_count'] = set()
-                ec_dict[pathway_id][ec_number]['ec_count'] = set()
-                ec_dict[pathway_id][ec_number]['gene_count'] = set()
-                ec_dict[pathway_id][ec_number]['genome_ec'] = set()
-            ec_dict[pathway_id][ec_number]['genome_count'].add(genome_id)
-            ec_dict[pathway_id][ec_number]['ec_count'].add(ec_number)
-            ec_dict[pathway_id][ec_number]['gene_count'].add(feature_id)
-            ec_dict[pathway_id][ec_number]['genome_ec'].add(genome_id+'_'+ec_number)
-
-    if not pathway_data_found:
-        return ({ 'success': False }) 
-
-    parsed_query_data = []
-    for line in pathway_query_data:
-        new_line = ''
-        for field in pathway_table_header:
-            if new_line != '':
-                new_line += '\t'
-            if field not in line:    
-                new_line += ' '
-            else:
-                value = line[field]
-                if not isinstance(value,str):
-                    value = str(value)
-                new_line += value 
-        parsed_query_data.append(new_line.split('\t'))
+    records = pathway_df[['annotation','pathway_id','pathway_name','pathway_class','ec_description','ec_number','feature_id','genome_id']].copy()
+    pathway_genomes_found = records['genome_id'].unique().tolist()
+    n_genomes = len(pathway_genomes_found)
+    records['row'] = np.arange(records.shape[0])
+    records['first_pathway'] = records.groupby('pathway_id', sort=False, observed=True)['row'].transform('min')
+    records['first_ec'] = records.groupby(['pathway_id','ec_number'], sort=False, observed=True)['row'].transform('min')
+
+    # pathway data
+    pathway_table = records.groupby('first_pathway').agg(
+        annotation=('annotation','first'),
+        pathway_id=('pathway_id','first'),
+        pathway_name=('pathway_name','first'),
+        pathway_class=('pathway_class','first'),
+        genome_count=('genome_id','nunique'),
+        ec_count=('ec_number','nunique'),
+        gene_count=('feature_id','nunique'))
+    # distinct genome and ec number pairs of each pathway
+    genome_ec = records[['pathway_id','genome_id','ec_number']].drop_duplicates().groupby('pathway_id', observed=True).size()
+    pathway_table['pathway_id'] = pathway_table['pathway_id'].astype(object)
+    pathway_table['genome_ec'] = pathway_table['pathway_id'].map(genome_ec)
+    pathway_table['ec_conservation'] = pathway_table['genome_ec'] / (pathway_table['ec_count'] * n_genomes) * 100.0
+    pathway_table['gene_conservation'] = pathway_table['gene_count'] / (pathway_table['ec_count'] * n_genomes)
+    pathway_line_list = [pathway_header]
+    for annotation, pathway_id, pathway_name, pathway_class, genome_count, ec_count, gene_count, genome_ec, ec_conservation, gene_conservation in zip(
+            *[pathway_table[column].tolist() for column in ['annotation','pathway_id','pathway_name','pathway_class','genome_count','ec_count','gene_count','genome_ec','ec_conservation','gene_conservation']]):
+        pathway_line = f'{annotation}\t{pathway_id}\t{pathway_name}\t{pathway_class}\t{genome_count}\t{ec_count}\t{gene_count}\t{genome_ec}\t{ec_conservation}\t{gene_conservation}'
+        pathway_line_list.append(pathway_line)
+
+    # ec data, each row has a single ec number so ec_count is 1 and genome_ec equals genome_count
+    ec_table = records.groupby(['first_pathway','first_ec']).agg(
+        annotation=('annotation','first'),
+        pathway_id=('pathway_id','first'),
+        pathway_name=('pathway_name','first'),
+        pathway_class=('pathway_class','first'),
+        ec_description=('ec_description','first'),
+        ec_number=('ec_number','first'),
+        genome_count=('genome_id','nunique'),
+        gene_count=('feature_id','nunique'))
+    ec_line_list = [ec_header]
+    for annotation, pathway_id, pathway_name, pathway_class, ec_description, ec_number, genome_count, gene_count in zip(
+            *[ec_table[column].tolist() for column in ['annotation','pathway_id','pathway_name','pathway_class','ec_description','ec_number','genome_count','gene_count']]):
+        ec_line = f'{annotation}\t{pathway_id}\t{pathway_name}\t{pathway_class}\t{ec_description}\t{ec_number}\t{genome_count}\t1\t{gene_count}\t{genome_count}'
+        ec_line_list.append(ec_line)
 
-    pathway_df = pd.DataFrame(parsed_query_data,columns=pathway_table_header)
-    gene_df = query_dict['feature']
+    return ('\n'.join(pathway_line_list), '\n'.join(ec_line_list), pathway_genomes_found)
+
+# Returns the pathways output of the parsed pathway records: writes the records tsv and
+# returns the tables json text with the runner result
+def compute_pathways(output_file, output_dir, records, query_dict):
+    if records is None:
+        return { 'result': { 'success': False } }
+    pathways_file = os.path.join(output_dir,output_file+'_pathways.tsv')
+    pathway_df = read_records_table(records['table'], PATHWAY_CATEGORY_FIELDS)
+    record_rows(pathway_df.shape[0])
+    gene_df = get_feature_df(query_dict)
 
     genes_output = pd.merge(gene_df.drop(return_columns_to_remove('pathways_genes',gene_df.columns.tolist()), axis=1),pathway_df,on=['genome_id','patric_id'],how='inner')
 
@@ -729,78 +785,7 @@ def run_pathways(genome_ids, query_dict, output_file, output_dir, genome_data, s
         genes_output['gene'] = genes_output['gene_x']
         genes_output.drop(['gene_x','gene_y'],inplace=True,axis=1)
 
-    for idx in range(0,genes_output.shape[0]):
-        pathway_id = genes_output.iloc[idx].pathway_id
-        if pathway_id not in unique_pathway_features:
-            unique_pathway_features[pathway_id] = {}    
-        gene = genes_output.iloc[idx]['gene']
-        if gene is None or gene is np.nan:
-            continue
-        genome_id = genes_output.iloc[idx].genome_id
-        if gene not in unique_pathway_features[pathway_id]:
-            unique_pathway_features[pathway_id][gene] = set()
-        unique_pathway_features[pathway_id][gene].add(genome_id)
-        unique_features.add(gene)
-
-    # get gene data frame 
-    # get conservation stats and add lines
-    for pathway_id in pathway_dict:
-        pathway_dict[pathway_id]['genome_count'] = len(pathway_dict[pathway_id]['genome_count'])
-        pathway_dict[pathway_id]['ec_count'] = len(pathway_dict[pathway_id]['ec_count'])
-        pathway_dict[pathway_id]['gene_count'] = len(pathway_dict[pathway_id]['gene_count'])
-        pathway_dict[pathway_id]['genome_ec'] = len(pathway_dict[pathway_id]['genome_ec'])
-        #pathway_dict[pathway_id]['ec_conservation'] = float(len(unique_pathway_ecs[pathway_id]))/float(len(unique_ecs))*100.0
-        #pathway_dict[pathway_id]['gene_conservation'] = float(len(unique_pathway_features[pathway_id]))/float(len(unique_features))*100.0
-        annotation = pathway_dict[pathway_id]['annotation']
-        pathway_id = pathway_dict[pathway_id]['pathway_id']
-        pathway_name = pathway_dict[pathway_id]['pathway_name']
-        pathway_class = pathway_dict[pathway_id]['pathway_class']
-        genome_count = pathway_dict[pathway_id]['genome_count']
-        ec_count = pathway_dict[pathway_id]['ec_count']
-        gene_count = pathway_dict[pathway_id]['gene_count']
-        genome_ec = pathway_dict[pathway_id]['genome_ec']
-        # calculate ec_conservation score
-        ec_numerator = 0
-        ec_denominator = 0
-        for ec_number in unique_pathway_ecs[pathway_id]:
-            ec_numerator += len(unique_pathway_ecs[pathway_id][ec_number])
-            ec_denominator += len(pathway_genomes_found)
-        #ec_numerator = float(ec_numerator) * float(len(pathway_genomes_found))
-        #ec_denominator = float(ec_denominator) * float(len(pathway_genomes_found))
-        if ec_denominator == 0:
-            ec_conservation = 0
-        else:
-            ec_conservation = float(ec_numerator) / float(ec_denominator) * 100.0
-        # calculate gene_conservation
-        gene_numerator = gene_count
-        gene_denominator = ec_count*len(pathway_genomes_found)
-        if gene_denominator == 0:
-            gene_conservation = 0
-        else:
-            gene_conservation = float(gene_numerator) / float(gene_denominator)
-        pathway_line = f'{annotation}\t{pathway_id}\t{pathway_name}\t{pathway_class}\t{genome_count}\t{ec_count}\t{gene_count}\t{genome_ec}\t{ec_conservation}\t{gene_conservation}'
-        pathway_line_list.append(pathway_line)
-        # now EC data
-        for ec_number in ec_dict[pathway_id]:
-            ec_dict[pathway_id][ec_number]['genome_count'] = len(ec_dict[pathway_id][ec_number]['genome_count'])
-            ec_dict[pathway_id][ec_number]['ec_count'] = len(ec_dict[pathway_id][ec_number]['ec_count'])
-            ec_dict[pathway_id][ec_number]['gene_count'] = len(ec_dict[pathway_id][ec_number]['gene_count'])
-            ec_dict[pathway_id][ec_number]['genome_ec'] = len(ec_dict[pathway_id][ec_number]['genome_ec'])
-            annotation = ec_dict[pathway_id][ec_number]['annotation']
-            pathway_id = ec_dict[pathway_id][ec_number]['pathway_id']
-            pathway_name = ec_dict[pathway_id][ec_number]['pathway_name']
-            pathway_class = ec_dict[pathway_id][ec_number]['pathway_class']
-            ec_description = ec_dict[pathway_id][ec_number]['ec_description']
-            ec_number = ec_dict[pathway_id][ec_number]['ec_number']
-            genome_count = ec_dict[pathway_id][ec_number]['genome_count']
-            ec_count = ec_dict[pathway_id][ec_number]['ec_count']
-            gene_count = ec_dict[pathway_id][ec_number]['gene_count']
-            genome_ec = ec_dict[pathway_id][ec_number]['genome_ec']
-            ec_line = f'{annotation}\t{pathway_id}\t{pathway_name}\t{pathway_class}\t{ec_description}\t{ec_number}\t{genome_count}\t{ec_count}\t{gene_count}\t{genome_ec}'
-            ec_line_list.append(ec_line)
-
-    pathway_output = '\n'.join(pathway_line_list)
-    ec_output = '\n'.join(ec_line_list)
+    pathway_output, ec_output, pathway_genomes_found = aggregate_pathways(pathway_df)
 
     output_json = {}
     output_json['pathway'] = pathway_output
@@ -812,33 +797,48 @@ def run_pathways(genome_ids, query_dict, output_file, output_dir, genome_data, s
     pathway_df.to_csv(pathways_file,sep='\t',index=False)
 
     output_json_file = pathways_file.replace('.tsv','_tables.json')
-    with open(output_json_file,"w") as o:
-        o.write(json.dumps(output_json))
-
-    print("Pathways Complete")
     pathway_success_json = {
         'genomes': list(pathway_genomes_found),
         'success': True
     }
-    return pathway_success_json
+    return {
+        'files': { output_json_file: json.dumps(output_json) },
+        'result': pathway_success_json
+    }
+
+def run_pathways(genome_ids, query_dict, output_file, output_dir, genome_data, session, cache=None):
+    print('starting pathways') 
+    records = parse_system_records('pathway', output_dir, fetch_system_records('pathway', genome_ids, session, cache, None, genome_data))
+    try:
+        output = compute_pathways(output_file, output_dir, records, query_dict)
+    finally:
+        if records is not None:
+            remove_columnar_table(records['table'])
+    return write_system_output('Pathways', output)
 
 def generate_report(genome_ids, pathway_obj, subsystems_obj, proteinfams_obj, output_dir):
     report_text_list = []
-    if pathway_obj['success']:
+    if pathway_obj.get('skipped'):
+        report_text_list.append('Pathways skipped: not in recipe')
+    elif pathway_obj['success']:
         report_text_list.append(f"Pathways succeded: {len(pathway_obj['genomes'])} out of {len(genome_ids)} genomes had pathway data") 
         if len(pathway_obj['genomes']) != len(genome_ids):
             missing_pathway_genomes = list(set(genome_ids).difference(set(pathway_obj['genomes'])))
             report_text_list.append(f"Genomes Missing from Pathways: {','.join(missing_pathway_genomes)}")
     else:
         report_text_list.append('Pathways Failed: see stdout and stderr')
-    if subsystems_obj['success']:
+    if subsystems_obj.get('skipped'):
+        report_text_list.append('Subsystems skipped: not in recipe')
+    elif subsystems_obj['success']:
         report_text_list.append(f"Subsystems succeeded: {len(subsystems_obj['genomes'])} out of {len(genome_ids)} genomes had subsystems data")
         if len(subsystems_obj['genomes']) != len(genome_ids):
             missing_subsystems_genomes = list(set(genome_ids).difference(set(subsystems_obj['genomes'])))
             report_text_list.append(f"Genomes Missing from Subsystems: {','.join(missing_subsystems_genomes)}")
     else:
         report_text_list.append('Subsystems Failed: see stdout and stderr')
-    if proteinfams_obj['success']:
+    if proteinfams_obj.get('skipped'):
+        report_text_list.append('ProteinFamilies skipped: not in recipe')
+    elif proteinfams_obj['success']:
         report_text_list.append(f"ProteinFamilies succeeded: {len(proteinfams_obj['genomes'])} out of {len(genome_ids)} genomes had proteinfamilies data")
         if len(proteinfams_obj['genomes']) != len(genome_ids):
             missing_proteinfams_genomes = list(set(genome_ids).difference(set(proteinfams_obj['genomes'])))
@@ -851,80 +851,252 @@ def generate_report(genome_ids, pathway_obj, subsystems_obj, proteinfams_obj, ou
         o.write(report_text)
     
 
+# Returns the feature table of query_dict, either the DataFrame itself or the
+# memory mapped table written by share_feature_table
+def get_feature_df(query_dict, columns=None):
+    if 'feature' in query_dict:
+        feature_df = query_dict['feature']
+        return feature_df if columns is None else feature_df[[c for c in columns if c in feature_df.columns]]
+    if 'feature_table' in query_dict:
+        return read_columnar_table(query_dict['feature_table'], columns)
+    return None
+
+# Returns the feature table columns the systems of the recipe read
+# subsystems report every feature column with its genes, pathways all but the dropped ones
+def get_recipe_feature_columns(recipe, columns):
+    if 'SUBSYSTEMS' in recipe:
+        return list(columns)
+    keep_columns = set()
+    if 'PATHWAYS' in recipe:
+        keep_columns.update(set(columns).difference(return_columns_to_remove('pathways_genes',columns)))
+    if 'FAMILIES' in recipe:
+        keep_columns.update(FAMILY_FEATURE_COLUMNS)
+    return [c for c in columns if c in keep_columns]
+
+# Writes the columns of the feature table of query_dict read by the recipe to a columnar
+# file under table_dir, so the worker processes map it instead of each receiving a pickled copy
+# Returns a query dict referring to the shared table
+def share_feature_table(table_dir, recipe, query_dict):
+    feature_df = query_dict['feature']
+    feature_df = feature_df[get_recipe_feature_columns(recipe, feature_df.columns.tolist())]
+    record_rows(feature_df.shape[0])
+    return { 'feature_table': write_columnar_table(feature_df, table_dir, prefix='.feature_table_') }
+
+# Columns of the genome_feature tsv download and the feature table fields they hold,
+# in the column order of the feature table
+FEATURE_COLUMN_MAP = {
+    'Genome': 'genome_name',
+    'Genome ID': 'genome_id',
+    'Accession': 'accession',
+    'BRC ID': 'patric_id',
+    'RefSeq Locus Tag': 'refseq_locus_tag',
+    'Alt Locus Tag': 'alt_locus_tag',
+    'Feature ID': 'feature_id',
+    'Annotation': 'annotation',
+    'Feature Type': 'feature_type',
+    'Start': 'start',
+    'End': 'end',
+    'Length': 'length',
+    'Strand': 'strand',
+    'FIGfam ID': 'figfam_id',
+    'PATRIC genus-specific families (PLfams)': 'plfam_id',
+    'PATRIC cross-genus families (PGfams)': 'pgfam_id',
+    'Protein ID': 'protein_id',
+    'AA Length': 'aa_length',
+    'Gene Symbol': 'gene',
+    'Product': 'product',
+    'GO': 'go'
+}
+FEATURE_FIELDS = list(FEATURE_COLUMN_MAP.values())
+# Feature fields parsed as numbers, the others are kept as text, genome ids included
+FEATURE_NUMERIC_FIELDS = ['start','end','length','aa_length']
+
+# Runs the features query for the feature fields the systems of the recipe read,
+# raising an error when it returns no table
+def fetch_feature_table(genome_ids, session, checkpoint=None, recipe=None, genome_data=None):
+    fields = None if recipe is None else get_recipe_feature_columns(recipe, FEATURE_FIELDS)
+    query_dict = run_feature_queries(genome_ids, session, checkpoint, fields, genome_data)
+    if not query_dict:
+        raise ValueError('features query returned no table')
+    return query_dict
+
+# Genomes per unit of the features query, units are checkpointed and shards hold whole units
+FEATURE_CHUNK_SIZE = 100
+# Uncompressed tsv bytes per CDS and feature field the features query is planned with until measured
+FEATURE_BYTES_PER_CDS_FIELD = 16
+
+# Fetches the fields of the PATRIC features of a list of genome ids from the tsv download
+# Returns a DataFrame with a column per field, None when no features were found
+def fetch_feature_frame(gids, api_session, fields):
+    query = f"in(genome_id,({','.join(gids)}))&limit(2500000)&sort(+feature_id)&eq(annotation,PATRIC)&select({','.join(fields)})"
+    text_data = '\n'.join(query_api_lines(api_session,'genome_feature',query,accept="text/tsv",print_query=False))
+    feature_df = pd.read_csv(io.StringIO(text_data),sep='\t',dtype=str)
+    if feature_df.shape[0] == 0:
+        return None
+    # the download names columns by field or by display name
+    feature_df.rename(columns=FEATURE_COLUMN_MAP, inplace=True)
+    for field in FEATURE_NUMERIC_FIELDS:
+        if field in feature_df.columns:
+            feature_df[field] = pd.to_numeric(feature_df[field], errors='coerce')
+    return feature_df.reindex(columns=fields)
+
+# Splits a features query frame by unit
+def split_feature_frame(feature_df, unit_of_genome):
+    if feature_df is None:
+        return {}
+    units = feature_df['genome_id'].map(unit_of_genome)
+    return {unit_index: unit_df for unit_index, unit_df in feature_df.groupby(units, sort=False)}
+
+# Joins the frames of a unit, the frames of a split unit are sorted by feature_id like a single query.
+# feature_id starts with the genome id, without it the genomes are put in that order
+def merge_feature_frames(feature_dfs):
+    if len(feature_dfs) == 0:
+        return None
+    if len(feature_dfs) == 1:
+        return feature_dfs[0].reset_index(drop=True)
+    feature_df = pd.concat(feature_dfs, ignore_index=True)
+    if 'feature_id' in feature_df.columns:
+        feature_df = feature_df.sort_values('feature_id', kind='stable', ignore_index=True)
+    else:
+        feature_df = feature_df.sort_values('genome_id', key=lambda genome_ids: genome_ids + '.', kind='stable', ignore_index=True)
+    return feature_df
+
 # Store pathways, subsystems, and features queries in a dictionary
-def run_feature_queries(genome_ids, session):
+# fields: genome_feature fields of the feature table, all feature fields when None
+# genome_data: optional genome data, the CDS counts size the queries
+def run_feature_queries(genome_ids, session, checkpoint=None, fields=None, genome_data=None):
     query_dict = {}
+    if fields is None:
+        fields = FEATURE_FIELDS
     ### Run features query
     if True:
         print('features query')
         try:
-            feature_df = getFeatureDataFrame(genome_ids,session, limit=2500000)
+            fetch_workers = get_fetch_workers()
+            api_session = create_api_session(session, fetch_workers)
+            # query in units so a resumed job only repeats the units it had not finished
+            namespace = get_fields_namespace('genome_feature', fields)
+            planner = ChunkPlanner.from_env(get_genome_weights(genome_data), FEATURE_BYTES_PER_CDS_FIELD * len(fields))
+            fetch_chunk = lambda gids: fetch_feature_frame(gids, api_session, fields)
+            feature_units = fetch_genome_units(genome_ids, FEATURE_CHUNK_SIZE, planner, fetch_chunk, split_feature_frame, merge_feature_frames, checkpoint, namespace, fetch_workers)
+            feature_dfs = [df for unit_ids, df in feature_units if df is not None]
+            feature_df = pd.concat(feature_dfs, ignore_index=True) if len(feature_dfs) > 0 else None
+            record_rows(sum(df.shape[0] for df in feature_dfs))
+            print(f'genome_feature: {len(genome_ids)} genomes queried in {planner.chunks} chunks')
         except Exception as e:
             print(f'Error running features query:\n{e}\n')
             return None
         if not feature_df is None:
-            column_map = {
-                'Genome': 'genome_name',
-                'Genome ID': 'genome_id',
-                'Accession': 'accession',
-                'BRC ID': 'patric_id',
-                'RefSeq Locus Tag': 'refseq_locus_tag',
-                'Alt Locus Tag': 'alt_locus_tag',
-                'Feature ID': 'feature_id',
-                'Annotation': 'annotation',
-                'Feature Type': 'feature_type',
-                'Start': 'start',
-                'End': 'end',
-                'Length': 'length',
-                'Strand': 'strand',
-                'FIGfam ID': 'figfam_id',
-                'PATRIC genus-specific families (PLfams)': 'plfam_id',
-                'PATRIC cross-genus families (PGfams)': 'pgfam_id',
-                'Protein ID': 'protein_id',
-                'AA Length': 'aa_length',
-                'Gene Symbol': 'gene',
-                'Product': 'product',
-                'GO': 'go'
-            }
-            if 'Genome ID' in feature_df.columns:
-                feature_df.rename(columns=column_map, inplace=True)
-            feature_df['plfam_index'] = feature_df['plfam_id']
-            feature_df['pgfam_index'] = feature_df['pgfam_id']
+            if 'plfam_id' in feature_df.columns:
+                feature_df['plfam_index'] = feature_df['plfam_id']
+            if 'pgfam_id' in feature_df.columns:
+                feature_df['pgfam_index'] = feature_df['pgfam_id']
             #feature_df.set_index('plfam_index', inplace=True)
             query_dict['feature'] = feature_df
         else:
             sys.stderr.write('Features dataframe is None\n')
     return query_dict
 
+# Fetches the genome table of the genomes from the tsv download of the genome endpoint,
+# columns keep the names of the download ('Genome ID', 'Genome Name', 'CDS', ...)
+def fetch_genome_data(genome_ids, session):
+    fetch_workers = get_fetch_workers()
+    api_session = create_api_session(session, fetch_workers)
+    def fetch_genome_chunk(gids):
+        query = f"in(genome_id,({','.join(gids)}))&limit(2500000)&sort(+genome_id)"
+        return list(query_api_lines(api_session,'genome',query,accept="text/tsv",print_query=False))
+    lines = []
+    for chunk_lines in fetch_chunks(fetch_genome_chunk, list(chunker(genome_ids, MAX_CHUNK_GENOMES)), fetch_workers):
+        # the chunks are parsed as one table so every column gets a single type, each repeats the header
+        lines += chunk_lines[1:] if len(lines) > 0 else chunk_lines
+    genome_data = pd.read_csv(io.StringIO('\n'.join(lines)),sep='\t',dtype={'Genome ID': str})
+    record_rows(genome_data.shape[0])
+    # counted like the estimate counts them
+    genome_cds = get_genome_weights(genome_data)
+    record_cds(int(sum(genome_cds.get(gid, DEFAULT_GENOME_CDS) for gid in genome_ids)))
+    return genome_data
+
+# Returns the genome ids of every group in order with the group of each id. Groups are
+# resolved concurrently, groups found in the genome group cache are not resolved again
 def get_genome_group_ids(group_list,session):
+    cache = GenomeGroupCache.from_env()
+    authorization = session.headers.get('Authorization', '')
+    def resolve_group(genome_group):
+        if cache is not None:
+            genome_id_list = cache.get(genome_group, authorization)
+            if genome_id_list is not None:
+                return genome_id_list
+        genome_id_list = getGenomeIdsByGenomeGroup(genome_group,session,genomeGroupPath=True)
+        # an empty group may be a failed lookup, it is not kept
+        if cache is not None and len(genome_id_list) > 0:
+            cache.put(genome_group, authorization, genome_id_list)
+        return genome_id_list
     genome_group_ids = []
     genome_group_list = []
-    for genome_group in group_list:
-        genome_id_list = getGenomeIdsByGenomeGroup(genome_group,session,genomeGroupPath=True)
-        genome_group_ids = genome_group_ids + genome_id_list
-        genome_group_list += [genome_group]*len(genome_id_list)
+    for genome_group, genome_id_list in zip(group_list, fetch_chunks(resolve_group, group_list, get_fetch_workers())):
+        genome_group_ids.extend(genome_id_list)
+        genome_group_list.extend([genome_group]*len(genome_id_list))
+    if cache is not None:
+        print(f"genome group cache: {cache.hits} groups found, {cache.misses} resolved")
+        cache.evict()
     return (genome_group_ids,genome_group_list)
 
-def run_compare_systems(job_data, output_dir):
+# Systems that can be requested in the job recipe
+RECIPE_SYSTEMS = ['PATHWAYS','SUBSYSTEMS','FAMILIES']
 
-    ###Setup session
-    s = requests.Session()
-    authenticateByEnv(s)
+# Returns the systems requested by the job, all of them when the recipe is missing or empty
+def get_recipe(job_data):
+    recipe = [system.upper() for system in job_data.get('recipe') or RECIPE_SYSTEMS]
+    for system in recipe:
+        if system not in RECIPE_SYSTEMS:
+            sys.stderr.write(f'Ignoring unknown recipe entry {system}, expected one of {",".join(RECIPE_SYSTEMS)}\n')
+    return [system for system in RECIPE_SYSTEMS if system in recipe]
 
-    output_dir = os.path.abspath(output_dir)
-    if not os.path.exists(output_dir):
-        subprocess.call(["mkdir", "-p", output_dir])
-    output_file = job_data["output_file"]
+# Returns the key identifying the inputs of a job: its genomes, systems, options changing
+# the outputs and the data version
+def get_job_key(genome_ids, recipe, job_data):
+    job_inputs = {
+        'genome_ids': sorted(genome_ids),
+        'recipe': recipe,
+        'output_file': job_data['output_file'],
+        'family_matrix': job_data.get('family_matrix', False),
+        'data_version': os.environ.get(DATA_VERSION_ENV, '')
+    }
+    return hashlib.sha1(json.dumps(job_inputs, sort_keys=True).encode()).hexdigest()
 
+# Returns the key of the outputs of a job in the result cache: the genomes, systems, options
+# and data version, plus the genome groups of each genome that the families tables list.
+# Outputs of private genomes are only shared between jobs of the same authorization
+def get_result_key(genome_ids, recipe, job_data, genome_group_dict, authorization):
+    job_inputs = {
+        'authorization': authorization,
+        'genome_ids': sorted(genome_ids),
+        'recipe': recipe,
+        'family_matrix': job_data.get('family_matrix', False),
+        'data_version': os.environ.get(DATA_VERSION_ENV, '')
+    }
+    if 'FAMILIES' in recipe:
+        job_inputs['genome_groups'] = sorted(genome_group_dict.items())
+    return hashlib.sha1(json.dumps(job_inputs, sort_keys=True).encode()).hexdigest()
 
-    print("Run ComparativeSystems:\njob_data = {0}".format(job_data)) 
-    print("output_dir = {0}".format(output_dir)) 
-    
+# Returns the output files of a job in output_dir
+def get_output_files(output_dir, output_file):
+    output_files = [f for f in os.listdir(output_dir) if f.startswith(output_file + '_') and os.path.isfile(os.path.join(output_dir, f))]
+    return sorted(output_files) + ['report.txt']
+
+# Records the result of a system whose outputs are written, a resumed job does not run it again
+def save_system_result(checkpoint, system, result):
+    checkpoint.save('systems', system, result)
+    return result
+
+# Resolves the genome groups of the job
+# Returns the unique genome ids and the genome group names of each genome
+def get_job_genomes(job_data, session):
     # TODO: Testing adding genome groups to genomeData
     genome_ids = job_data["genome_ids"]
     genome_group_list = ['None']*len(genome_ids)
     if len(job_data["genome_groups"]) > 0:
-        genome_group_ids, curr_genome_group_list = get_genome_group_ids(job_data["genome_groups"],s)
+        genome_group_ids, curr_genome_group_list = get_genome_group_ids(job_data["genome_groups"],session)
         if len(genome_group_ids) == 0:
             sys.stderr.write('FAILED to get genome ids for genome groups: exiting')
             sys.exit(-1)
@@ -932,21 +1104,303 @@ def run_compare_systems(job_data, output_dir):
         genome_ids = genome_ids + genome_group_ids
         genome_group_list += curr_genome_group_list
 
-    # create genome group dictionary
-    genome_group_dict = {}
-    for idx,gi in enumerate(genome_ids):
-        gg = os.path.basename(genome_group_list[idx])
-        if gi in genome_group_dict:
-            genome_group_dict[gi] = genome_group_dict[gi] + ',' + gg 
-        else:
-            genome_group_dict[gi] = gg
+    # create genome group dictionary: the groups of each genome in order, comma separated
+    genome_groups = {}
+    for gi, genome_group in zip(genome_ids, genome_group_list):
+        genome_groups.setdefault(gi, []).append(os.path.basename(genome_group))
+    genome_group_dict = {gi: ','.join(groups) for gi, groups in genome_groups.items()}
+
+    # unique genome ids in order of first appearance, chunks of a resumed job must match
+    genome_ids = list(dict.fromkeys(genome_ids))
+    return (genome_ids, genome_group_dict)
 
-    genome_ids = list(set(genome_ids))
+# Adds the stages querying the genomes and parsing the results into the tables that the
+# output stages read: genome_data, features.share and <system>.parse
+# prefix: optional prefix of the stage names
+# feature_recipe: systems whose feature columns are queried, the systems when None. A resumed
+# job queries the columns of its whole recipe so the features checkpoint still applies
+def add_fetch_stages(scheduler, systems, genome_ids, session, cache, checkpoint, table_dir, prefix='', feature_recipe=None):
     # optionally add more genome info to output 
-    genome_data = getDataForGenomes(genome_ids,s) 
+    scheduler.add_stage(prefix+'genome_data', fetch_genome_data, args=(genome_ids, session))
+    scheduler.add_stage(prefix+'features.fetch', fetch_feature_table, args=(genome_ids, session, checkpoint, feature_recipe or systems), deps=[prefix+'genome_data'])
+    scheduler.add_stage(prefix+'features.share', share_feature_table, args=(table_dir, systems), deps=[prefix+'features.fetch'])
+    if 'PATHWAYS' in systems:
+        scheduler.add_stage(prefix+'pathways.fetch', fetch_system_records, args=('pathway', genome_ids, session, cache, checkpoint), deps=[prefix+'genome_data'])
+        scheduler.add_stage(prefix+'pathways.parse', parse_system_records, args=('pathway', table_dir), deps=[prefix+'pathways.fetch'])
+    if 'SUBSYSTEMS' in systems:
+        scheduler.add_stage(prefix+'subsystems.fetch', fetch_system_records, args=('subsystem', genome_ids, session, cache, checkpoint), deps=[prefix+'genome_data'])
+        scheduler.add_stage(prefix+'subsystems.parse', parse_system_records, args=('subsystem', table_dir), deps=[prefix+'subsystems.fetch'])
+    if 'FAMILIES' in systems:
+        scheduler.add_stage(prefix+'families.fetch', fetch_family_frames, args=(genome_ids, session, cache, checkpoint), deps=[prefix+'features.fetch', prefix+'genome_data'])
+        scheduler.add_stage(prefix+'families.parse', parse_family_frames, args=(table_dir,), deps=[prefix+'families.fetch'])
 
-    query_dict = run_feature_queries(genome_ids, s)
-    if not query_dict:
+# Adds the stages computing and writing the outputs of the systems from the parsed tables,
+# the result of each system is kept under the system name
+def add_output_stages(scheduler, systems, genome_ids, genome_group_dict, job_data, output_dir, session, checkpoint):
+    output_file = job_data["output_file"]
+    if 'PATHWAYS' in systems:
+        scheduler.add_stage('pathways.aggregate', compute_pathways, args=(output_file, output_dir), deps=['pathways.parse', 'features.share'], kind='cpu')
+        scheduler.add_stage('pathways.write', write_system_output, args=('Pathways',), deps=['pathways.aggregate'])
+        scheduler.add_stage('PATHWAYS', save_system_result, args=(checkpoint, 'PATHWAYS'), deps=['pathways.write'], keep=True)
+    if 'SUBSYSTEMS' in systems:
+        scheduler.add_stage('subsystems.aggregate', compute_subsystems, args=(output_file, output_dir), deps=['subsystems.parse', 'features.share', 'genome_data'], kind='cpu')
+        scheduler.add_stage('subsystems.write', write_system_output, args=('Subsystems',), deps=['subsystems.aggregate'])
+        scheduler.add_stage('SUBSYSTEMS', save_system_result, args=(checkpoint, 'SUBSYSTEMS'), deps=['subsystems.write'], keep=True)
+    if 'FAMILIES' in systems:
+        matrix_file = get_family_matrix_file(output_file, output_dir, job_data.get('family_matrix', False))
+        scheduler.add_stage('families.aggregate', aggregate_family_tables, args=(genome_ids, matrix_file), deps=['families.parse', 'genome_data'], kind='cpu')
+        scheduler.add_stage('families.products', fetch_family_products, args=(session, checkpoint), deps=['families.aggregate'])
+        scheduler.add_stage('families.write', write_families, args=(output_file, output_dir, genome_group_dict), deps=['genome_data', 'families.aggregate', 'families.products'])
+        scheduler.add_stage('FAMILIES', save_system_result, args=(checkpoint, 'FAMILIES'), deps=['families.write'], keep=True)
+
+# Returns the results of the systems completed by a previous run of the job
+def load_system_results(checkpoint, recipe):
+    system_results = {}
+    for system in recipe:
+        system_result = checkpoint.load('systems', system)
+        if system_result is not None:
+            print(f'{system} completed by a previous run')
+            system_results[system] = system_result
+    return system_results
+
+def write_job_report(recipe, genome_ids, system_results, output_dir):
+    skipped = { 'success': False, 'skipped': True }
+    failed = { 'success': False }
+    pathway_success = system_results.get('PATHWAYS', failed) if 'PATHWAYS' in recipe else skipped
+    subsystems_success = system_results.get('SUBSYSTEMS', failed) if 'SUBSYSTEMS' in recipe else skipped
+    proteinfams_success = system_results.get('FAMILIES', failed) if 'FAMILIES' in recipe else skipped
+    generate_report(genome_ids,pathway_success,subsystems_success,proteinfams_success,output_dir)
+
+# Writes the telemetry of the stages the scheduler ran to output_dir and returns the report lines summarizing it
+def write_job_telemetry(scheduler, output_dir):
+    telemetry_json = write_telemetry(output_dir, scheduler.telemetry, scheduler.start_time)
+    return summarize_telemetry(telemetry_json)
+
+# Appends the telemetry summary to the report of the job
+def append_report_lines(output_dir, report_lines):
+    with open(os.path.join(output_dir,'report.txt'),'a') as o:
+        o.write('\n' + '\n'.join(report_lines) + '\n')
+
+# Writes the manifest of a shard, its genome data and the names of the tables its stages
+# left in shard_dir. partials are the results of the parse stages of systems, in order
+def write_shard_partials(shard_dir, manifest, systems, genome_data, query_dict, *partials):
+    manifest = dict(manifest, recipe=systems, data_version=os.environ.get(DATA_VERSION_ENV, ''))
+    genome_data.to_pickle(os.path.join(shard_dir, 'genome_data.pkl'))
+    manifest['genome_data'] = 'genome_data.pkl'
+    manifest['features'] = os.path.basename(query_dict['feature_table'])
+    manifest['records'] = {}
+    for system, partial in zip(systems, partials):
+        if system == 'FAMILIES':
+            manifest['families'] = {
+                'plfam': os.path.basename(partial['plfam']),
+                'pgfam': os.path.basename(partial['pgfam']),
+                'genome_ids': sorted(partial['genome_ids'])
+            }
+        elif partial is None:
+            manifest['records'][system] = None
+        else:
+            manifest['records'][system] = { 'table': os.path.basename(partial['table']), 'header': partial['header'] }
+    write_shard_manifest(shard_dir, manifest)
+    return dict(manifest, shard_dir=shard_dir)
+
+# Stages reading the partials of the shards. genome_ids optionally restricts them to the given
+# genomes, with the rows in the order a job of these genomes queries them
+def load_shard_genome_data(manifests, genome_ids=None):
+    genome_data = pd.concat([pd.read_pickle(os.path.join(m['shard_dir'], m['genome_data'])) for m in manifests], ignore_index=True)
+    if genome_ids is not None:
+        genome_data = genome_data[genome_data['Genome ID'].isin(genome_ids)]
+        genome_data = sort_unit_rows(genome_data, genome_ids, MAX_CHUNK_GENOMES, 'Genome ID', genome_column='Genome ID')
+    return genome_data
+
+def merge_shard_features(table_dir, manifests, genome_ids=None):
+    feature_tables = [os.path.join(m['shard_dir'], m['features']) for m in manifests]
+    return { 'feature_table': concat_columnar_tables(feature_tables, table_dir, prefix='.feature_table_', genome_ids=genome_ids, unit_size=FEATURE_CHUNK_SIZE) }
+
+# Concatenates the records tables of the shards with the columns an unsharded job gets:
+# the widest record header followed by the missing required fields
+def merge_shard_records(endpoint, system, table_dir, manifests, genome_ids=None):
+    shard_records = [(m['shard_dir'], m['records'][system]) for m in manifests if m['records'][system] is not None]
+    if len(shard_records) == 0:
+        return None
+    table_header = None
+    for shard_dir, records in shard_records:
+        if table_header is None or len(records['header']) > len(table_header):
+            table_header = records['header']
+    columns = table_header + [field for field in SYSTEM_REQUIRED_FIELDS[endpoint] if field not in table_header]
+    records_tables = [os.path.join(shard_dir, records['table']) for shard_dir, records in shard_records]
+    records_table = concat_columnar_tables(records_tables, table_dir, prefix=f'.{endpoint}_records_', columns=columns, genome_ids=genome_ids, unit_size=GENOME_UNIT_SIZE, sort_column='id')
+    if genome_ids is not None and read_columnar_table(records_table, ['genome_id']).shape[0] == 0:
+        remove_columnar_table(records_table)
+        return None
+    return { 'table': records_table, 'header': table_header }
+
+def merge_shard_family_partials(table_dir, manifests, genome_ids=None):
+    partial_tables = {'genome_ids': set()}
+    for m in manifests:
+        partial_tables['genome_ids'].update(m['families']['genome_ids'])
+    if genome_ids is not None:
+        partial_tables['genome_ids'].intersection_update(genome_ids)
+    # the partials of a genome follow its rows in the feature table
+    for fam in ['plfam','pgfam']:
+        partial_tables[fam] = concat_columnar_tables([os.path.join(m['shard_dir'], m['families'][fam]) for m in manifests], table_dir, prefix=f'.{fam}_partials_', genome_ids=genome_ids, unit_size=FEATURE_CHUNK_SIZE)
+    return partial_tables
+
+# Parse stage of each system, its result is the partial table of the system
+PARSE_STAGES = {'PATHWAYS': 'pathways.parse', 'SUBSYSTEMS': 'subsystems.parse', 'FAMILIES': 'families.parse'}
+
+# Calls a merge stage on the summaries of the prior job and the partials of the added genomes,
+# keeping the genomes of the updated job in the order a full run of the job produces
+def merge_update_partials(merge_fn, merge_args, genome_ids, prior_manifest, *added_manifests):
+    return merge_fn(*merge_args, [prior_manifest] + list(added_manifests), genome_ids=genome_ids)
+
+# Adds the stages producing the tables read by the output stages from the summaries of a prior
+# job: only the genomes added since are queried, the rows of removed genomes are dropped
+def add_update_stages(scheduler, systems, genome_ids, prior_manifest, session, cache, checkpoint, table_dir, added_dir, feature_recipe=None):
+    prior_genome_ids = set(prior_manifest['genome_ids'])
+    added_genome_ids = [gid for gid in genome_ids if gid not in prior_genome_ids]
+    removed_count = len(prior_genome_ids.difference(genome_ids))
+    print(f'updating a job of {len(prior_genome_ids)} genomes: {len(added_genome_ids)} added, {removed_count} removed')
+    deps = []
+    if len(added_genome_ids) > 0:
+        add_fetch_stages(scheduler, systems, added_genome_ids, session, cache, checkpoint, added_dir, prefix='added.', feature_recipe=feature_recipe)
+        added_manifest = { 'genome_ids': added_genome_ids }
+        scheduler.add_stage('added.write', write_shard_partials, args=(added_dir, added_manifest, systems),
+            deps=['added.genome_data', 'added.features.share'] + ['added.' + PARSE_STAGES[system] for system in systems])
+        deps = ['added.write']
+    scheduler.add_stage('genome_data', merge_update_partials, args=(load_shard_genome_data, (), genome_ids, prior_manifest), deps=deps)
+    scheduler.add_stage('features.share', merge_update_partials, args=(merge_shard_features, (table_dir,), genome_ids, prior_manifest), deps=deps)
+    if 'PATHWAYS' in systems:
+        scheduler.add_stage('pathways.parse', merge_update_partials, args=(merge_shard_records, ('pathway', 'PATHWAYS', table_dir), genome_ids, prior_manifest), deps=deps)
+    if 'SUBSYSTEMS' in systems:
+        scheduler.add_stage('subsystems.parse', merge_update_partials, args=(merge_shard_records, ('subsystem', 'SUBSYSTEMS', table_dir), genome_ids, prior_manifest), deps=deps)
+    if 'FAMILIES' in systems:
+        scheduler.add_stage('families.parse', merge_update_partials, args=(merge_shard_family_partials, (table_dir,), genome_ids, prior_manifest), deps=deps)
+
+def run_compare_systems(job_data, output_dir):
+
+    ###Setup session
+    s = requests.Session()
+    authenticateByEnv(s)
+
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.exists(output_dir):
+        subprocess.call(["mkdir", "-p", output_dir])
+    output_file = job_data["output_file"]
+
+
+    print("Run ComparativeSystems:\njob_data = {0}".format(job_data)) 
+    print("output_dir = {0}".format(output_dir)) 
+
+    recipe = get_recipe(job_data)
+    if len(recipe) == 0:
+        sys.stderr.write('No valid systems in recipe: exiting\n')
+        sys.exit(-1)
+    print(f"recipe = {','.join(recipe)}")
+
+    genome_ids, genome_group_dict = get_job_genomes(job_data, s)
+    job_key = get_job_key(genome_ids, recipe, job_data)
+    # per-genome cache of api rows shared between jobs, disabled unless configured
+    cache = GenomeDataCache.from_env()
+    # outputs of whole jobs shared between jobs, disabled unless configured
+    result_cache = JobResultCache.from_env()
+    result_key = get_result_key(genome_ids, recipe, job_data, genome_group_dict, s.headers.get('Authorization', ''))
+    if result_cache is not None and not job_data.get('shard') and not job_data.get('keep_summaries'):
+        start_time = time.time()
+        cached_files, cache_telemetry = measure_stage('io', result_cache.get, (result_key, output_dir, output_file))
+        if cached_files is not None:
+            print(f'Outputs of job {result_key} found in result cache: {",".join(cached_files)}')
+            # the only stage of the job is the copy from the cache
+            telemetry_json = write_telemetry(output_dir, {'result_cache': dict(cache_telemetry, status='success')}, start_time)
+            append_report_lines(output_dir, summarize_telemetry(telemetry_json))
+            return
+
+    if job_data.get('shard'):
+        # only query and parse a block of the genomes, the partial tables are kept for the merge
+        shard, n_shards = parse_shard(job_data['shard'])
+        genome_ids = get_shard_genome_ids(genome_ids, shard, n_shards, FEATURE_CHUNK_SIZE)
+        print(f'shard {shard}/{n_shards}: {len(genome_ids)} genomes')
+        shard_dir = os.path.join(output_dir, f'{output_file}_shard_{shard}_of_{n_shards}')
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        os.makedirs(shard_dir)
+        manifest = { 'job_key': job_key, 'shard': shard, 'n_shards': n_shards, 'genome_ids': genome_ids }
+        if len(genome_ids) == 0:
+            # a job with fewer units of genomes than shards leaves shards empty, the merge
+            # still expects a manifest from every shard
+            write_shard_manifest(shard_dir, dict(manifest, recipe=recipe, data_version=os.environ.get(DATA_VERSION_ENV, '')))
+            print(f'Shard {shard}/{n_shards} has no genomes, empty manifest written to {shard_dir}')
+            return
+        checkpoint = JobCheckpoint(output_dir, f'{job_key}:{shard}/{n_shards}', resume=job_data.get('resume', False))
+        scheduler = StageScheduler(get_workers(job_data))
+        add_fetch_stages(scheduler, recipe, genome_ids, s, cache, checkpoint, shard_dir)
+        scheduler.add_stage('shard.write', write_shard_partials, args=(shard_dir, manifest, recipe), deps=['genome_data', 'features.share'] + [PARSE_STAGES[system] for system in recipe], keep=True)
+        stage_results, stage_failures = scheduler.run()
+        print_transfer_stats()
+        write_job_telemetry(scheduler, shard_dir)
+        if cache is not None:
+            cache.evict()
+        if len(stage_failures) > 0:
+            sys.stderr.write(f'Shard {shard}/{n_shards} failed: {",".join(stage_failures)}\n')
+            sys.exit(-1)
+        checkpoint.remove()
+        print(f'Shard {shard}/{n_shards} partials written to {shard_dir}')
+        return
+
+    # summaries of a previous run of the job, only the genomes added since are queried
+    prior_manifest = None
+    if job_data.get('update_from'):
+        try:
+            prior_manifest = read_summaries_manifest(job_data['update_from'])
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f'Error reading the summaries of the job to update:\n{e}\n')
+            sys.exit(-1)
+        missing_systems = [system for system in recipe if system not in prior_manifest['recipe']]
+        if len(missing_systems) > 0 or prior_manifest['data_version'] != os.environ.get(DATA_VERSION_ENV, ''):
+            sys.stderr.write(f'The job to update has no summaries of {",".join(missing_systems) or "this data version"}, run the full job: exiting\n')
+            sys.exit(-1)
+
+    # completed chunks and systems of this job, picked up again in resume mode
+    checkpoint = JobCheckpoint(output_dir, job_key, resume=job_data.get('resume', False))
+    system_results = load_system_results(checkpoint, recipe)
+    remaining = [system for system in recipe if system not in system_results]
+    # columnar tables handed between stages, kept as the summaries of the job when requested
+    table_dir = tempfile.mkdtemp(dir=output_dir, prefix='.compare_systems_')
+    # partials of the genomes added to the job being updated
+    added_dir = tempfile.mkdtemp(dir=output_dir, prefix='.compare_systems_') if prior_manifest is not None else None
+    keep_summaries = job_data.get('keep_summaries', False) and remaining == recipe
+    if job_data.get('keep_summaries', False) and not keep_summaries:
+        print('Not keeping summaries: systems completed by a previous run have no tables')
+
+    # each system is split into stages run as soon as their inputs are ready: the subsystem
+    # and pathway records are fetched while the features query runs, aggregations run on
+    # worker processes
+    scheduler = StageScheduler(get_workers(job_data))
+    if len(remaining) > 0:
+        if prior_manifest is None:
+            add_fetch_stages(scheduler, remaining, genome_ids, s, cache, checkpoint, table_dir, feature_recipe=recipe)
+        else:
+            add_update_stages(scheduler, remaining, genome_ids, prior_manifest, s, cache, checkpoint, table_dir, added_dir, feature_recipe=recipe)
+        add_output_stages(scheduler, remaining, genome_ids, genome_group_dict, job_data, output_dir, s, checkpoint)
+    if keep_summaries:
+        summaries_manifest = { 'job_key': job_key, 'shard': 0, 'n_shards': 1, 'genome_ids': genome_ids }
+        scheduler.add_stage('summaries.write', write_shard_partials, args=(table_dir, summaries_manifest, recipe), deps=['genome_data', 'features.share'] + [PARSE_STAGES[system] for system in recipe])
+    stage_results, stage_failures = scheduler.run()
+    telemetry_lines = write_job_telemetry(scheduler, output_dir)
+    if added_dir is not None:
+        shutil.rmtree(added_dir, ignore_errors=True)
+    system_results.update(stage_results)
+    if keep_summaries and len(stage_failures) == 0:
+        summaries_dir = os.path.join(output_dir, output_file + SUMMARIES_SUFFIX)
+        # a job updated in place replaces the summaries it started from
+        for previous_summaries in glob.glob(os.path.join(output_dir, '*' + SUMMARIES_SUFFIX)):
+            shutil.rmtree(previous_summaries, ignore_errors=True)
+        os.replace(table_dir, summaries_dir)
+        print(f'Summaries of {len(genome_ids)} genomes kept in {summaries_dir}')
+    else:
+        shutil.rmtree(table_dir, ignore_errors=True)
+    print(f'checkpoint: {checkpoint.loaded} chunks resumed, {checkpoint.saved} chunks saved')
+    print_transfer_stats()
+
+    if 'features.fetch' in stage_failures:
         sys.stderr.write('Error running features queries: terminating\n')
         report_text = 'Error running features queries: see stdout and stderr'
         report_file = os.path.join(output_dir,'report.txt')
@@ -954,16 +1408,103 @@ def run_compare_systems(job_data, output_dir):
             o.write(report_text)
         sys.exit(0)
 
-    # TODO: add multithreading
-    pool = multiprocessing.Pool(processes=3)
-    pathway_result = pool.apply_async(run_pathways, args = (genome_ids, query_dict, output_file, output_dir, genome_data, s))
-    subsystems_result = pool.apply_async(run_subsystems, args = (genome_ids, query_dict, output_file, output_dir, genome_data, s))
-    proteinfams_result = pool.apply_async(run_families, args = (genome_ids, query_dict, output_file, output_dir, genome_data, genome_group_dict, s))
+    # keep the checkpoint of a job with failed stages so it can be resumed
+    if len(stage_failures) == 0:
+        checkpoint.remove()
 
-    pathway_success = pathway_result.get()
-    subsystems_success = subsystems_result.get()
-    proteinfams_success = proteinfams_result.get()
-    pool.close()
-    pool.join()
+    if cache is not None:
+        cache.evict()
 
-    generate_report(genome_ids,pathway_success,subsystems_success,proteinfams_success,output_dir)
+    write_job_report(recipe, genome_ids, system_results, output_dir)
+
+    # the cached report has no timings of this run
+    if result_cache is not None and len(stage_failures) == 0:
+        result_cache.put(result_key, output_dir, output_file, get_output_files(output_dir, output_file))
+        result_cache.evict()
+    append_report_lines(output_dir, telemetry_lines)
+
+# Merges the partial tables written by the shards of a job into the outputs of the job
+def merge_compare_systems(job_data, output_dir, shard_dirs):
+
+    ###Setup session
+    s = requests.Session()
+    authenticateByEnv(s)
+
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.exists(output_dir):
+        subprocess.call(["mkdir", "-p", output_dir])
+
+    print("Merge ComparativeSystems:\njob_data = {0}".format(job_data)) 
+    print("output_dir = {0}".format(output_dir)) 
+
+    recipe = get_recipe(job_data)
+    if len(recipe) == 0:
+        sys.stderr.write('No valid systems in recipe: exiting\n')
+        sys.exit(-1)
+
+    genome_ids, genome_group_dict = get_job_genomes(job_data, s)
+    job_key = get_job_key(genome_ids, recipe, job_data)
+    try:
+        manifests = read_shard_manifests(shard_dirs, job_key)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f'Error reading shards:\n{e}\n')
+        sys.exit(-1)
+    # empty shards have no partial tables
+    manifests = [manifest for manifest in manifests if len(manifest['genome_ids']) > 0]
+
+    checkpoint = JobCheckpoint(output_dir, f'{job_key}:merge', resume=job_data.get('resume', False))
+    system_results = load_system_results(checkpoint, recipe)
+    remaining = [system for system in recipe if system not in system_results]
+    table_dir = tempfile.mkdtemp(dir=output_dir, prefix='.compare_systems_')
+
+    # the merged partials take the place of the fetch stages of an unsharded job
+    scheduler = StageScheduler(get_workers(job_data))
+    if len(remaining) > 0:
+        scheduler.add_stage('genome_data', load_shard_genome_data, args=(manifests,))
+        scheduler.add_stage('features.share', merge_shard_features, args=(table_dir, manifests))
+        if 'PATHWAYS' in remaining:
+            scheduler.add_stage('pathways.parse', merge_shard_records, args=('pathway', 'PATHWAYS', table_dir, manifests))
+        if 'SUBSYSTEMS' in remaining:
+            scheduler.add_stage('subsystems.parse', merge_shard_records, args=('subsystem', 'SUBSYSTEMS', table_dir, manifests))
+        if 'FAMILIES' in remaining:
+            scheduler.add_stage('families.parse', merge_shard_family_partials, args=(table_dir, manifests))
+        add_output_stages(scheduler, remaining, genome_ids, genome_group_dict, job_data, output_dir, s, checkpoint)
+    stage_results, stage_failures = scheduler.run()
+    telemetry_lines = write_job_telemetry(scheduler, output_dir)
+    shutil.rmtree(table_dir, ignore_errors=True)
+    system_results.update(stage_results)
+
+    if len(stage_failures) == 0:
+        checkpoint.remove()
+
+    write_job_report(recipe, genome_ids, system_results, output_dir)
+    append_report_lines(output_dir, telemetry_lines)
+
+# Estimates the runtime and peak memory of a job from the size of its genomes without running it,
+# the estimate is written to estimate.json in output_dir
+def estimate_compare_systems(job_data, output_dir):
+
+    ###Setup session
+    s = requests.Session()
+    authenticateByEnv(s)
+
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.exists(output_dir):
+        subprocess.call(["mkdir", "-p", output_dir])
+
+    recipe = get_recipe(job_data)
+    if len(recipe) == 0:
+        sys.stderr.write('No valid systems in recipe: exiting\n')
+        sys.exit(-1)
+
+    genome_ids, genome_group_dict = get_job_genomes(job_data, s)
+    model = load_estimate_model()
+    # the ladder only reads the genome and CDS counts
+    stats = get_job_stats(genome_ids, s, sample_records=covers_recipe(model, recipe))
+    estimate = estimate_resources(stats, recipe, model)
+    with open(os.path.join(output_dir, ESTIMATE_FILE),'w') as o:
+        json.dump(estimate, o, indent=1)
+    for system, system_estimate in estimate['systems'].items():
+        print(f"{system}: {system_estimate['seconds']}s, {system_estimate['memory_mb']} MB")
+    print(f"Estimate for {len(genome_ids)} genomes, {estimate['stats']['cds']} CDS ({estimate['model']} model): runtime {estimate['runtime']}s, memory {estimate['memory']}, {estimate['cpu']} cpu")
+    return estimate
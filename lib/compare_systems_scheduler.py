@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from compare_systems_telemetry import measure_stage
+
+# Number of worker processes for the cpu stages, set by the app service from the job allocation
+ALLOCATED_CPU_ENV = 'P3_ALLOCATED_CPU'
+DEFAULT_WORKERS = 3
+
+# Returns the number of cpu workers of the job: the parallel job field, the allocation
+# of the app service or the default
+def get_workers(job_data):
+    workers = job_data.get('parallel') or os.environ.get(ALLOCATED_CPU_ENV) or DEFAULT_WORKERS
+    return max(1, int(workers))
+
+class StageFailed(Exception):
+    pass
+
+class StageScheduler:
+    '''
+    Runs a graph of stages, each started as soon as the stages it depends on have finished.
+    A stage is called as fn(*args, *dependency_results).
+    'io' stages are network bound and run on threads of the calling process, so their
+    results are passed to dependent io stages without copies. 'cpu' stages run on a pool
+    of worker processes, their arguments and results are pickled and should stay small;
+    large tables are handed over as columnar table directories.
+    The pool is forked before any stage thread starts.
+    A stage whose dependency failed is not run and fails as well. Results are released
+    once every dependent stage has started unless the stage was added with keep=True.
+    The telemetry of every stage that ran is collected in the telemetry dict.
+    '''
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self.stages = {}
+        self.telemetry = {}
+        self.start_time = None
+
+    def add_stage(self, name, fn, args=(), deps=(), kind='io', keep=False):
+        if kind not in ('io', 'cpu'):
+            raise ValueError(f'Unknown stage kind {kind}')
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dep}')
+        self.stages[name] = {'fn': fn, 'args': tuple(args), 'deps': tuple(deps), 'kind': kind, 'keep': keep}
+
+    def _submit_cpu(self, pool, fn, args):
+        future = Future()
+        pool.apply_async(fn, args, callback=future.set_result, error_callback=future.set_exception)
+        return future
+
+    # Runs every stage and returns (results, failures), dicts keyed by stage name.
+    # results holds the kept results, failures the exception of every failed stage
+    def run(self):
+        cpu_stages = [name for name in self.stages if self.stages[name]['kind'] == 'cpu']
+        io_stages = [name for name in self.stages if self.stages[name]['kind'] == 'io']
+        pool = None
+        if len(cpu_stages) > 0:
+            pool = multiprocessing.Pool(processes=min(self.workers, len(cpu_stages)))
+        waiting_dependants = {name: 0 for name in self.stages}
+        for stage in self.stages.values():
+            for dep in stage['deps']:
+                waiting_dependants[dep] += 1
+        results = {}
+        finished = set()
+        failures = {}
+        pending = list(self.stages)
+        running = {}
+        submitted = {}
+        self.start_time = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(io_stages))) as executor:
+                while len(pending) > 0 or len(running) > 0:
+                    started = True
+                    while started:
+                        started = False
+                        for name in list(pending):
+                            stage = self.stages[name]
+                            failed_deps = [dep for dep in stage['deps'] if dep in failures]
+                            if len(failed_deps) > 0:
+                                failures[name] = StageFailed(f'dependency {failed_deps[0]} failed')
+                                pending.remove(name)
+                                started = True
+                                continue
+                            if not all(dep in finished for dep in stage['deps']):
+                                continue
+                            args = stage['args'] + tuple(results[dep] for dep in stage['deps'])
+                            print(f'starting stage {name}')
+                            if stage['kind'] == 'cpu':
+                                future = self._submit_cpu(pool, measure_stage, ('cpu', stage['fn'], args))
+                            else:
+                                future = executor.submit(measure_stage, 'io', stage['fn'], args)
+                            running[future] = name
+                            submitted[name] = time.time()
+                            pending.remove(name)
+                            started = True
+                            for dep in stage['deps']:
+                                waiting_dependants[dep] -= 1
+                                if waiting_dependants[dep] == 0 and not self.stages[dep]['keep']:
+                                    results.pop(dep, None)
+                    if len(running) == 0:
+                        break
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        try:
+                            result, telemetry = future.result()
+                        except Exception as e:
+                            sys.stderr.write(f'Stage {name} failed:\n{"".join(traceback.format_exception(type(e), e, e.__traceback__))}\n')
+                            failures[name] = e
+                            self.telemetry[name] = {'kind': self.stages[name]['kind'], 'worker': '', 'status': 'failed',
+                                'start': submitted[name], 'end': time.time(), 'wall_seconds': time.time() - submitted[name]}
+                            continue
+                        self.telemetry[name] = dict(telemetry, status='success')
+                        finished.add(name)
+                        print(f'finished stage {name}')
+                        if waiting_dependants[name] > 0 or self.stages[name]['keep']:
+                            results[name] = result
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return ({name: results[name] for name in results if self.stages[name]['keep']}, failures)
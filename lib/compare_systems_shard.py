@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from compare_systems_table import read_columnar_table, write_columnar_table
+
+# Partial results of one shard of a job are written to a directory holding this manifest
+# and the columnar tables it names. The merge step concatenates the partials of every
+# shard in shard order, which is the order an unsharded job produces them in.
+SHARD_MANIFEST = 'shard.json'
+# A job run with keep_summaries leaves the same partials for all of its genomes in
+# <output_file>_summaries, an update of the job starts from them
+SUMMARIES_SUFFIX = '_summaries'
+
+# Parses a shard specification 'i/n' into (i, n), shards are numbered from 0
+def parse_shard(spec):
+    try:
+        shard, n_shards = [int(x) for x in str(spec).split('/')]
+    except ValueError:
+        raise ValueError(f'Invalid shard {spec}, expected i/n')
+    if n_shards < 1 or shard < 0 or shard >= n_shards:
+        raise ValueError(f'Invalid shard {spec}, expected 0 <= i < n')
+    return (shard, n_shards)
+
+# Returns the genome ids of a shard: a contiguous block of whole units of unit_size genomes,
+# so the query chunks of a shard are the query chunks of the unsharded job
+def get_shard_genome_ids(genome_ids, shard, n_shards, unit_size):
+    n_units = (len(genome_ids) + unit_size - 1) // unit_size
+    first_unit = shard * n_units // n_shards
+    last_unit = (shard + 1) * n_units // n_shards
+    return genome_ids[first_unit * unit_size:last_unit * unit_size]
+
+def write_shard_manifest(shard_dir, manifest):
+    with open(os.path.join(shard_dir, SHARD_MANIFEST), 'w') as o:
+        json.dump(manifest, o)
+
+# Reads the manifests of the shard directories and returns them in shard order.
+# Every shard of the job must be present exactly once
+def read_shard_manifests(shard_dirs, job_key):
+    manifests = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, SHARD_MANIFEST)) as i:
+            manifest = json.load(i)
+        if manifest['job_key'] != job_key:
+            raise ValueError(f'Shard {shard_dir} belongs to a different job')
+        manifest['shard_dir'] = os.path.abspath(shard_dir)
+        manifests.append(manifest)
+    manifests.sort(key=lambda manifest: manifest['shard'])
+    n_shards = manifests[0]['n_shards'] if len(manifests) > 0 else 0
+    if [manifest['shard'] for manifest in manifests] != list(range(n_shards)) or any(manifest['n_shards'] != n_shards for manifest in manifests):
+        raise ValueError(f'Expected shards 0 to {n_shards - 1} once each, found {[manifest["shard"] for manifest in manifests]}')
+    return manifests
+
+# Reads the summaries manifest left in the output directory of a previous job
+def read_summaries_manifest(output_dir):
+    manifest_files = glob.glob(os.path.join(output_dir, '*' + SUMMARIES_SUFFIX, SHARD_MANIFEST))
+    if len(manifest_files) != 1:
+        raise ValueError(f'Expected one job summaries directory in {output_dir}, found {len(manifest_files)}')
+    with open(manifest_files[0]) as i:
+        manifest = json.load(i)
+    manifest['shard_dir'] = os.path.dirname(os.path.abspath(manifest_files[0]))
+    return manifest
+
+# Returns the rows of frame in the order a job of genome_ids produces them: unit by unit of
+# unit_size genomes and by sort_column within a unit. Without a sort_column the rows of a
+# unit are ordered by genome id, each genome keeping the order of its rows, as a query
+# sorted by feature_id, which starts with the genome id, returns them
+def sort_unit_rows(frame, genome_ids, unit_size, sort_column=None, genome_column='genome_id'):
+    unit_of_genome = {gid: pos // unit_size for pos, gid in enumerate(genome_ids)}
+    genome_values = frame[genome_column].astype(str)
+    units = genome_values.map(unit_of_genome).to_numpy(dtype=np.int64)
+    if sort_column is not None and sort_column in frame.columns:
+        keys = frame[sort_column].astype(str)
+    else:
+        keys = genome_values + '.'
+    order = np.lexsort((pd.factorize(keys, sort=True)[0], units))
+    return frame.take(order).reset_index(drop=True)
+
+# Concatenates columnar tables in order into a new table under table_dir
+# columns: optional column order of the result, columns missing from a table are null
+# genome_ids: optional list of genomes whose rows are kept. With a unit_size, the rows are
+# placed in the order a job of these genomes produces, see sort_unit_rows
+def concat_columnar_tables(table_dirs, table_dir, prefix, columns=None, genome_ids=None, genome_column='genome_id', unit_size=None, sort_column=None):
+    frames = []
+    for shard_table in table_dirs:
+        frame = read_columnar_table(shard_table)
+        if genome_ids is not None:
+            frame = frame[frame[genome_column].isin(genome_ids)]
+        if columns is not None:
+            frame = frame.reindex(columns=columns)
+        frames.append(frame)
+    frame = pd.concat(frames, ignore_index=True)
+    if genome_ids is not None and unit_size is not None:
+        frame = sort_unit_rows(frame, genome_ids, unit_size, sort_column, genome_column)
+    return write_columnar_table(frame, table_dir, prefix=prefix)
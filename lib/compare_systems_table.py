@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Column by column storage of a DataFrame that worker processes open with numpy memory maps
+# instead of receiving a pickled copy of the table.
+# Numeric and boolean columns are stored as .npy arrays. String columns are stored as
+# categorical int32 codes plus a fixed width array of the distinct values. Anything else
+# falls back to a pickled column.
+
+def _column_file(table_dir, idx, suffix):
+    return os.path.join(table_dir, f'{idx}.{suffix}')
+
+# Writes df to a new directory under parent_dir and returns the directory path
+def write_columnar_table(df, parent_dir, prefix='table_'):
+    table_dir = tempfile.mkdtemp(dir=parent_dir, prefix=prefix)
+    schema = []
+    for idx, column in enumerate(df.columns):
+        series = df[column]
+        if pd.api.types.is_bool_dtype(series.dtype) or (pd.api.types.is_numeric_dtype(series.dtype) and series.dtype.kind in 'iuf'):
+            np.save(_column_file(table_dir, idx, 'npy'), series.to_numpy())
+            schema.append({'name': column, 'kind': 'array'})
+            continue
+        values = pd.Categorical(series)
+        if pd.api.types.infer_dtype(values.categories, skipna=True) in ('string', 'empty'):
+            np.save(_column_file(table_dir, idx, 'npy'), values.codes.astype(np.int32))
+            np.save(_column_file(table_dir, idx, 'categories.npy'), np.asarray(values.categories, dtype=str))
+            schema.append({'name': column, 'kind': 'category'})
+        else:
+            with open(_column_file(table_dir, idx, 'pkl'), 'wb') as o:
+                pickle.dump(series.to_numpy(), o)
+            schema.append({'name': column, 'kind': 'pickle'})
+    with open(os.path.join(table_dir, 'schema.json'), 'w') as o:
+        json.dump({'columns': schema, 'rows': df.shape[0]}, o)
+    return table_dir
+
+# Opens a table written by write_columnar_table, optionally reading only the given columns.
+# Array columns and category codes are memory mapped, not copied into the process
+def read_columnar_table(table_dir, columns=None):
+    with open(os.path.join(table_dir, 'schema.json')) as i:
+        schema = json.load(i)
+    data = {}
+    for idx, column in enumerate(schema['columns']):
+        name = column['name']
+        if columns is not None and name not in columns:
+            continue
+        if column['kind'] == 'array':
+            data[name] = np.load(_column_file(table_dir, idx, 'npy'), mmap_mode='r')
+        elif column['kind'] == 'category':
+            codes = np.load(_column_file(table_dir, idx, 'npy'), mmap_mode='r')
+            categories = np.load(_column_file(table_dir, idx, 'categories.npy'), mmap_mode='r')
+            data[name] = pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object))
+        else:
+            with open(_column_file(table_dir, idx, 'pkl'), 'rb') as i:
+                data[name] = pickle.load(i)
+    return pd.DataFrame(data, copy=False)
+
+def remove_columnar_table(table_dir):
+    shutil.rmtree(table_dir, ignore_errors=True)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import contextvars
+import json
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+TELEMETRY_FILE = 'telemetry.json'
+
+# Counters of the stage running in the current context. The threads a stage fetches chunks
+# on run in copies of its context, so they add to the counters of the stage
+_stage_counters = contextvars.ContextVar('stage_counters', default=None)
+_counters_lock = threading.Lock()
+
+def _add_counters(**values):
+    counters = _stage_counters.get()
+    if counters is None:
+        return
+    with _counters_lock:
+        for key, value in values.items():
+            counters[key] = counters.get(key, 0) + value
+
+def record_request(wire_bytes, content_bytes):
+    _add_counters(requests=1, wire_bytes=wire_bytes, bytes=content_bytes)
+
+# Records rows read or written by the current stage
+def record_rows(rows):
+    _add_counters(rows=rows)
+
+# Records the CDS count of the genomes of the current stage, only the stages reading the
+# genome table record it. It is the weight the resource estimate is calibrated on
+def record_cds(cds):
+    _add_counters(cds=cds)
+
+def _run_in_stage_thread(fn, *args):
+    start_cpu = time.thread_time()
+    try:
+        return fn(*args)
+    finally:
+        _add_counters(cpu_seconds=time.thread_time() - start_cpu)
+
+# Submits fn(*args) to an executor on behalf of the current stage: requests, rows and cpu
+# time of the call are counted in the stage
+def submit_in_stage(executor, fn, *args):
+    return executor.submit(contextvars.copy_context().run, _run_in_stage_thread, fn, *args)
+
+# Resets the peak resident set size of the process to its current size, so the peak read
+# at the end of a stage is the peak of the stage. Returns False where the kernel does not allow it
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as o:
+            o.write('5')
+    except OSError:
+        return False
+    return True
+
+# Runs a stage and returns (result, telemetry). cpu stages run alone in a pool process,
+# so the cpu time of the process is theirs, io stages count the cpu time of their threads.
+# peak_rss_mb is the peak of the stage when peak_rss_scope is 'stage': the peak of a pool
+# process is reset when a cpu stage starts. io stages share the main process with each
+# other, their peak_rss_mb is the peak of the process up to the end of the stage, scope 'process'
+def measure_stage(kind, fn, args):
+    counters = {'requests': 0, 'wire_bytes': 0, 'bytes': 0, 'rows': 0, 'cpu_seconds': 0.0}
+    peak_rss_scope = 'stage' if kind == 'cpu' and reset_peak_rss() else 'process'
+    token = _stage_counters.set(counters)
+    cpu_clock = time.process_time if kind == 'cpu' else time.thread_time
+    start_time = time.time()
+    start_cpu = cpu_clock()
+    try:
+        result = fn(*args)
+    finally:
+        _stage_counters.reset(token)
+    telemetry = {
+        'kind': kind,
+        'worker': multiprocessing.current_process().name if kind == 'cpu' else threading.current_thread().name,
+        'pid': os.getpid(),
+        'start': start_time,
+        'end': time.time(),
+        'wall_seconds': time.time() - start_time,
+        'cpu_seconds': cpu_clock() - start_cpu + counters.pop('cpu_seconds'),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_rss_scope': peak_rss_scope
+    }
+    telemetry.update(counters)
+    return (result, telemetry)
+
+# Writes the telemetry of the stages of a job to output_dir, stage times are relative to start_time
+def write_telemetry(output_dir, stage_telemetry, start_time):
+    stages = {}
+    for name, telemetry in stage_telemetry.items():
+        stages[name] = dict(telemetry, start=round(telemetry['start'] - start_time, 3), end=round(telemetry['end'] - start_time, 3))
+    telemetry_json = {
+        'wall_seconds': time.time() - start_time,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'stages': stages
+    }
+    with open(os.path.join(output_dir, TELEMETRY_FILE), 'w') as o:
+        json.dump(telemetry_json, o, indent=1)
+    return telemetry_json
+
+# Returns the lines of the report summarizing the telemetry of a job
+def summarize_telemetry(telemetry_json, n_slowest=3):
+    stages = telemetry_json['stages']
+    requests = sum(telemetry.get('requests', 0) for telemetry in stages.values())
+    wire_bytes = sum(telemetry.get('wire_bytes', 0) for telemetry in stages.values())
+    content_bytes = sum(telemetry.get('bytes', 0) for telemetry in stages.values())
+    summary_lines = [f"Run time: {telemetry_json['wall_seconds']:.1f}s over {len(stages)} stages, {requests} requests, "
+        f"{wire_bytes/1024**2:.1f} MB downloaded ({content_bytes/1024**2:.1f} MB uncompressed), peak memory {telemetry_json['peak_rss_mb']:.0f} MB"]
+    slowest = sorted(stages.items(), key=lambda item: item[1]['wall_seconds'], reverse=True)[:n_slowest]
+    summary_lines.append('Slowest stages: ' + ', '.join(f"{name} {telemetry['wall_seconds']:.1f}s ({telemetry['worker'] or telemetry['status']})" for name, telemetry in slowest))
+    summary_lines.append(f'Stage telemetry: {TELEMETRY_FILE}')
+    return summary_lines
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+import os, sys, json
+import argparse
+from compare_systems_estimate import ESTIMATE_MODEL_ENV, calibrate_estimate_model
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f'Fits the resource estimate model of compare_systems on the telemetry of earlier jobs. Point {ESTIMATE_MODEL_ENV} at the model file to use it.')
+    parser.add_argument('telemetry_files', nargs='+', help='telemetry.json files of completed jobs')
+    parser.add_argument('-o', help='model file to write', required=True)
+    map_args = parser.parse_args()
+
+    telemetry_jsons = []
+    for telemetry_file in map_args.telemetry_files:
+        with open(telemetry_file) as i:
+            telemetry_jsons.append(json.load(i))
+    model = calibrate_estimate_model(telemetry_jsons)
+    if len(model) == 0:
+        sys.stderr.write('No job in the telemetry files ran the features query: exiting\n')
+        sys.exit(2)
+    with open(map_args.o, 'w') as o:
+        json.dump(model, o, indent=1)
+    for system, system_model in model.items():
+        print(f"{system}: {system_model['seconds'][0]:.1f}s + {system_model['seconds'][1]:.2e}s per unit, {system_model['memory_mb'][0]:.0f} MB + {system_model['memory_mb'][1]:.2e} MB per unit")
+    print(f"model of {len(telemetry_jsons)} jobs written to {map_args.o}")
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 import os, sys, json
 import argparse
-from compare_systems_lib import run_compare_systems
+from compare_systems_lib import estimate_compare_systems, merge_compare_systems, run_compare_systems
 if __name__ == "__main__":
+    # compare_systems merge --jfile <job> -o <output_dir> <shard_dir>...
+    merge = len(sys.argv) > 1 and sys.argv[1] == 'merge'
+    if merge:
+        sys.argv.pop(1)
     parser = argparse.ArgumentParser()
     #if you want to support multiple genomes for alignment you should make this json payload an nargs+ parameter
     parser.add_argument('--jfile',help='json file for job: \
@@ -10,6 +14,14 @@ if __name__ == "__main__":
             "recipe": ["PATHWAYS","SUBSYSTEMS","FAMILIES"', required=True)
     # parser.add_argument('--sstring', help='json server string specifying api {"data_api":"url"}', required=True, default=None)
     parser.add_argument('-o', help='output directory. Defaults to current directory.', required=False, default=None)
+    parser.add_argument('--resume', action='store_true', help='resume a failed job from the checkpoint in its output directory', required=False, default=False)
+    parser.add_argument('--keep-summaries', action='store_true', help='keep the per genome partial tables in the output directory so the job can be updated', required=False, default=False)
+    parser.add_argument('--update', help='output directory of a job run with --keep-summaries, only genomes added since are queried', required=False, default=None)
+    parser.add_argument('--shard', help='only query the i-th of n blocks of genomes (i/n, from 0) and write partial results to merge', required=False, default=None)
+    if merge:
+        parser.add_argument('shard_dirs', nargs='+', help='partial result directories of the shards')
+    parser.add_argument('--estimate', action='store_true', help='only estimate the runtime and memory of the job, written to estimate.json in the output directory', required=False, default=False)
+    parser.add_argument('--parallel', type=int, help='number of worker processes. Defaults to P3_ALLOCATED_CPU or 3.', required=False, default=None)
     if len(sys.argv) ==1:
         parser.print_help()
         sys.exit(2)
@@ -26,6 +38,16 @@ if __name__ == "__main__":
     else:
         output_dir=map_args.o
     job_data["output_path"]=output_dir
+    if map_args.resume:
+        job_data["resume"]=True
+    if map_args.parallel is not None:
+        job_data["parallel"]=map_args.parallel
+    if map_args.keep_summaries:
+        job_data["keep_summaries"]=True
+    if map_args.update is not None:
+        job_data["update_from"]=map_args.update
+    if map_args.shard is not None:
+        job_data["shard"]=map_args.shard
     '''
     try:
         tool_params=json.loads(map_args.p)
@@ -33,4 +55,9 @@ if __name__ == "__main__":
         tool_params={}
     '''
     #print("Parameters: {}".format(tool_params), file=sys.stdout)
-    run_compare_systems(job_data,output_dir)
+    if map_args.estimate:
+        estimate_compare_systems(job_data,output_dir)
+    elif merge:
+        merge_compare_systems(job_data,output_dir,map_args.shard_dirs)
+    else:
+        run_compare_systems(job_data,output_dir)
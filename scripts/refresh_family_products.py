@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+import os, sys
+import argparse
+import requests
+from bvbrc_api import authenticateByEnv
+from compare_systems_cache import FamilyProductStore, FAMILY_STORE_ENV
+from compare_systems_lib import refresh_family_products
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Loads every protein_family_ref product into the family product store used by compare_systems')
+    parser.add_argument('--store', help=f'SQLite file of the store. Defaults to {FAMILY_STORE_ENV}.', required=False, default=os.environ.get(FAMILY_STORE_ENV))
+    parser.add_argument('--page-size', type=int, help='number of families per query', required=False, default=25000)
+    map_args = parser.parse_args()
+    if not map_args.store:
+        sys.stderr.write(f'No store given and {FAMILY_STORE_ENV} is not set\n')
+        sys.exit(2)
+
+    s = requests.Session()
+    authenticateByEnv(s)
+    store = FamilyProductStore.from_env(map_args.store)
+    total = refresh_family_products(store, s, page_size=map_args.page_size)
+    print(f"{total} families refreshed, {store.count()} in {store.db_file}")
+    store.close()
@@ -32,6 +32,22 @@ sub preflight
     my $token = $app->token();
     my $ws = $app->workspace();
 
+    #
+    # Size the job from its genomes. The genome count ladder below is only used
+    # when the estimate fails.
+    #
+    my $estimate = estimate_compsystems($params, $token);
+    if ($estimate)
+    {
+        return {
+            cpu => $estimate->{cpu},
+            memory => $estimate->{memory},
+            runtime => $estimate->{runtime},
+            storage => 0,
+            is_control_task => 0,
+        };
+    }
+
     my $api = P3DataAPI->new();
     my $groups = $params->{genome_groups}; 
     my $numGenomes = 0;
@@ -68,6 +84,33 @@ sub preflight
     return $pf;
 }
 
+#
+# Runs compare_systems --estimate on the job parameters and returns the estimate,
+# undef when it fails.
+#
+sub estimate_compsystems
+{
+    my($params, $token) = @_;
+
+    my $tmp = File::Temp->newdir( CLEANUP => 1 );
+    my $jdesc = "$tmp/jobdesc.json";
+    write_file($jdesc, encode_json($params));
+
+    local $ENV{KB_AUTH_TOKEN} = $ENV{KB_AUTH_TOKEN};
+    $ENV{KB_AUTH_TOKEN} = ref($token) ? $token->token : $token if $token;
+    my @cmd = ("compare_systems", "-o", "$tmp/estimate", "--jfile", $jdesc, "--estimate");
+    my $ok = run(\@cmd);
+    my $estimate_file = "$tmp/estimate/estimate.json";
+    if (!$ok || ! -s $estimate_file)
+    {
+        warn "Resource estimate failed: @cmd\n";
+        return undef;
+    }
+    my $estimate = decode_json(read_file($estimate_file));
+    print STDERR "Estimate: ", Dumper($estimate);
+    return $estimate;
+}
+
 sub process_compsystems
 {
     my($app, $app_def, $raw_params, $params) = @_;   
@@ -113,6 +156,7 @@ sub process_compsystems
     my $parallel = $ENV{P3_ALLOCATED_CPU};
 
     my @cmd = ("compare_systems","-o",$work_dir,"--jfile", $jdesc);
+    push(@cmd, "--parallel", $parallel) if $parallel;
 
     warn Dumper (\@cmd, $params_to_app);
 
@@ -123,7 +167,7 @@ sub process_compsystems
         die "Command failed: @cmd\n";
     }
 
-    my @output_suffixes = ([qr/\.tsv$/, 'tsv'],[qr/\.json$/, 'json'],[qr/\.txt$/, 'txt']);
+    my @output_suffixes = ([qr/\.tsv$/, 'tsv'],[qr/\.json$/, 'json'],[qr/\.txt$/, 'txt'],[qr/\.npz$/, 'unspecified']);
     
     my $outfile;
     opendir(D, $work_dir) or die "Cannot opendir $work_dir: $!";